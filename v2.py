@@ -3,14 +3,36 @@ import math
 import random
 import json
 import os
+import weakref
+import asyncio
+import struct
+import time
+import threading
+import collections
+import gzip
+import zlib
+import atexit
+import queue
+import sqlite3
+import array
+import gc
+import tracemalloc
+import mmap
+import io
 
 import pygame
 
+try:
+    import numpy as np
+except ImportError:  # NumPy необязателен: без него отключаются частицы
+    np = None
+
 
 # ---------- Настройки ----------
 WIDTH, HEIGHT = 1000, 800
 FPS = 120
 TITLE = "Oracle"
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
 
 WHITE = (255, 255, 255)
 BLACK = (0, 0, 0)
@@ -23,15 +45,27 @@ BLUE = (52, 152, 219)
 
                                        
 # ---------- Вспомогательные функции ----------
+_FONT_CACHE: dict[int, pygame.font.Font] = {}
+
+
 def load_font(size: int) -> pygame.font.Font:
+    # Шрифт на размер создаётся один раз: draw_text зовёт это каждый кадр
+    font = _FONT_CACHE.get(size)
+    if font is not None:
+        return font
     pygame.font.init()
     try:
-        return pygame.font.SysFont("segoeui", size)
+        font = pygame.font.SysFont("segoeui", size)
     except Exception:
-        return pygame.font.Font(None, size)
+        font = pygame.font.Font(None, size)
+    _FONT_CACHE[size] = font
+    return font
 
 
 def draw_text(surface: pygame.Surface, text: str, size: int, color, x: int, y: int, center=True):
+    if not isinstance(surface, pygame.Surface):
+        surface.draw_text(text, size, color, x, y, center)
+        return
     font = load_font(size)
     lines = text.split("\n")
     total_height = sum(font.size(line)[1] for line in lines)
@@ -46,12 +80,154 @@ def draw_text(surface: pygame.Surface, text: str, size: int, color, x: int, y: i
         surface.blit(surf, rect)
 
 
+# Атлас глифов для текста, который меняется каждый кадр (таймеры, HP, кулдауны, журнал боя).
+# Все символы набора лежат в одной поверхности (на GPU — в одной текстуре): новая строка —
+# это пачка копий из неё, без font.render и без новых поверхностей. На Surface строка
+# уходит одним вызовом blits(), на Renderer — копиями из текстуры. Ширины символов
+# известны сразу, кернинг пар считается при первой встрече; кэшируется только раскладка
+# строки (смещения глифов), не её картинка. Символ вне набора — обычный draw_text.
+GLYPH_CHARSET = (
+    " !\"#$%&'()*+,-./0123456789:;<=>?@ABCDEFGHIJKLMNOPQRSTUVWXYZ[\\]^_`abcdefghijklmnopqrstuvwxyz{|}~"
+    "АБВГДЕЁЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯабвгдеёжзийклмнопрстуфхцчшщъыьэюя—–…№«»•·°×"
+)
+GLYPH_ATLAS_WIDTH = 512
+GLYPH_LINE_CACHE = 256
+
+
+class GlyphAtlas:
+    __slots__ = ("font", "color", "glyphs", "kerning", "_surface", "_runs")
+
+    def __init__(self, size: int, color):
+        font = self.font = load_font(size)
+        self.color = color
+        # символ -> ширина; области в атласе появляются вместе с поверхностью
+        self.glyphs: dict[str, list] = {ch: [None, font.size(ch)[0]] for ch in GLYPH_CHARSET}
+        self.kerning: dict[str, int] = {}
+        self._surface: pygame.Surface | None = None
+        self._runs: dict[str, tuple] = {}
+
+    @property
+    def surface(self) -> pygame.Surface:
+        if self._surface is None:
+            # Упаковка полками слева направо
+            rendered = [(ch, self.font.render(ch, True, self.color)) for ch in GLYPH_CHARSET]
+            places = []
+            x = y = row = 0
+            for ch, surf in rendered:
+                w, h = surf.get_size()
+                if x + w > GLYPH_ATLAS_WIDTH:
+                    x, y, row = 0, y + row + 1, 0
+                places.append((ch, surf, x, y))
+                x += w + 1
+                row = max(row, h)
+            atlas = pygame.Surface((GLYPH_ATLAS_WIDTH, y + row), pygame.SRCALPHA)
+            for ch, surf, gx, gy in places:
+                atlas.blit(surf, (gx, gy))
+                self.glyphs[ch][0] = (gx, gy, surf.get_width(), surf.get_height())
+            if pygame.display.get_surface() is not None:
+                atlas = atlas.convert_alpha()  # формат экрана — блиты без преобразования
+            self._surface = atlas
+        return self._surface
+
+    def covers(self, text: str) -> bool:
+        glyphs = self.glyphs
+        for ch in text:
+            if ch not in glyphs and ch != "\n":
+                return False
+        return True
+
+    def run(self, line: str) -> tuple:
+        # (ширина, высота строки, ((область, смещение x), ...)) — пробелы не рисуются
+        entry = self._runs.get(line)
+        if entry is not None:
+            return entry
+        if len(self._runs) >= GLYPH_LINE_CACHE:
+            self._runs.clear()
+        self.surface
+        glyphs, kerning = self.glyphs, self.kerning
+        quads = []
+        x = 0
+        prev = ""
+        for ch in line:
+            if prev:
+                pair = prev + ch
+                k = kerning.get(pair)
+                if k is None:
+                    k = kerning[pair] = self.font.size(pair)[0] - glyphs[prev][1] - glyphs[ch][1]
+                x += k
+            area, advance = glyphs[ch]
+            if ch != " ":
+                quads.append((area, x))
+            x += advance
+            prev = ch
+        entry = self._runs[line] = (x, self.font.size(line)[1], tuple(quads))
+        return entry
+
+
+_GLYPH_ATLASES: dict[tuple, GlyphAtlas] = {}
+
+
+def glyph_atlas(size: int, color) -> GlyphAtlas:
+    key = (size, tuple(color))
+    atlas = _GLYPH_ATLASES.get(key)
+    if atlas is None:
+        atlas = _GLYPH_ATLASES[key] = GlyphAtlas(size, color)
+    return atlas
+
+
+def draw_glyphs(target, text: str, size: int, color, x: int, y: int, center=True):
+    # Та же раскладка, что у draw_text
+    if not isinstance(target, pygame.Surface) and not isinstance(target, RendererTarget):
+        target.draw_glyphs(text, size, color, x, y, center)
+        return
+    atlas = glyph_atlas(size, color)
+    if not atlas.covers(text):
+        draw_text(target, text, size, color, x, y, center)
+        return
+    runs = [atlas.run(line) for line in text.split("\n")]
+    if isinstance(target, pygame.Surface):
+        source = atlas.surface
+        offset_y = -sum(run[1] for run in runs) // 2 if center else 0
+        for i, (width, h, quads) in enumerate(runs):
+            if center:
+                left, top = x - width // 2, y + offset_y + i * (h + 4) - h // 2
+            else:
+                left, top = x, y + i * (h + 4)
+            target.blits([(source, (left + dx, top), area) for area, dx in quads], doreturn=False)
+        return
+    tex = target.texture(atlas.surface)[0]
+    offset_y = -sum(run[1] for run in runs) // 2 if center else 0
+    for i, (width, h, quads) in enumerate(runs):
+        if center:
+            # Как у Rect.center: левый верхний угол через целочисленное деление пополам
+            left, top = x - width // 2, y + offset_y + i * (h + 4) - h // 2
+        else:
+            left, top = x, y + i * (h + 4)
+        for area, dx in quads:
+            tex.draw(srcrect=area, dstrect=(left + dx, top, area[2], area[3]))
+
+
+def wrap_text(text: str, font: pygame.font.Font, max_width: int) -> list[str]:
+    # Перенос по словам с учётом явных переводов строк
+    lines: list[str] = []
+    for paragraph in text.split("\n"):
+        line = ""
+        for word in paragraph.split(" "):
+            candidate = word if not line else line + " " + word
+            if line and font.size(candidate)[0] > max_width:
+                lines.append(line)
+                line = word
+            else:
+                line = candidate
+        lines.append(line)
+    return lines
+
+
 def load_player_sprite(size: tuple[int, int]) -> pygame.Surface:
     # Пытаемся загрузить спрайт игрока из assets/player.png и масштабируем под size
     # Если файла нет, рисуем запасной плейсхолдер (маленький человечек)
-    path = os.path.join("assets", "player.png")
     try:
-        img = pygame.image.load(path).convert_alpha()
+        img = load_image("player.png")
         if img.get_size() != size:
             img = pygame.transform.smoothscale(img, size)
         return img
@@ -70,10 +246,9 @@ def load_player_sprite(size: tuple[int, int]) -> pygame.Surface:
 def load_menu_background(size: tuple[int, int]) -> pygame.Surface:
     # Загружает фон главного меню из assets/menu_bg.png, масштабирует под экран
     # Если файла нет, рисует простой градиентный фон
-    path = os.path.join("assets", "menu_bg.png")
     w, h = size
     try:
-        img = pygame.image.load(path).convert()
+        img = load_image("menu_bg.png", alpha=False)
         if img.get_size() != size:
             img = pygame.transform.smoothscale(img, size)
         return img
@@ -90,6 +265,163 @@ def load_menu_background(size: tuple[int, int]) -> pygame.Surface:
         return bg
 
 
+# ---------- Пакет ресурсов ----------
+# Для раздачи ресурсы собираются в один файл (--build-pack): заголовок, индекс со смещениями
+# и данные записей, выровненные по 16 байт. Картинки хранятся уже раскодированными в BGRA —
+# том же порядке байт, что у convert_alpha() на дисплее ARGB8888, — поэтому Surface создаётся
+# прямо поверх отображённой памяти (mmap + frombuffer) без декодирования и копий. С
+# --pack-compress записи, которые хорошо жмутся, хранятся сжатыми zlib: файл в разы меньше,
+# но при загрузке распаковка и одна копия. Короткие звуки лежат как есть (FILE) и
+# декодируются микшером из памяти; музыка по-прежнему стримится из assets/. Нет пакета —
+# грузим отдельные файлы из assets/.
+ASSET_PACK_PATH = "assets.pack"
+ASSET_PACK_MAGIC = b"ORPK"
+ASSET_PACK_VERSION = 1
+ASSET_PACK_ALIGN = 16
+ASSET_PACK_COMPRESS_RATIO = 0.75  # сжимаем, только если запись уменьшается хотя бы на четверть
+ASSET_IMAGE_EXTS = (".png", ".jpg", ".jpeg", ".gif", ".bmp")
+ASSET_FILE_EXTS = (".wav", ".ogg")
+
+_PACK_HEADER = struct.Struct("<4sHII")          # магия, версия, число записей, размер индекса
+_PACK_ENTRY = struct.Struct("<QIIHH4sB")        # смещение, размер в файле, исходный размер, w, h, формат, zlib
+
+
+class AssetPack:
+    def __init__(self, path: str = ASSET_PACK_PATH):
+        self.path = path
+        self.entries: dict[str, tuple] = {}
+        self._map = None
+        self._view: memoryview | None = None
+        self._opened = False
+        self._lock = threading.Lock()
+
+    def open(self) -> bool:
+        # Один open+mmap на весь процесс; дальше никаких обращений к файловой системе.
+        # Первым может обратиться поток звука, поэтому индекс разбирается под замком,
+        # а _opened ставится только когда entries и _map уже готовы.
+        if self._opened:
+            return self._map is not None
+        with self._lock:
+            if not self._opened:
+                self._load()
+                self._opened = True
+        return self._map is not None
+
+    def _load(self):
+        try:
+            with open(self.path, "rb") as f:
+                # ACCESS_COPY: страницы приватные, запись в Surface не испортит файл
+                pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        except (OSError, ValueError):
+            return
+        magic, version, count, index_size = _PACK_HEADER.unpack_from(pack, 0)
+        if magic != ASSET_PACK_MAGIC or version != ASSET_PACK_VERSION:
+            pack.close()
+            return
+        entries = {}
+        pos = _PACK_HEADER.size
+        for _ in range(count):
+            (name_len,) = struct.unpack_from("<H", pack, pos)
+            name = pack[pos + 2:pos + 2 + name_len].decode("utf-8")
+            pos += 2 + name_len
+            entries[name] = _PACK_ENTRY.unpack_from(pack, pos)
+            pos += _PACK_ENTRY.size
+        self.entries = entries
+        self._view = memoryview(pack)
+        self._map = pack
+
+    def __contains__(self, name: str) -> bool:
+        return self.open() and name in self.entries
+
+    def data(self, name: str):
+        # Память записи: срез отображения или распакованный bytearray
+        if not self.open():
+            return None
+        entry = self.entries.get(name)
+        if entry is None:
+            return None
+        offset, stored, raw, _, _, _, compressed = entry
+        view = self._view[offset:offset + stored]
+        if compressed:
+            return bytearray(zlib.decompress(view, bufsize=raw))
+        return view
+
+    def surface(self, name: str) -> pygame.Surface | None:
+        data = self.data(name)
+        if data is None:
+            return None
+        _, _, _, w, h, fmt, _ = self.entries[name]
+        if fmt == b"FILE":
+            return None
+        return pygame.image.frombuffer(data, (w, h), fmt.decode("ascii"))
+
+
+ASSET_PACK = AssetPack()
+# Картинки, перечитанные горячей перезагрузкой: важнее пакета и старых файлов
+_RELOADED_IMAGES: dict[str, pygame.Surface] = {}
+
+
+def load_image(asset_rel_path: str, alpha: bool = True) -> pygame.Surface:
+    # Сначала пакет, иначе отдельный файл из assets/; ошибки — как у pygame.image.load
+    img = _RELOADED_IMAGES.get(asset_rel_path)
+    if img is None:
+        img = ASSET_PACK.surface(asset_rel_path)
+    if img is None:
+        img = pygame.image.load(os.path.join("assets", asset_rel_path))
+        return img.convert_alpha() if alpha else img.convert()
+    return img if alpha else img.convert()
+
+
+def build_asset_pack(source: str = "assets", path: str = ASSET_PACK_PATH, compress: bool = False,
+                     compress_ratio: float = ASSET_PACK_COMPRESS_RATIO) -> dict:
+    records = []
+    for root, dirs, files in os.walk(source):
+        dirs.sort()
+        for filename in sorted(files):
+            full = os.path.join(root, filename)
+            name = os.path.relpath(full, source).replace(os.sep, "/")
+            ext = os.path.splitext(filename)[1].lower()
+            if ext in ASSET_IMAGE_EXTS:
+                img = pygame.image.load(full)
+                w, h = img.get_size()
+                payload, fmt = pygame.image.tobytes(img, "BGRA"), b"BGRA"
+            elif ext in ASSET_FILE_EXTS:
+                with open(full, "rb") as f:
+                    payload = f.read()
+                w = h = 0
+                fmt = b"FILE"
+            else:
+                continue
+            packed = zlib.compress(payload, 9) if compress else payload
+            compressed = compress and len(packed) <= len(payload) * compress_ratio
+            records.append((name, packed if compressed else payload, len(payload), w, h, fmt, compressed))
+
+    index_size = sum(2 + len(r[0].encode("utf-8")) + _PACK_ENTRY.size for r in records)
+    offset = _PACK_HEADER.size + index_size
+    index = bytearray(_PACK_HEADER.pack(ASSET_PACK_MAGIC, ASSET_PACK_VERSION, len(records), index_size))
+    offsets = []
+    for name, stored, raw, w, h, fmt, compressed in records:
+        offset += -offset % ASSET_PACK_ALIGN
+        offsets.append(offset)
+        encoded = name.encode("utf-8")
+        index += struct.pack("<H", len(encoded)) + encoded
+        index += _PACK_ENTRY.pack(offset, len(stored), raw, w, h, fmt, int(compressed))
+        offset += len(stored)
+    with open(path + ".tmp", "wb") as f:
+        f.write(index)
+        for record, at in zip(records, offsets):
+            f.write(b"\0" * (at - f.tell()))
+            f.write(record[1])
+    os.replace(path + ".tmp", path)
+    return {"path": path, "entries": len(records), "bytes": offset,
+            "compressed": sum(1 for r in records if r[6]), "raw_bytes": sum(r[2] for r in records)}
+
+
+def format_pack_report(report: dict) -> str:
+    return (f"Пакет {report['path']}: {report['entries']} записей ({report['compressed']} сжато), "
+            f"{report['bytes'] / 1024:.0f} КиБ, пиксели без сжатия {report['raw_bytes'] / 1024:.0f} КиБ")
+
+
 # ---------- Текстуры ----------
 _TEXTURE_CACHE: dict[tuple[str, tuple[int, int]], pygame.Surface] = {}
 
@@ -99,9 +431,8 @@ def load_texture(asset_rel_path: str, size: tuple[int, int], fallback_color=(80,
     key = (asset_rel_path, size)
     if key in _TEXTURE_CACHE:
         return _TEXTURE_CACHE[key]
-    full_path = os.path.join("assets", asset_rel_path)
     try:
-        img = pygame.image.load(full_path).convert_alpha()
+        img = load_image(asset_rel_path)
         if img.get_size() != size:
             img = pygame.transform.smoothscale(img, size)
         _TEXTURE_CACHE[key] = img
@@ -122,6 +453,199 @@ def draw_textured_rect(screen: pygame.Surface, rect: pygame.Rect, asset_rel_path
     screen.blit(tex, rect.topleft)
 
 
+TILE_SIZE = 32
+# Позиции плиток пола считаются один раз, а не создаются заново в каждом кадре
+FLOOR_TILES = tuple((x, y) for x in range(0, WIDTH, TILE_SIZE) for y in range(0, HEIGHT, TILE_SIZE))
+
+
+def draw_floor(screen: pygame.Surface, asset_rel_path: str, fallback_color):
+    tex = load_texture(asset_rel_path, (TILE_SIZE, TILE_SIZE), fallback_color=fallback_color)
+    for pos in FLOOR_TILES:
+        screen.blit(tex, pos)
+
+
+# ---------- Анимация спрайтов ----------
+# Кадры режутся из листов один раз при загрузке; отражённые и тонированные варианты
+# запекаются один раз и кэшируются. Часы анимации общие для всех спрайтов с одной частотой,
+# поэтому одинаковые спрайты (например, два часовых) не тратят время на собственный таймер.
+ANIM_FPS = 8.0
+DEFEATED_TINT = (40, 140, 60)
+PLAYER_DIRECTIONS = ("down", "left", "right", "up")
+
+
+class AnimationClock:
+    __slots__ = ("fps", "time", "step")
+
+    def __init__(self, fps: float):
+        self.fps = fps
+        self.time = 0.0
+        self.step = 0
+
+    def advance(self, dt: float):
+        self.time += dt
+        self.step = int(self.time * self.fps)
+
+
+_ANIMATION_CLOCKS: dict[float, AnimationClock] = {}
+
+
+def animation_clock(fps: float) -> AnimationClock:
+    clock = _ANIMATION_CLOCKS.get(fps)
+    if clock is None:
+        clock = _ANIMATION_CLOCKS[fps] = AnimationClock(fps)
+    return clock
+
+
+def tick_animation_clocks(dt: float):
+    for clock in _ANIMATION_CLOCKS.values():
+        clock.advance(dt)
+
+
+def tint_surface(surf: pygame.Surface, color, amount: float = 0.6) -> pygame.Surface:
+    # Смешивание с цветом с сохранением альфы: rgb * (1 - amount) + color * amount
+    out = surf.convert_alpha()
+    keep = int(255 * (1.0 - amount))
+    out.fill((keep, keep, keep, 255), special_flags=pygame.BLEND_RGBA_MULT)
+    out.fill((int(color[0] * amount), int(color[1] * amount), int(color[2] * amount), 0), special_flags=pygame.BLEND_RGBA_ADD)
+    return out
+
+
+class Animation:
+    __slots__ = ("frames", "clock", "_variants")
+
+    def __init__(self, frames: list[pygame.Surface], fps: float = ANIM_FPS):
+        self.frames = tuple(frames)
+        self.clock = animation_clock(fps)
+        self._variants: dict[tuple, "Animation"] = {}
+
+    def frame(self) -> pygame.Surface:
+        frames = self.frames
+        return frames[self.clock.step % len(frames)] if len(frames) > 1 else frames[0]
+
+    def variant(self, flip_x: bool = False, tint=None) -> "Animation":
+        # Отражённая/тонированная копия, запекается при первом запросе
+        if not flip_x and tint is None:
+            return self
+        key = (flip_x, tint)
+        anim = self._variants.get(key)
+        if anim is None:
+            frames = []
+            for f in self.frames:
+                if flip_x:
+                    f = pygame.transform.flip(f, True, False)
+                if tint is not None:
+                    f = tint_surface(f, tint)
+                frames.append(f)
+            anim = Animation(frames, self.clock.fps)
+            self._variants[key] = anim
+        return anim
+
+
+def slice_sheet(sheet: pygame.Surface, frame_size: tuple[int, int], size: tuple[int, int]) -> list[list[pygame.Surface]]:
+    # Лист разрезается на строки кадров frame_size, каждый кадр масштабируется под size
+    fw, fh = frame_size
+    rows = []
+    for y in range(0, sheet.get_height() - fh + 1, fh):
+        row = []
+        for x in range(0, sheet.get_width() - fw + 1, fw):
+            frame = sheet.subsurface(pygame.Rect(x, y, fw, fh))
+            row.append(pygame.transform.smoothscale(frame, size) if frame_size != size else frame.copy())
+        rows.append(row)
+    return rows
+
+
+_ANIMATION_CACHE: dict[tuple[str, tuple[int, int]], Animation] = {}
+
+
+def load_animation(asset_rel_path: str, size: tuple[int, int], fallback_color=(80, 80, 80), border_radius: int = 0, fps: float = ANIM_FPS) -> Animation:
+    # Горизонтальная лента квадратных кадров (ширина кратна высоте) или одиночная картинка
+    key = (asset_rel_path, size)
+    anim = _ANIMATION_CACHE.get(key)
+    if anim is not None:
+        return anim
+    frames = None
+    try:
+        sheet = load_image(asset_rel_path)
+        sw, sh = sheet.get_size()
+        if sh > 0 and sw >= 2 * sh and sw % sh == 0:
+            frames = slice_sheet(sheet, (sh, sh), size)[0]
+    except Exception:
+        pass
+    if frames is None:
+        frames = [load_texture(asset_rel_path, size, fallback_color=fallback_color, border_radius=border_radius)]
+    anim = _ANIMATION_CACHE[key] = Animation(frames, fps)
+    return anim
+
+
+def draw_animated_rect(screen: pygame.Surface, rect: pygame.Rect, asset_rel_path: str, fallback_color=(80, 80, 80), border_radius: int = 0, tint=None):
+    anim = load_animation(asset_rel_path, (rect.width, rect.height), fallback_color=fallback_color, border_radius=border_radius)
+    screen.blit(anim.variant(tint=tint).frame(), rect.topleft)
+
+
+_PLAYER_ANIMATIONS: dict[tuple[int, int], dict[str, Animation]] = {}
+PLAYER_ASSETS = ("player_sheet.png", "player_idle.png", "player.png")
+
+
+def load_player_animations(size: tuple[int, int]) -> dict[str, Animation]:
+    anims = _PLAYER_ANIMATIONS.get(size)
+    if anims is None:
+        anims = _PLAYER_ANIMATIONS[size] = build_player_animations(size)
+    return anims
+
+
+def build_player_animations(size: tuple[int, int]) -> dict[str, Animation]:
+    # assets/player_sheet.png: 4 строки шагов (вниз, влево, вправо, вверх), кадры квадратные.
+    # assets/player_idle.png (необязательно): такие же 4 строки для стояния на месте.
+    # Без листа — статичный спрайт, левое направление — запечённое отражение правого.
+    anims = {}
+    for prefix, name in (("walk", "player_sheet.png"), ("idle", "player_idle.png")):
+        try:
+            sheet = load_image(name)
+            fh = sheet.get_height() // len(PLAYER_DIRECTIONS)
+            rows = slice_sheet(sheet, (fh, fh), size)
+            for direction, row in zip(PLAYER_DIRECTIONS, rows):
+                if row:
+                    anims[f"{prefix}_{direction}"] = Animation(row)
+        except Exception:
+            pass
+    if "walk_right" not in anims:
+        static = Animation([load_player_sprite(size)])
+        for direction in PLAYER_DIRECTIONS:
+            anims[f"walk_{direction}"] = static.variant(flip_x=direction == "left")
+    for direction in PLAYER_DIRECTIONS:
+        walk = anims[f"walk_{direction}"]
+        anims.setdefault(f"idle_{direction}", Animation([walk.frames[0]]))
+    return anims
+
+
+class AnimatedSprite:
+    # Состояние анимации одной сущности: направление и «идёт/стоит»
+    __slots__ = ("animations", "direction", "moving")
+
+    def __init__(self, animations: dict[str, Animation], direction: str = "down"):
+        self.animations = animations
+        self.direction = direction
+        self.moving = False
+
+    def set_motion(self, dx: float, dy: float):
+        self.moving = dx != 0 or dy != 0
+        if abs(dx) > abs(dy):
+            self.direction = "right" if dx > 0 else "left"
+        elif dy != 0:
+            self.direction = "down" if dy > 0 else "up"
+
+    def image(self) -> pygame.Surface:
+        return self.animations[("walk_" if self.moving else "idle_") + self.direction].frame()
+
+
+def emit_level_up(scene: "Scene"):
+    # Вспышка повышения уровня вокруг игрока (или в центре экрана, если игрока в сцене нет)
+    player = getattr(scene, "player", None)
+    x, y = player.center if player is not None else (WIDTH // 2, HEIGHT // 2)
+    scene.manager.particles.emit_effect("level_up", x, y)
+    AUDIO.play("level_up")
+
+
 def make_scene_switch(scene_name: str, game_state: "GameState"):
     # Отложенное создание сцены по имени класса, чтобы избежать предупреждений линтера
     def factory(manager):
@@ -130,6 +654,833 @@ def make_scene_switch(scene_name: str, game_state: "GameState"):
     return factory
 
 
+# ---------- Бэкенды отрисовки ----------
+# Сцены рисуют в «цель»: это либо pygame.Surface (программный блит), либо RendererTarget поверх
+# pygame._sdl2.video.Renderer. RendererTarget повторяет нужное сценам подмножество API Surface
+# (fill/blit/get_size), а примитивы идут через draw_rect/draw_circle/draw_text. Поверхности
+# загружаются в текстуры один раз (кэш по самой поверхности); если содержимое поверхности
+# меняется (туман мини-карты, свет), владелец вызывает mark_surface_changed и текстура обновится.
+try:
+    from pygame._sdl2.video import Window as SDLWindow, Renderer as SDLRenderer, Texture as SDLTexture
+except ImportError:  # старый pygame без _sdl2 — доступен только программный бэкенд
+    SDLWindow = SDLRenderer = SDLTexture = None
+
+# Режимы смешивания SDL для special_flags блита
+_SDL_BLEND_ADD = 2
+_SDL_BLEND_MOD = 4
+_SURFACE_GENERATION: "weakref.WeakKeyDictionary[pygame.Surface, int]" = weakref.WeakKeyDictionary()
+RENDERER_TEXT_CACHE = 512
+
+
+def mark_surface_changed(surf: pygame.Surface):
+    _SURFACE_GENERATION[surf] = _SURFACE_GENERATION.get(surf, 0) + 1
+
+
+def draw_rect(target, color, rect, width: int = 0, border_radius: int = 0):
+    if isinstance(target, pygame.Surface):
+        pygame.draw.rect(target, color, rect, width, border_radius)
+    else:
+        target.draw_rect(color, rect, width)
+
+
+def draw_circle(target, color, center, radius: int, width: int = 0):
+    if isinstance(target, pygame.Surface):
+        pygame.draw.circle(target, color, center, radius, width)
+    else:
+        target.draw_circle(color, center, radius, width)
+
+
+class RendererTarget:
+    def __init__(self, renderer):
+        self.renderer = renderer
+        self._textures: "weakref.WeakKeyDictionary[pygame.Surface, list]" = weakref.WeakKeyDictionary()
+        self._text: dict[tuple, tuple] = {}
+        self._circles: dict[tuple, object] = {}
+        self.uploads = 0
+
+    def get_size(self) -> tuple[int, int]:
+        return (WIDTH, HEIGHT)
+
+    def get_width(self) -> int:
+        return WIDTH
+
+    def get_height(self) -> int:
+        return HEIGHT
+
+    def texture(self, surf: pygame.Surface):
+        # [текстура, поколение поверхности, исходный режим смешивания]
+        generation = _SURFACE_GENERATION.get(surf, 0)
+        entry = self._textures.get(surf)
+        if entry is None:
+            tex = SDLTexture.from_surface(self.renderer, surf)
+            entry = self._textures[surf] = [tex, generation, tex.blend_mode]
+            self.uploads += 1
+        elif entry[1] != generation:
+            entry[0].update(surf)
+            entry[1] = generation
+            self.uploads += 1
+        return entry
+
+    def fill(self, color, rect=None):
+        self.renderer.draw_color = pygame.Color(color)
+        if rect is None:
+            self.renderer.clear()
+        else:
+            self.renderer.fill_rect(rect)
+
+    def blit(self, source: pygame.Surface, dest, area=None, special_flags: int = 0):
+        tex, _, blend = self.texture(source)
+        w, h = (area[2], area[3]) if area is not None else source.get_size()
+        x, y = dest[0], dest[1]
+        if special_flags == pygame.BLEND_RGB_MULT:
+            tex.blend_mode = _SDL_BLEND_MOD
+        elif special_flags == pygame.BLEND_RGB_ADD:
+            tex.blend_mode = _SDL_BLEND_ADD
+        tex.draw(srcrect=area, dstrect=(x, y, w, h))
+        if special_flags:
+            tex.blend_mode = blend
+
+    def draw_rect(self, color, rect, width: int = 0):
+        r = self.renderer
+        r.draw_color = pygame.Color(color)
+        if width == 0:
+            r.fill_rect(rect)
+            return
+        rect = pygame.Rect(rect)
+        for _ in range(width):
+            r.draw_rect(rect)
+            rect.inflate_ip(-2, -2)
+
+    def draw_circle(self, color, center, radius: int, width: int = 0):
+        key = (tuple(color), radius, width)
+        tex = self._circles.get(key)
+        if tex is None:
+            surf = pygame.Surface((radius * 2 + 1, radius * 2 + 1), pygame.SRCALPHA)
+            pygame.draw.circle(surf, color, (radius, radius), radius, width)
+            tex = self._circles[key] = SDLTexture.from_surface(self.renderer, surf)
+        tex.draw(dstrect=(center[0] - radius, center[1] - radius, tex.width, tex.height))
+
+    def draw_text(self, text: str, size: int, color, x: int, y: int, center=True):
+        # Строки текста кэшируются как готовые текстуры с уже посчитанной раскладкой
+        key = (text, size, tuple(color), center)
+        lines = self._text.get(key)
+        if lines is None:
+            if len(self._text) >= RENDERER_TEXT_CACHE:
+                self._text.clear()
+            font = load_font(size)
+            parts = text.split("\n")
+            total_height = sum(font.size(line)[1] for line in parts)
+            offset_y = -total_height // 2 if center else 0
+            lines = []
+            for i, line in enumerate(parts):
+                surf = font.render(line, True, color)
+                rect = surf.get_rect()
+                if center:
+                    rect.center = (0, offset_y + i * (rect.height + 4))
+                else:
+                    rect.topleft = (0, i * (rect.height + 4))
+                lines.append((SDLTexture.from_surface(self.renderer, surf), rect))
+            lines = self._text[key] = tuple(lines)
+        for tex, rect in lines:
+            tex.draw(dstrect=(x + rect.x, y + rect.y, rect.width, rect.height))
+
+    def draw_points(self, xs, ys, colors, size: int = 2):
+        r = self.renderer
+        for x, y, (cr, cg, cb) in zip(xs.tolist(), ys.tolist(), colors.tolist()):
+            r.draw_color = (int(cr), int(cg), int(cb), 255)
+            r.fill_rect((x, y, size, size))
+
+
+# ---------- Частицы ----------
+# Пул фиксированного размера: все данные в заранее выделенных массивах NumPy,
+# обновление и отрисовка — векторные операции с out=, без объектов на частицу.
+# Без NumPy эффекты просто отключаются.
+PARTICLE_CAPACITY = 4096
+
+PARTICLE_EFFECTS: dict[str, dict] = {
+    "hit": dict(count=28, color=(255, 210, 140), speed=(80.0, 260.0), life=(0.2, 0.5), gravity=500.0),
+    "fire": dict(count=60, color=(255, 120, 30), speed=(40.0, 180.0), life=(0.4, 0.9), gravity=-120.0),
+    "dash": dict(count=40, color=(240, 240, 240), speed=(160.0, 320.0), life=(0.15, 0.35)),
+    "barrier": dict(count=90, color=(90, 170, 255), speed=(10.0, 40.0), life=(0.6, 1.1), radius=48.0),
+    "arcane": dict(count=220, color=(190, 90, 255), speed=(120.0, 420.0), life=(0.5, 1.2)),
+    "level_up": dict(count=160, color=(241, 196, 15), speed=(30.0, 140.0), life=(0.8, 1.6), gravity=-160.0, radius=12.0),
+}
+
+
+class ParticlePool:
+    def __init__(self, capacity: int = PARTICLE_CAPACITY, seed: int | None = None):
+        self.capacity = capacity
+        self.enabled = np is not None and capacity > 0
+        self.active = 0
+        self._cursor = 0
+        if not self.enabled:
+            return
+        f32 = np.float32
+        self.pos = np.zeros((capacity, 2), f32)
+        self.vel = np.zeros((capacity, 2), f32)
+        self.life = np.zeros(capacity, f32)
+        self.inv_max_life = np.ones(capacity, f32)
+        self.color = np.zeros((capacity, 3), f32)
+        self.gravity = np.zeros(capacity, f32)
+        self.rng = np.random.default_rng(seed)
+        # Рабочие буферы
+        self._rand = np.zeros((2, capacity), f32)
+        self._step = np.zeros((capacity, 2), f32)
+        self._alive = np.zeros(capacity, bool)
+        self._mask = np.zeros(capacity, bool)
+        self._cmp = np.zeros(capacity, bool)
+        self._fx = np.zeros(capacity, f32)
+        self._fade = np.zeros(capacity, f32)
+        self._ix = np.zeros(capacity, np.intp)
+        self._iy = np.zeros(capacity, np.intp)
+        self._ix1 = np.zeros(capacity, np.intp)
+        self._iy1 = np.zeros(capacity, np.intp)
+        self._rgb = np.zeros((capacity, 3), f32)
+
+    def clear(self):
+        if self.enabled:
+            self.life.fill(0.0)
+            self._alive.fill(False)
+        self.active = 0
+
+    def emit_effect(self, name: str, x: float, y: float):
+        self.emit(x, y, **PARTICLE_EFFECTS[name])
+
+    def emit(self, x: float, y: float, count: int, color, speed=(40.0, 160.0), life=(0.3, 0.8), gravity: float = 0.0, radius: float = 0.0):
+        # Новые частицы занимают слоты по кругу, вытесняя самые старые
+        if not self.enabled or count <= 0:
+            return
+        count = min(count, self.capacity)
+        start = self._cursor
+        first = min(count, self.capacity - start)
+        self._spawn(start, first, x, y, color, speed, life, gravity, radius)
+        if first < count:
+            self._spawn(0, count - first, x, y, color, speed, life, gravity, radius)
+        self._cursor = (start + count) % self.capacity
+        self.active = min(self.capacity, self.active + count)
+
+    def _spawn(self, start: int, n: int, x, y, color, speed, life, gravity, radius):
+        sl = slice(start, start + n)
+        angle, r = self._rand[0, :n], self._rand[1, :n]
+        self.rng.random(out=angle, dtype=np.float32)
+        self.rng.random(out=r, dtype=np.float32)
+        angle *= 2 * math.pi
+        vx, vy = self.vel[sl, 0], self.vel[sl, 1]
+        np.cos(angle, out=vx)
+        np.sin(angle, out=vy)
+        # Старт на окружности радиуса radius вокруг точки
+        np.multiply(vx, radius, out=self.pos[sl, 0])
+        np.multiply(vy, radius, out=self.pos[sl, 1])
+        self.pos[sl, 0] += x
+        self.pos[sl, 1] += y
+        # Скорость: случайная в диапазоне speed
+        r *= speed[1] - speed[0]
+        r += speed[0]
+        vx *= r
+        vy *= r
+        # Время жизни: случайное в диапазоне life
+        self.rng.random(out=r, dtype=np.float32)
+        r *= life[1] - life[0]
+        r += life[0]
+        self.life[sl] = r
+        np.reciprocal(r, out=self.inv_max_life[sl])
+        self.color[sl] = color
+        self.gravity[sl] = gravity
+        self._alive[sl] = True
+
+    def update(self, dt: float):
+        if not self.active:
+            return
+        np.multiply(self.vel, dt, out=self._step)
+        self.pos += self._step
+        np.multiply(self.gravity, dt, out=self._fx)
+        self.vel[:, 1] += self._fx
+        self.life -= dt
+        np.greater(self.life, 0.0, out=self._alive)
+        self.active = int(np.count_nonzero(self._alive))
+
+    def draw(self, surface: pygame.Surface):
+        # Частицы 2×2 пикселя, затухают к концу жизни; пишем прямо в пиксели поверхности
+        if not self.active:
+            return
+        w, h = surface.get_size()
+        x, y = self.pos[:, 0], self.pos[:, 1]
+        mask, cmp = self._mask, self._cmp
+        np.greater_equal(x, 0.0, out=mask)
+        mask &= self._alive
+        np.less(x, w - 1, out=cmp)
+        mask &= cmp
+        np.greater_equal(y, 0.0, out=cmp)
+        mask &= cmp
+        np.less(y, h - 1, out=cmp)
+        mask &= cmp
+        n = int(np.count_nonzero(mask))
+        if n == 0:
+            return
+        fx, ix, iy, ix1, iy1 = self._fx[:n], self._ix[:n], self._iy[:n], self._ix1[:n], self._iy1[:n]
+        np.compress(mask, x, out=fx)
+        ix[:] = fx
+        np.compress(mask, y, out=fx)
+        iy[:] = fx
+        np.add(ix, 1, out=ix1)
+        np.add(iy, 1, out=iy1)
+        fade = self._fade[:n]
+        np.compress(mask, self.life, out=fade)
+        np.compress(mask, self.inv_max_life, out=fx)
+        fade *= fx
+        np.clip(fade, 0.0, 1.0, out=fade)
+        rgb = self._rgb[:n]
+        np.compress(mask, self.color, axis=0, out=rgb)
+        rgb *= fade[:, None]
+        if not isinstance(surface, pygame.Surface):
+            surface.draw_points(ix, iy, rgb)
+            return
+        try:
+            pixels = pygame.surfarray.pixels3d(surface)
+        except (ValueError, pygame.error):
+            return
+        try:
+            pixels[ix, iy] = rgb
+            pixels[ix1, iy] = rgb
+            pixels[ix, iy1] = rgb
+            pixels[ix1, iy1] = rgb
+        finally:
+            del pixels
+
+
+# ---------- Сборщик мусора ----------
+# После загрузки долгоживущие объекты (шрифты, текстуры, диалоги, первая сцена) замораживаются
+# gc.freeze() и больше не обходятся сборщиком. Сборки старшего поколения во время игры
+# откладываются (порог поколения 2 поднимается) и выполняются целиком при смене сцены,
+# где короткая пауза незаметна. За кадр считается чистый прирост объектов под GC — рост счётчика
+# поколения 0; временные объекты, умершие в том же кадре, и объекты вне GC (Rect, числа, строки)
+# в него не попадают. Прирост сравнивается с бюджетом кадра; F3 — счётчик на экране.
+# В диагностическом режиме (--gc-report) tracemalloc дополнительно меряет пик памяти внутри кадра —
+# он видит все аллокации, включая временные, но заметно замедляет игру.
+GC_ALLOC_BUDGET = 300
+GC_DEFERRED_THRESHOLD = 1_000_000
+
+
+class GCGovernor:
+    def __init__(self, budget: int = GC_ALLOC_BUDGET):
+        self.budget = budget
+        self.active = False
+        self.tuned = False
+        self.overlay = False
+        self._thresholds = gc.get_threshold()
+        self._mark = 0
+        self._pending = 0
+        self._pause_start = 0.0
+        self._in_scene_collect = False
+        self.diagnose = False
+        self._own_tracing = False
+        self._frame_base = 0
+        self.last_tracked = 0
+        self.frame_pause = 0.0
+        self.frames = 0
+        self.over_budget = 0
+        self.total_tracked = 0
+        self.peak_tracked = 0
+        # Пик памяти сверх начала кадра (байты) — только в диагностике
+        self.total_frame_bytes = 0
+        self.peak_frame_bytes = 0
+        # Сборки по поколениям посреди кадра; полные сборки на смене сцены — отдельно
+        self.collections = [0, 0, 0]
+        self.scene_collections = 0
+        self.max_pause = 0.0
+        self.scene_pause = 0.0
+
+    def start(self, tune: bool = True, diagnose: bool = False):
+        if self.active:
+            return
+        self.tuned = tune
+        self.diagnose = diagnose
+        if diagnose:
+            self._own_tracing = not tracemalloc.is_tracing()
+            if self._own_tracing:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            self._frame_base = tracemalloc.get_traced_memory()[0]
+        self._thresholds = gc.get_threshold()
+        if tune:
+            gc.collect()
+            gc.freeze()
+            gc.set_threshold(self._thresholds[0], self._thresholds[1], GC_DEFERRED_THRESHOLD)
+        gc.callbacks.append(self._callback)
+        self._mark = gc.get_count()[0]
+        self.active = True
+
+    def stop(self):
+        if not self.active:
+            return
+        self.active = False
+        gc.callbacks.remove(self._callback)
+        if self._own_tracing:
+            tracemalloc.stop()
+            self._own_tracing = False
+        if self.tuned:
+            gc.set_threshold(*self._thresholds)
+            gc.unfreeze()
+
+    def _callback(self, phase: str, info: dict):
+        if phase == "start":
+            # Сборка обнуляет счётчик — запоминаем прирост до неё
+            self._pending += max(0, gc.get_count()[0] - self._mark)
+            self._pause_start = time.perf_counter()
+            return
+        self._mark = 0
+        if self._in_scene_collect:
+            return
+        self.collections[info["generation"]] += 1
+        self.frame_pause += time.perf_counter() - self._pause_start
+
+    def scene_changed(self):
+        if not (self.active and self.tuned):
+            return
+        self._in_scene_collect = True
+        started = time.perf_counter()
+        try:
+            gc.collect()
+        finally:
+            self._in_scene_collect = False
+        self.scene_pause = max(self.scene_pause, time.perf_counter() - started)
+        self.scene_collections += 1
+        self._mark = gc.get_count()[0]
+
+    def frame_done(self):
+        if not self.active:
+            return
+        count = gc.get_count()[0]
+        tracked = self._pending + max(0, count - self._mark)
+        self._pending = 0
+        self._mark = count
+        self.last_tracked = tracked
+        self.frames += 1
+        self.total_tracked += tracked
+        self.peak_tracked = max(self.peak_tracked, tracked)
+        if self.diagnose:
+            current, peak = tracemalloc.get_traced_memory()
+            used = max(0, peak - self._frame_base)
+            self.total_frame_bytes += used
+            self.peak_frame_bytes = max(self.peak_frame_bytes, used)
+            tracemalloc.reset_peak()
+            self._frame_base = current
+        if tracked > self.budget:
+            self.over_budget += 1
+        self.max_pause = max(self.max_pause, self.frame_pause)
+        self.frame_pause = 0.0
+
+    def handle_event(self, event) -> bool:
+        if event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+            self.overlay = not self.overlay
+            return True
+        return False
+
+    def draw_overlay(self, target):
+        if self.overlay and self.active:
+            color = RED if self.last_tracked > self.budget else LIGHT_GRAY
+            draw_text(target, f"gc+ {self.last_tracked}/{self.budget}  gc {self.collections[0]}/{self.collections[1]}/{self.collections[2]}",
+                      16, color, 8, HEIGHT - 24, center=False)
+
+    def report(self) -> dict:
+        report = {"frames": self.frames, "budget": self.budget, "over_budget": self.over_budget,
+                  "mean_tracked": self.total_tracked / self.frames if self.frames else 0.0,
+                  "peak_tracked": self.peak_tracked, "collections": list(self.collections),
+                  "scene_collections": self.scene_collections, "max_pause_ms": self.max_pause * 1000,
+                  "scene_pause_ms": self.scene_pause * 1000, "frozen": gc.get_freeze_count()}
+        if self.diagnose:
+            report["mean_frame_kb"] = self.total_frame_bytes / self.frames / 1024 if self.frames else 0.0
+            report["peak_frame_kb"] = self.peak_frame_bytes / 1024
+        return report
+
+
+def format_gc_report(report: dict) -> str:
+    frames = report["frames"]
+    share = 100.0 * report["over_budget"] / frames if frames else 0.0
+    gen0, gen1, gen2 = report["collections"]
+    lines = [
+        f"Чистый прирост объектов под GC за кадр: в среднем {report['mean_tracked']:.0f}, пик {report['peak_tracked']}, "
+        f"бюджет {report['budget']} превышен в {report['over_budget']} из {frames} кадров ({share:.1f}%)",
+        f"Сборки посреди кадра: gen0 {gen0}, gen1 {gen1}, gen2 {gen2}; худшая пауза {report['max_pause_ms']:.2f} мс",
+        f"Полные сборки на смене сцены: {report['scene_collections']}, худшая {report['scene_pause_ms']:.2f} мс; "
+        f"заморожено объектов: {report['frozen']}",
+    ]
+    if "peak_frame_kb" in report:
+        lines.append(f"Память внутри кадра (tracemalloc, с временными объектами): в среднем "
+                     f"{report['mean_frame_kb']:.1f} КБ, пик {report['peak_frame_kb']:.1f} КБ")
+    return "\n".join(lines)
+
+
+GC_GOVERNOR = GCGovernor()
+
+
+# ---------- Звук ----------
+# Музыка сцен стримится с диска через pygame.mixer.music (в памяти только буфер декодера),
+# короткие эффекты декодируются заранее в Sound и общие для всех сцен. Эффекты играют через
+# фиксированный пул каналов: свободный канал, иначе вытесняется самый старый голос с меньшим
+# или равным приоритетом, иначе звук пропускается. Загрузка и смена музыки идут в фоновом
+# потоке, поэтому главный цикл только ставит команды в очередь и запускает готовые Sound.
+# Нет файла эффекта — синтезируется короткий тон; нет музыки — сцена просто тихая.
+AUDIO_CHANNELS = 8
+MUSIC_FADE_MS = 400
+MUSIC_VOLUME = 0.6
+MUSIC_TRACKS = {
+    "OverworldScene": "music/overworld.ogg",
+    "FieldsScene": "music/fields.ogg",
+    "DungeonScene": "music/dungeon.ogg",
+    "CombatScene": "music/combat.ogg",
+}
+# Эффект: (файл, приоритет, тон-заглушка: начальная и конечная частота, длительность)
+SFX = {
+    "hit": ("sfx/hit.wav", 1, (220.0, 110.0, 0.08)),
+    "spell": ("sfx/spell.wav", 2, (440.0, 880.0, 0.18)),
+    "ability": ("sfx/ability.wav", 2, (330.0, 660.0, 0.15)),
+    "potion": ("sfx/potion.wav", 2, (520.0, 780.0, 0.2)),
+    "chest": ("sfx/chest.wav", 3, (392.0, 784.0, 0.35)),
+    "level_up": ("sfx/level_up.wav", 3, (523.0, 1046.0, 0.45)),
+}
+# Эффекты частиц боя и их звуки
+EFFECT_SFX = {"hit": "hit", "fire": "spell", "dash": "ability", "barrier": "ability", "arcane": "ability"}
+
+
+def synth_tone(f0: float, f1: float, seconds: float, frequency: int, channels: int) -> bytes:
+    # Простая «пищалка» со скольжением частоты и затуханием, 16 бит со знаком
+    n = max(1, int(frequency * seconds))
+    samples = array.array("h")
+    phase = 0.0
+    for i in range(n):
+        t = i / n
+        phase += 2 * math.pi * (f0 + (f1 - f0) * t) / frequency
+        value = int(12000 * (1.0 - t) * math.sin(phase))
+        samples.extend([value] * channels)
+    return samples.tobytes()
+
+
+class AudioManager:
+    def __init__(self, channels: int = AUDIO_CHANNELS):
+        self.channel_count = channels
+        self.enabled = False
+        self.sounds: dict[str, "pygame.mixer.Sound"] = {}
+        self.channels: list = []
+        # Для каждого канала: (приоритет, время запуска) текущего голоса
+        self.voices: list[tuple[int, float]] = []
+        self.track: str | None = None
+        self.stolen = 0
+        self.dropped = 0
+        self._commands: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> bool:
+        if self.enabled:
+            return True
+        try:
+            if not pygame.mixer.get_init():
+                pygame.mixer.init(frequency=44100, size=-16, channels=2, buffer=512)
+            pygame.mixer.set_num_channels(self.channel_count)
+        except pygame.error:
+            return False  # нет аудиоустройства — игра идёт без звука
+        self.channels = [pygame.mixer.Channel(i) for i in range(self.channel_count)]
+        self.voices = [(0, 0.0)] * self.channel_count
+        self.enabled = True
+        self._thread = threading.Thread(target=self._run, name="audio", daemon=True)
+        self._thread.start()
+        self._commands.put(("preload",))
+        return True
+
+    def stop(self):
+        if not self.enabled:
+            return
+        self.enabled = False
+        self._commands.put(None)
+        self._thread.join()
+        self._thread = None
+        pygame.mixer.music.stop()
+        pygame.mixer.stop()
+
+    def scene_changed(self, scene_name: str):
+        if self.enabled:
+            self._commands.put(("music", MUSIC_TRACKS.get(scene_name)))
+
+    def play(self, name: str):
+        # Главный поток: выбрать канал и запустить готовый Sound — без ввода-вывода
+        if not self.enabled:
+            return
+        sound = self.sounds.get(name)
+        if sound is None:
+            return  # ещё не декодирован
+        priority = SFX[name][1]
+        index = -1
+        for i, channel in enumerate(self.channels):
+            if not channel.get_busy():
+                index = i
+                break
+        if index < 0:
+            # Вытесняем самый старый голос среди самых низких приоритетов, если он не важнее нового
+            index = min(range(len(self.voices)), key=lambda i: self.voices[i])
+            if self.voices[index][0] > priority:
+                self.dropped += 1
+                return
+            self.stolen += 1
+        self.channels[index].play(sound)
+        self.voices[index] = (priority, time.perf_counter())
+
+    def _load_sound(self, rel_path: str, tone: tuple[float, float, float]):
+        data = ASSET_PACK.data(rel_path)
+        if data is not None:
+            try:
+                return pygame.mixer.Sound(file=io.BytesIO(data))
+            except pygame.error:
+                pass
+        path = os.path.join("assets", rel_path)
+        if data is None and os.path.exists(path):
+            try:
+                return pygame.mixer.Sound(path)
+            except pygame.error:
+                pass
+        frequency, _, channels = pygame.mixer.get_init()
+        return pygame.mixer.Sound(buffer=synth_tone(*tone, frequency, channels))
+
+    def _switch_music(self, rel_path: str | None):
+        if rel_path == self.track:
+            return
+        self.track = rel_path
+        if pygame.mixer.music.get_busy():
+            pygame.mixer.music.fadeout(MUSIC_FADE_MS)
+            time.sleep(MUSIC_FADE_MS / 1000.0)
+        path = os.path.join("assets", rel_path) if rel_path else None
+        if path is None or not os.path.exists(path):
+            pygame.mixer.music.stop()
+            return
+        try:
+            pygame.mixer.music.load(path)
+            pygame.mixer.music.set_volume(MUSIC_VOLUME)
+            pygame.mixer.music.play(-1, fade_ms=MUSIC_FADE_MS)
+        except pygame.error:
+            pass
+
+    def _run(self):
+        while True:
+            command = self._commands.get()
+            if command is None:
+                return
+            if command[0] == "preload":
+                for name, (rel_path, _, tone) in SFX.items():
+                    self.sounds[name] = self._load_sound(rel_path, tone)
+            elif command[0] == "music":
+                # Между переключениями могли накопиться новые — играем только последнюю сцену
+                target = command[1]
+                try:
+                    while True:
+                        pending = self._commands.get_nowait()
+                        if pending is None:
+                            return
+                        if pending[0] == "music":
+                            target = pending[1]
+                        else:
+                            self._commands.put(pending)
+                            break
+                except queue.Empty:
+                    pass
+                self._switch_music(target)
+
+
+AUDIO = AudioManager()
+
+
+# ---------- Телеметрия ----------
+# События игры складываются в кольцевой буфер (deque с maxlen: добавление O(1) без блокировок,
+# при переполнении теряются самые старые). Фоновый поток раз в TELEMETRY_FLUSH_INTERVAL или
+# при наборе пачки забирает их и дописывает в журнал: каждая пачка — отдельный gzip-член
+# в конце файла, поэтому журнал только растёт, а оборванная запись портит лишь последнюю пачку.
+TELEMETRY_DIR = "telemetry"
+TELEMETRY_CAPACITY = 16384
+TELEMETRY_BATCH = 512
+TELEMETRY_FLUSH_INTERVAL = 2.0
+
+
+class TelemetryBus:
+    def __init__(self, capacity: int = TELEMETRY_CAPACITY, batch: int = TELEMETRY_BATCH, flush_interval: float = TELEMETRY_FLUSH_INTERVAL):
+        self.buffer: collections.deque = collections.deque(maxlen=capacity)
+        self.batch = batch
+        self.flush_interval = flush_interval
+        self.path: str | None = None
+        self.enabled = False
+        self.emitted = 0
+        self.written = 0
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._atexit = False
+
+    def start(self, path: str | None = None):
+        if self.enabled:
+            return
+        if path is None:
+            os.makedirs(TELEMETRY_DIR, exist_ok=True)
+            path = os.path.join(TELEMETRY_DIR, time.strftime("%Y%m%d-%H%M%S") + f"-{os.getpid()}.log.gz")
+        self.path = path
+        self.enabled = True
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="telemetry", daemon=True)
+        self._thread.start()
+        if not self._atexit:
+            # Выход через sys.exit() из любой сцены тоже должен дописать хвост
+            atexit.register(self.stop)
+            self._atexit = True
+        self.emit("session_start")
+
+    def stop(self):
+        if not self.enabled:
+            return
+        self.emit("session_end")
+        self.enabled = False
+        self._stop.set()
+        self._wake.set()
+        self._thread.join()
+        self._thread = None
+        self.flush()
+
+    def emit(self, kind: str, **fields):
+        # Горячий путь главного цикла: только кортеж в deque
+        if not self.enabled:
+            return
+        self.buffer.append((time.time(), kind, fields))
+        self.emitted += 1
+        if len(self.buffer) >= self.batch:
+            self._wake.set()
+
+    def dropped(self) -> int:
+        return self.emitted - self.written - len(self.buffer)
+
+    def flush(self) -> int:
+        buffer = self.buffer
+        events = [buffer.popleft() for _ in range(len(buffer))]
+        if not events or self.path is None:
+            return 0
+        text = "".join(json.dumps(event, ensure_ascii=False, separators=(",", ":")) + "\n" for event in events)
+        data = gzip.compress(text.encode("utf-8"), compresslevel=6)
+        with open(self.path, "ab") as f:
+            f.write(data)
+        self.written += len(events)
+        return len(events)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except OSError:
+                pass  # диск недоступен — пачка теряется, игра продолжается
+
+
+TELEMETRY = TelemetryBus()
+
+
+def read_telemetry(path: str):
+    # Журнал читается по gzip-членам; пачка целиком разбирается одним json.loads
+    with open(path, "rb") as f:
+        data = f.read()
+    while data:
+        d = zlib.decompressobj(31)
+        try:
+            chunk = d.decompress(data)
+        except zlib.error:
+            break
+        if not d.eof:
+            break  # оборванная последняя пачка
+        text = chunk.decode("utf-8").rstrip("\n")
+        if text:
+            yield from json.loads("[" + text.replace("\n", ",") + "]")
+        data = d.unused_data
+
+
+def _aggregate_telemetry_file(path: str) -> collections.Counter:
+    stats: collections.Counter = collections.Counter()
+    for _, kind, fields in read_telemetry(path):
+        stats["events"] += 1
+        stats["kind:" + kind] += 1
+        if kind == "scene":
+            stats["scene:" + fields["name"]] += 1
+        elif kind == "combat_start":
+            stats["combat_start:" + fields["enemy"]] += 1
+        elif kind == "combat_end":
+            enemy = fields["enemy"]
+            stats[("combat_won:" if fields["won"] else "combat_lost:") + enemy] += 1
+            stats["combat_turns:" + enemy] += fields["turns"]
+        elif kind == "ability":
+            stats["ability:" + fields["key"]] += 1
+        elif kind == "xp":
+            stats["xp"] += fields["amount"]
+        elif kind == "level_up":
+            stats["max_level"] = max(stats["max_level"], fields["level"])
+        elif kind == "trial":
+            stats["trial_completed" if fields["completed"] else "trial_failed"] += 1
+    return stats
+
+
+def telemetry_files(directory: str = TELEMETRY_DIR) -> list[str]:
+    if not os.path.isdir(directory):
+        return []
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith(".log.gz"))
+
+
+def aggregate_telemetry(paths: list[str], workers: int | None = None) -> dict:
+    # Журналы независимы: при нескольких файлах разбираются пулом процессов
+    if len(paths) > 1 and (workers or os.cpu_count() or 1) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parts = list(pool.map(_aggregate_telemetry_file, paths))
+    else:
+        parts = [_aggregate_telemetry_file(path) for path in paths]
+    total: collections.Counter = collections.Counter()
+    max_level = 0
+    for part in parts:
+        max_level = max(max_level, part.pop("max_level", 0))
+        total.update(part)
+
+    def group(prefix: str) -> dict:
+        return {k[len(prefix):]: v for k, v in sorted(total.items()) if k.startswith(prefix)}
+
+    combats = {}
+    for enemy, started in group("combat_start:").items():
+        won = total["combat_won:" + enemy]
+        lost = total["combat_lost:" + enemy]
+        combats[enemy] = {
+            "started": started, "won": won, "lost": lost,
+            "turns_mean": total["combat_turns:" + enemy] / (won + lost) if won + lost else None,
+        }
+    return {
+        "files": len(paths),
+        "sessions": total["kind:session_start"],
+        "events": total["events"],
+        "kinds": group("kind:"),
+        "scenes": group("scene:"),
+        "combats": combats,
+        "abilities": group("ability:"),
+        "xp": total["xp"],
+        "level_ups": total["kind:level_up"],
+        "max_level": max_level,
+        "trials": {"completed": total["trial_completed"], "failed": total["trial_failed"]},
+        "saves": total["kind:save"],
+        "loads": total["kind:load"],
+    }
+
+
+def format_telemetry_report(report: dict) -> str:
+    lines = [f"Журналов: {report['files']}  сессий: {report['sessions']}  событий: {report['events']}"]
+    lines.append("Сцены: " + ", ".join(f"{k} {v}" for k, v in report["scenes"].items()))
+    lines.append("Бои (начато / победы / поражения / ходов в среднем):")
+    for enemy, c in report["combats"].items():
+        turns = f"{c['turns_mean']:.1f}" if c["turns_mean"] is not None else "-"
+        lines.append(f"  {enemy:16s} {c['started']:5d} {c['won']:5d} {c['lost']:5d} {turns:>6s}")
+    lines.append("Способности: " + (", ".join(f"{k} {v}" for k, v in report["abilities"].items()) or "-"))
+    lines.append(f"Опыт: {report['xp']}  повышений уровня: {report['level_ups']}  макс. уровень: {report['max_level']}")
+    lines.append(f"Забеги на время: пройдено {report['trials']['completed']}, провалено {report['trials']['failed']}")
+    lines.append(f"Сохранений: {report['saves']}  загрузок: {report['loads']}")
+    return "\n".join(lines)
+
+
 # ---------- Базовые сущности ----------
 class Scene:
     def __init__(self, manager: "SceneManager"):
@@ -144,10 +1495,56 @@ class Scene:
     def draw(self, screen: pygame.Surface):
         pass
 
+    def rewind_state(self):
+        # Неизменяемое состояние сцены для точки перемотки (None — только GameState)
+        return None
+
+    def idle_for(self) -> float | None:
+        # Сколько секунд кадр не изменится без ввода (None — сцена анимируется)
+        return None
+
+    def assets_reloaded(self, names: set[str]):
+        # Горячая перезагрузка: сцена подменяет то, что держит у себя (имена — от assets/)
+        pass
+
+
+class HeldKeys:
+    # Замена pygame.key.get_pressed() для сессий без окна: набор зажатых клавиш
+    __slots__ = ("down",)
+
+    def __init__(self):
+        self.down: set[int] = set()
+
+    def __getitem__(self, key: int) -> bool:
+        return key in self.down
+
 
 class SceneManager:
-    def __init__(self, start_scene_factory):
+    def __init__(self, start_scene_factory, headless: bool = False):
+        # headless: без окна и отрисовки (сервер, боты) — ввод только через held_keys
+        self.headless = headless
+        self.held_keys: HeldKeys | None = HeldKeys() if headless else None
+        self.quit_requested = False
+        # Выход сразу завершает процесс; сервер и поток симуляции только ставят флаг
+        self.exit_on_quit = not headless
+        # Файл сохранения F5/F9; у сессий без окна (сервер, боты) его нет — savegame.json общий на хост
+        self.save_path: str | None = None if headless else SAVE_PATH
+        # Общий пул частиц: эффекты переживают смену сцены (например, уровень после боя)
+        self.particles = ParticlePool(capacity=0 if headless else PARTICLE_CAPACITY)
         self.current = start_scene_factory(self)
+        self._reported_scene: Scene | None = None
+        self.rewind = RewindBuffer()
+        self.hot_reload: "HotReloader | None" = None
+
+    def pressed(self):
+        return self.held_keys if self.held_keys is not None else pygame.key.get_pressed()
+
+    def request_quit(self):
+        if not self.exit_on_quit:
+            self.quit_requested = True
+            return
+        pygame.quit()
+        sys.exit(0)
 
     def change(self, new_scene_factory):
         self.current = new_scene_factory(self)
@@ -157,136 +1554,308 @@ class SceneManager:
             self.current.handle_event(event)
 
     def update(self, dt):
+        if self.hot_reload is not None and self.hot_reload.pending():
+            self.hot_reload.apply(self)
+        if self.current is not self._reported_scene:
+            # Сцены переключаются и через change(), и прямым присваиванием current
+            self._reported_scene = self.current
+            TELEMETRY.emit("scene", name=type(self.current).__name__)
+            AUDIO.scene_changed(type(self.current).__name__)
+            GC_GOVERNOR.scene_changed()
+            game_state = getattr(self.current, "game_state", None)
+            if game_state is not None:
+                self.rewind.capture(game_state, type(self.current).__name__, self.current.rewind_state())
         if self.current:
             self.current.update(dt)
+        self.particles.update(dt)
+        if not self.headless:
+            tick_animation_clocks(dt)
 
     def draw(self, screen):
         if self.current:
             self.current.draw(screen)
+        self.particles.draw(screen)
+
+    def idle_for(self) -> float | None:
+        if self.current is not self._reported_scene or self.particles.active or not self.current:
+            return None
+        return self.current.idle_for()
+
+
+# ---------- Состояние игры ----------
+SAVE_PATH = "savegame.json"
+SAVE_DELTA_PATH = SAVE_PATH + ".delta"
+SAVE_DELTA_COMPACT = 32  # столько дописанных изменений — и следующее сохранение полное
+
+# Все сохраняемые поля состояния по порядку: (имя, значение по умолчанию).
+# Булевы поля упаковываются в одну битовую маску, у каждого поля свой бит «грязности».
+_STATE_FIELDS: tuple[tuple[str, object], ...] = (
+    ("honor", 0),
+    ("gold", 0),
+    ("helped_npc", False),
+    ("has_key", False),
+    ("beast_defeated", False),
+    # Инвентарь и квесты
+    ("has_sword", False),
+    ("potions", 0),
+    ("artifact_found", False),
+    ("guard_defeated", False),
+    ("quests", {
+        "beast": "Помочь городу изгнать зверя",
+        "key": "Найти способ открыть северную дверь",
+        "dungeon": "Исследовать тайник у ворот",
+    }),
+    # Расширение
+    ("herbs", 0),
+    ("companion_joined", False),
+    ("last_location", "overworld"),
+    # Враги подземелья и зачистка (кортеж — неизменяемый, его можно разделять между снимками)
+    ("defeated_enemies", ()),
+    ("dungeon_fully_cleared", False),
+    # Прокачка и артефакт/рогалик
+    ("level", 1),
+    ("xp", 0),
+    ("xp_to_next", 10),
+    ("base_atk", 2),
+    ("max_hp", 10),
+    ("artifact_level", 0),
+    ("run_number", 0),
+    ("miniboss_defeated", False),
+    ("final_boss_defeated", False),
+    # Способности (подобие RoR2): Q/E/R — активные с перезарядкой
+    ("abilities", None),
+    # Активности: тотем-вызов, забег на время
+    ("totem_defeated", False),
+    ("trial_active", False),
+    ("trial_time_left", 0.0),
+    ("trial_stage", 0),
+    ("trial_completed", False),
+    # Туман войны мини-карты: локация -> битовая маска открытых клеток
+    ("explored", {}),
+)
+_FIELD_INDEX = {name: i for i, (name, _) in enumerate(_STATE_FIELDS)}
+
+# Что сбрасывается при новом забеге: уровни, артефакт, инвентарь и способности переносятся
+_RUN_RESET_FIELDS = (
+    "honor", "gold", "helped_npc", "has_key", "beast_defeated", "guard_defeated",
+    "defeated_enemies", "dungeon_fully_cleared", "artifact_found", "miniboss_defeated",
+    "final_boss_defeated", "last_location",
+    "totem_defeated", "trial_active", "trial_time_left", "trial_stage", "trial_completed",
+)
+
+_ABILITY_DEFAULTS = (
+    ("q", "Рывок-удар", 6.0),
+    ("e", "Барьер", 8.0),
+    ("r", "Арканный взрыв", 16.0),
+)
+
+
+class AbilityState:
+    __slots__ = ("key", "name", "max_cd", "learned", "cd")
+
+    def __init__(self, key: str, name: str, max_cd: float, learned: bool = False, cd: float = 0.0):
+        self.key = key
+        self.name = name
+        self.max_cd = max_cd
+        self.learned = learned
+        self.cd = cd
+
+    def ready(self) -> bool:
+        return self.learned and self.cd <= 0.0
+
+    def trigger(self):
+        self.cd = self.max_cd
+        TELEMETRY.emit("ability", key=self.key)
+
+    def to_dict(self) -> dict:
+        return {"learned": self.learned, "cd": self.cd, "max_cd": self.max_cd, "name": self.name}
+
+
+class _Flag:
+    # Булево поле: хранится битом в GameState._flags
+    __slots__ = ("bit",)
+
+    def __init__(self, index: int):
+        self.bit = 1 << index
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        return bool(obj._flags & self.bit)
+
+    def __set__(self, obj, value):
+        flags = (obj._flags | self.bit) if value else (obj._flags & ~self.bit)
+        if flags != obj._flags:
+            obj._flags = flags
+            obj._dirty |= self.bit
+            obj._version += 1
+            obj._snapshot = None
+
+
+class _Field:
+    # Обычное поле: хранится в GameState._values по индексу
+    __slots__ = ("index", "bit")
+
+    def __init__(self, index: int):
+        self.index = index
+        self.bit = 1 << index
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        return obj._values[self.index]
+
+    def __set__(self, obj, value):
+        values = obj._values
+        if values[self.index] is value or values[self.index] == value:
+            return
+        values[self.index] = value
+        obj._dirty |= self.bit
+        obj._version += 1
+        obj._snapshot = None
 
 
 class GameState:
+    __slots__ = ("_flags", "_values", "_dirty", "_version", "_snapshot", "_save_id", "_deltas", "__weakref__")
+
     def __init__(self):
-        self.honor = 0
-        self.gold = 0
-        self.helped_npc = False
-        self.has_key = False
-        self.beast_defeated = False
-        # Новое: инвентарь и квесты
-        self.has_sword = False
-        self.potions = 0
-        self.artifact_found = False
-        self.guard_defeated = False
-        self.quests = {
-            "beast": "Помочь городу изгнать зверя",
-            "key": "Найти способ открыть северную дверь",
-            "dungeon": "Исследовать тайник у ворот",
-        }
-        # Расширение
-        self.herbs = 0
-        self.companion_joined = False
-        self.last_location = "overworld"
-        # Враги подземелья и зачистка
-        self.defeated_enemies: list[str] = []
-        self.dungeon_fully_cleared = False
-        # Прокачка и артефакт/рогалик
-        self.level = 1
-        self.xp = 0
-        self.xp_to_next = 10
-        self.base_atk = 2
-        self.max_hp = 10
-        self.artifact_level = 0
-        self.run_number = 0
-        self.miniboss_defeated = False
-        self.final_boss_defeated = False
-        # Способности (подобие RoR2): Q/E/R — активные с перезарядкой
-        self.abilities = {
-            "q": {"learned": False, "cd": 0.0, "max_cd": 6.0, "name": "Рывок-удар"},
-            "e": {"learned": False, "cd": 0.0, "max_cd": 8.0, "name": "Барьер"},
-            "r": {"learned": False, "cd": 0.0, "max_cd": 16.0, "name": "Арканный взрыв"},
+        self._flags = 0
+        self._values: list = [None] * len(_STATE_FIELDS)
+        for i, (name, default) in enumerate(_STATE_FIELDS):
+            if isinstance(default, bool):
+                if default:
+                    self._flags |= 1 << i
+            else:
+                self._values[i] = dict(default) if isinstance(default, dict) else default
+        self._values[_FIELD_INDEX["abilities"]] = {
+            key: AbilityState(key, name, max_cd) for key, name, max_cd in _ABILITY_DEFAULTS
         }
-        # Активности: тотем-вызов, забег на время
-        self.totem_defeated = False
-        self.trial_active = False
-        self.trial_time_left = 0.0
-        self.trial_stage = 0
-        self.trial_completed = False
+        self._dirty = 0
+        self._version = 0
+        self._snapshot = None
+        # Полное сохранение, с которым состояние сейчас совпадает (изменения — относительно него)
+        self._save_id: str | None = None
+        self._deltas = 0
+
+    # Отслеживание изменений
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def touch(self, name: str):
+        # Пометить поле изменённым (для изменений внутри контейнеров)
+        self._dirty |= 1 << _FIELD_INDEX[name]
+        self._version += 1
+        self._snapshot = None
+
+    def dirty_fields(self) -> list[str]:
+        return [name for i, (name, _) in enumerate(_STATE_FIELDS) if self._dirty >> i & 1]
+
+    def clear_dirty(self):
+        self._dirty = 0
+
+    def snapshot(self) -> tuple:
+        # Неизменяемый слепок для сравнения состояний; кэшируется до следующего изменения
+        if self._snapshot is None:
+            values = list(self._values)
+            values[_FIELD_INDEX["quests"]] = tuple(sorted(self.quests.items()))
+            values[_FIELD_INDEX["explored"]] = tuple(sorted(self.explored.items()))
+            values[_FIELD_INDEX["abilities"]] = tuple(ab.learned for ab in self.abilities.values())
+            self._snapshot = (self._flags, tuple(values))
+        return self._snapshot
+
+    def state_hash(self) -> int:
+        return hash(self.snapshot())
+
+    # Сериализация
+    def _export(self, name: str):
+        if name == "defeated_enemies":
+            return list(self.defeated_enemies)
+        if name == "abilities":
+            return {key: ab.to_dict() for key, ab in self.abilities.items()}
+        return getattr(self, name)
+
+    def _import(self, name: str, value):
+        if name == "quests":
+            if isinstance(value, dict):
+                self.quests = value
+        elif name == "defeated_enemies":
+            self.defeated_enemies = tuple(value or ())
+        elif name == "explored":
+            if isinstance(value, dict):
+                self.explored = {str(k): int(v) for k, v in value.items()}
+        elif name == "abilities":
+            if isinstance(value, dict):
+                for key, rec in value.items():
+                    ab = self.abilities.get(key)
+                    if ab is not None and isinstance(rec, dict):
+                        ab.learned = bool(rec.get("learned", ab.learned))
+                        ab.cd = float(rec.get("cd", 0.0))
+                self.touch("abilities")
+        else:
+            setattr(self, name, value)
 
     def to_dict(self) -> dict:
-        return {
-            "honor": self.honor,
-            "gold": self.gold,
-            "helped_npc": self.helped_npc,
-            "has_key": self.has_key,
-            "beast_defeated": self.beast_defeated,
-            "has_sword": self.has_sword,
-            "potions": self.potions,
-            "artifact_found": self.artifact_found,
-            "guard_defeated": self.guard_defeated,
-            "quests": self.quests,
-            "herbs": self.herbs,
-            "companion_joined": self.companion_joined,
-            "last_location": self.last_location,
-            "defeated_enemies": self.defeated_enemies,
-            "dungeon_fully_cleared": self.dungeon_fully_cleared,
-            "level": self.level,
-            "xp": self.xp,
-            "xp_to_next": self.xp_to_next,
-            "base_atk": self.base_atk,
-            "max_hp": self.max_hp,
-            "artifact_level": self.artifact_level,
-            "run_number": self.run_number,
-            "miniboss_defeated": self.miniboss_defeated,
-            "final_boss_defeated": self.final_boss_defeated,
-            "abilities": self.abilities,
-            "totem_defeated": self.totem_defeated,
-            "trial_active": self.trial_active,
-            "trial_time_left": self.trial_time_left,
-            "trial_stage": self.trial_stage,
-            "trial_completed": self.trial_completed,
-        }
+        return {name: self._export(name) for name, _ in _STATE_FIELDS}
+
+    def to_delta(self) -> dict:
+        # Только поля, изменённые с последнего clear_dirty()
+        return {name: self._export(name) for name in self.dirty_fields()}
+
+    def apply_delta(self, data: dict):
+        for name, _ in _STATE_FIELDS:
+            if name in data:
+                self._import(name, data[name])
+
+    def copy(self, share_containers: bool = False) -> "GameState":
+        # Быстрая копия без сериализации: неизменяемые значения разделяются, контейнеры копируются.
+        # share_containers — не копировать quests/explored/abilities, если копию в них не пишут.
+        gs = GameState.__new__(GameState)
+        gs._flags = self._flags
+        gs._values = list(self._values)
+        if not share_containers:
+            gs._values[_FIELD_INDEX["quests"]] = dict(self.quests)
+            gs._values[_FIELD_INDEX["explored"]] = dict(self.explored)
+            gs._values[_FIELD_INDEX["abilities"]] = {
+                key: AbilityState(ab.key, ab.name, ab.max_cd, ab.learned, ab.cd) for key, ab in self.abilities.items()
+            }
+        gs._dirty = 0
+        gs._version = 0
+        gs._snapshot = None
+        gs._save_id = None
+        gs._deltas = 0
+        return gs
 
     @staticmethod
     def from_dict(data: dict) -> "GameState":
         gs = GameState()
-        gs.honor = data.get("honor", 0)
-        gs.gold = data.get("gold", 0)
-        gs.helped_npc = data.get("helped_npc", False)
-        gs.has_key = data.get("has_key", False)
-        gs.beast_defeated = data.get("beast_defeated", False)
-        gs.has_sword = data.get("has_sword", False)
-        gs.potions = data.get("potions", 0)
-        gs.artifact_found = data.get("artifact_found", False)
-        gs.guard_defeated = data.get("guard_defeated", False)
-        qs = data.get("quests") or {}
-        if isinstance(qs, dict):
-            gs.quests = qs
-        gs.herbs = data.get("herbs", 0)
-        gs.companion_joined = data.get("companion_joined", False)
-        gs.last_location = data.get("last_location", "overworld")
-        gs.defeated_enemies = list(data.get("defeated_enemies", []))
-        gs.dungeon_fully_cleared = data.get("dungeon_fully_cleared", False)
-        gs.level = data.get("level", 1)
-        gs.xp = data.get("xp", 0)
-        gs.xp_to_next = data.get("xp_to_next", 10)
-        gs.base_atk = data.get("base_atk", 2)
-        gs.max_hp = data.get("max_hp", 10)
-        gs.artifact_level = data.get("artifact_level", 0)
-        gs.run_number = data.get("run_number", 0)
-        gs.miniboss_defeated = data.get("miniboss_defeated", False)
-        gs.final_boss_defeated = data.get("final_boss_defeated", False)
-        # Способности и активности
-        gs.abilities = data.get("abilities", gs.abilities)
-        gs.totem_defeated = data.get("totem_defeated", False)
-        gs.trial_active = data.get("trial_active", False)
-        gs.trial_time_left = data.get("trial_time_left", 0.0)
-        gs.trial_stage = data.get("trial_stage", 0)
-        gs.trial_completed = data.get("trial_completed", False)
+        gs.apply_delta(data)
+        gs.clear_dirty()
         return gs
 
+    # Способности
+    def learn_ability(self, key: str) -> bool:
+        ab = self.abilities.get(key)
+        if ab is None or ab.learned:
+            return False
+        ab.learned = True
+        self.touch("abilities")
+        return True
+
+    def tick_cooldowns(self, dt: float):
+        # Кулдауны меняются каждый кадр и не помечают состояние изменённым
+        for ab in self.abilities.values():
+            if ab.cd > 0.0:
+                ab.cd = max(0.0, ab.cd - dt)
+
+    def defeat_enemy(self, enemy_id: str):
+        if enemy_id not in self.defeated_enemies:
+            self.defeated_enemies = self.defeated_enemies + (enemy_id,)
+
     # Прокачка и рогалик
     def grant_xp(self, amount: int):
         self.xp += amount
+        TELEMETRY.emit("xp", amount=amount, level=self.level)
         while self.xp >= self.xp_to_next:
             self.xp -= self.xp_to_next
             self.level += 1
@@ -294,28 +1863,1066 @@ class GameState:
             # Рост характеристик
             self.max_hp += 2
             self.base_atk += 1
+            TELEMETRY.emit("level_up", level=self.level)
 
     def start_new_run(self):
         self.run_number += 1
         # Часть прогресса переносится (уровни, артефакт), сюжет сбрасывается
-        self.honor = 0
-        self.gold = 0
-        self.helped_npc = False
-        self.has_key = False
-        self.beast_defeated = False
-        self.guard_defeated = False
-        self.defeated_enemies = []
-        self.dungeon_fully_cleared = False
-        self.artifact_found = False
-        self.miniboss_defeated = False
-        self.final_boss_defeated = False
-        self.last_location = "overworld"
-        # Сброс активностей; способности остаются выученными между забегами
-        self.totem_defeated = False
-        self.trial_active = False
-        self.trial_time_left = 0.0
-        self.trial_stage = 0
-        self.trial_completed = False
+        defaults = dict(_STATE_FIELDS)
+        for name in _RUN_RESET_FIELDS:
+            setattr(self, name, defaults[name])
+
+
+for _i, (_name, _default) in enumerate(_STATE_FIELDS):
+    setattr(GameState, _name, _Flag(_i) if isinstance(_default, bool) else _Field(_i))
+del _i, _name, _default
+
+
+# Полное сохранение помечается случайным "_save_id", каждая строка журнала — "_base" с тем же
+# id. Биты «грязности» значат «изменено с последнего сохранения этого состояния», поэтому
+# журнал пишется только состоянием, которое само загружено или сохранено в этот файл;
+# новая игра или чужой забег сначала сохраняются полностью. Строки от другой базы
+# (файл перезаписали) при загрузке пропускаются.
+def _delta_path(path: str) -> str:
+    return SAVE_DELTA_PATH if path == SAVE_PATH else path + ".delta"
+
+
+def _read_save_id(path: str) -> str | None:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f).get("_save_id")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def save_game(game_state: GameState, path: str = SAVE_PATH):
+    # Полное сохранение; журнал изменений после него больше не нужен
+    data = game_state.to_dict()
+    data["_save_id"] = os.urandom(8).hex()
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(path + ".tmp", path)
+    if os.path.exists(_delta_path(path)):
+        os.remove(_delta_path(path))
+    game_state.clear_dirty()
+    game_state._save_id = data["_save_id"]
+    game_state._deltas = 0
+    TELEMETRY.emit("save", path=path, delta=False)
+
+
+def save_game_delta(game_state: GameState, path: str = SAVE_PATH) -> bool:
+    # Быстрое сохранение (F5): дописываем в журнал только изменённые поля
+    base = game_state._save_id
+    if base is None or game_state._deltas >= SAVE_DELTA_COMPACT or _read_save_id(path) != base:
+        save_game(game_state, path)
+        return True
+    delta = game_state.to_delta()
+    if not delta:
+        return False
+    delta["_base"] = base
+    with open(_delta_path(path), "a", encoding="utf-8") as f:
+        f.write(json.dumps(delta, ensure_ascii=False) + "\n")
+    game_state.clear_dirty()
+    game_state._deltas += 1
+    TELEMETRY.emit("save", path=path, delta=True)
+    return True
+
+
+def load_game(path: str = SAVE_PATH) -> GameState:
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    gs = GameState.from_dict(data)
+    base = data.get("_save_id")
+    if base is not None and os.path.exists(_delta_path(path)):
+        with open(_delta_path(path), "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                delta = json.loads(line)
+                if delta.get("_base") == base:
+                    gs.apply_delta(delta)
+                    gs._deltas += 1
+        gs.clear_dirty()
+    gs._save_id = base
+    TELEMETRY.emit("load", path=path)
+    return gs
+
+
+# ---------- Призрак забега ----------
+# Лучший пройденный забег на время лежит рядом с сохранением: позиция игрока на каждом
+# фиксированном тике GHOST_TICK_RATE разностью от предыдущей точки (zigzag + varint —
+# шаг в несколько пикселей занимает байт на ось), 20 секунд забега — около килобайта.
+# Запись — пара append в bytearray за тик, воспроизведение — разбор одной точки за тик
+# и линейная интерполяция между соседними точками.
+GHOST_PATH = SAVE_PATH + ".ghost"
+GHOST_TICK_RATE = 30
+GHOST_MAGIC = b"ORGH"
+GHOST_ALPHA = 110
+_GHOST_HEADER = struct.Struct("<4sHhhIf")  # магия, частота, старт x, старт y, тики, время забега
+
+
+def _put_varint(buf: bytearray, value: int):
+    value = value << 1 if value >= 0 else (~value << 1) | 1
+    while value >= 0x80:
+        buf.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def _get_varint(data, pos: int) -> tuple[int, int]:
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            break
+        shift += 7
+    return (value >> 1) ^ -(value & 1), pos
+
+
+class GhostTrack:
+    __slots__ = ("start", "ticks", "time", "tick_rate", "data")
+
+    def __init__(self, start: tuple[int, int], ticks: int, time_used: float, data: bytes, tick_rate: int = GHOST_TICK_RATE):
+        self.start = start
+        self.ticks = ticks
+        self.time = time_used
+        self.tick_rate = tick_rate
+        self.data = data
+
+    def to_bytes(self) -> bytes:
+        return _GHOST_HEADER.pack(GHOST_MAGIC, self.tick_rate, self.start[0], self.start[1], self.ticks, self.time) + self.data
+
+    @classmethod
+    def from_bytes(cls, raw: bytes) -> "GhostTrack":
+        magic, tick_rate, x, y, ticks, time_used = _GHOST_HEADER.unpack_from(raw)
+        if magic != GHOST_MAGIC:
+            raise ValueError("not a ghost file")
+        return cls((x, y), ticks, time_used, bytes(raw[_GHOST_HEADER.size:]), tick_rate)
+
+
+class GhostRecorder:
+    def __init__(self, start: tuple[int, int], tick_rate: int = GHOST_TICK_RATE):
+        self.start = start
+        self.tick_rate = tick_rate
+        self.interval = 1.0 / tick_rate
+        self.last = start
+        self.ticks = 0
+        self.accum = 0.0
+        self.data = bytearray()
+
+    def tick(self, dt: float, pos: tuple[int, int]):
+        self.accum += dt
+        while self.accum >= self.interval:
+            self.accum -= self.interval
+            _put_varint(self.data, pos[0] - self.last[0])
+            _put_varint(self.data, pos[1] - self.last[1])
+            self.last = pos
+            self.ticks += 1
+
+    def track(self, time_used: float) -> GhostTrack:
+        return GhostTrack(self.start, self.ticks, time_used, bytes(self.data), self.tick_rate)
+
+
+class GhostPlayer:
+    def __init__(self, track: GhostTrack):
+        self.track = track
+        self.interval = 1.0 / track.tick_rate
+        self.prev = self.next = track.start
+        self.pos = 0
+        self.tick = 0
+        self.accum = 0.0
+
+    @property
+    def finished(self) -> bool:
+        return self.tick >= self.track.ticks
+
+    def advance(self, dt: float):
+        self.accum += dt
+        data = self.track.data
+        while self.accum >= self.interval and not self.finished:
+            self.accum -= self.interval
+            dx, self.pos = _get_varint(data, self.pos)
+            dy, self.pos = _get_varint(data, self.pos)
+            self.prev = self.next
+            self.next = (self.next[0] + dx, self.next[1] + dy)
+            self.tick += 1
+
+    def position(self) -> tuple[int, int]:
+        if self.finished:
+            return self.next
+        t = self.accum / self.interval
+        return (round(self.prev[0] + (self.next[0] - self.prev[0]) * t),
+                round(self.prev[1] + (self.next[1] - self.prev[1]) * t))
+
+
+_GHOST_BEST: dict[str, GhostTrack | None] = {}
+
+
+def load_ghost(path: str = GHOST_PATH) -> GhostTrack | None:
+    # Файл читается один раз за процесс, дальше — из кэша
+    if path not in _GHOST_BEST:
+        try:
+            with open(path, "rb") as f:
+                _GHOST_BEST[path] = GhostTrack.from_bytes(f.read())
+        except (OSError, ValueError, struct.error):
+            _GHOST_BEST[path] = None
+    return _GHOST_BEST[path]
+
+
+def save_ghost(track: GhostTrack, path: str = GHOST_PATH) -> bool:
+    # Сохраняем, только если забег быстрее лучшего
+    best = load_ghost(path)
+    if best is not None and best.time <= track.time:
+        return False
+    with open(path + ".tmp", "wb") as f:
+        f.write(track.to_bytes())
+    os.replace(path + ".tmp", path)
+    _GHOST_BEST[path] = track
+    return True
+
+
+# ---------- Перемотка ----------
+# Кольцо последних REWIND_CAPACITY точек состояния: снимок берётся при каждой смене сцены
+# и в начале каждого хода боя. Точка — битовые флаги и кортеж значений полей; контейнеры
+# (квесты, туман, способности) замораживаются в кортежи и, если не изменились с прошлой
+# точки, разделяются с ней (тот же объект), defeated_enemies и так неизменяемый кортеж.
+# Точка без изменений не добавляется, так что память растёт с изменениями, а не с числом
+# снимков. Перемотка восстанавливает GameState на месте: сцены держат ссылку на него.
+REWIND_CAPACITY = 64
+_QUESTS_INDEX = _FIELD_INDEX["quests"]
+_EXPLORED_INDEX = _FIELD_INDEX["explored"]
+_ABILITIES_INDEX = _FIELD_INDEX["abilities"]
+
+
+class RewindPoint:
+    __slots__ = ("flags", "values", "label", "extra")
+
+    def __init__(self, flags: int, values: tuple, label: str, extra=None):
+        self.flags = flags
+        self.values = values
+        self.label = label
+        # Состояние самой сцены (например, HP в бою), если сцена его отдаёт
+        self.extra = extra
+
+
+def _freeze_containers(values: list, prev: tuple | None):
+    frozen = (
+        (_QUESTS_INDEX, tuple(sorted(values[_QUESTS_INDEX].items()))),
+        (_EXPLORED_INDEX, tuple(sorted(values[_EXPLORED_INDEX].items()))),
+        (_ABILITIES_INDEX, tuple((key, ab.learned, ab.cd) for key, ab in values[_ABILITIES_INDEX].items())),
+    )
+    for index, value in frozen:
+        if prev is not None and prev[index] == value:
+            value = prev[index]  # без изменений — разделяем с прошлой точкой
+        values[index] = value
+
+
+class RewindBuffer:
+    def __init__(self, capacity: int = REWIND_CAPACITY):
+        self.points: collections.deque[RewindPoint] = collections.deque(maxlen=capacity)
+        self._owner = None
+
+    def __len__(self) -> int:
+        return len(self.points)
+
+    def capture(self, gs: GameState, label: str, extra=None) -> bool:
+        if self._owner is None or self._owner() is not gs:
+            # Новая игра или загрузка — старая история к этому состоянию не относится
+            self.points.clear()
+            self._owner = weakref.ref(gs)
+        prev = self.points[-1] if self.points else None
+        values = list(gs._values)
+        _freeze_containers(values, prev.values if prev is not None else None)
+        values = tuple(values)
+        if prev is not None and prev.flags == gs._flags and prev.extra == extra:
+            if prev.values == values:
+                return False
+        self.points.append(RewindPoint(gs._flags, values, label, extra))
+        return True
+
+    def rewind(self, gs: GameState, steps: int = 1) -> RewindPoint | None:
+        # steps=1 — последняя точка; более поздние точки отбрасываются
+        if self._owner is None or self._owner() is not gs or not 0 < steps <= len(self.points):
+            return None
+        for _ in range(steps - 1):
+            self.points.pop()
+        point = self.points[-1]
+        self.restore(gs, point)
+        return point
+
+    def rewind_to(self, gs: GameState, label: str) -> RewindPoint | None:
+        for steps, point in enumerate(reversed(self.points), 1):
+            if point.label == label:
+                return self.rewind(gs, steps)
+        return None
+
+    @staticmethod
+    def restore(gs: GameState, point: RewindPoint):
+        values = list(point.values)
+        values[_QUESTS_INDEX] = dict(values[_QUESTS_INDEX])
+        values[_EXPLORED_INDEX] = dict(values[_EXPLORED_INDEX])
+        # Объекты способностей обновляем на месте: на них могут ссылаться сцены
+        abilities = gs._values[_ABILITIES_INDEX]
+        for key, learned, cd in values[_ABILITIES_INDEX]:
+            abilities[key].learned = learned
+            abilities[key].cd = cd
+        values[_ABILITIES_INDEX] = abilities
+        changed = point.flags ^ gs._flags
+        for i, (old, new) in enumerate(zip(gs._values, values)):
+            if old is not new and old != new:
+                changed |= 1 << i
+        gs._flags = point.flags
+        gs._values = values
+        gs._dirty |= changed | 1 << _ABILITIES_INDEX
+        gs._version += 1
+        gs._snapshot = None
+        TELEMETRY.emit("rewind", label=point.label)
+
+
+# ---------- Правила: флаги квестов, подсказки, концовки ----------
+class Rule:
+    # Предикат над GameState с явным списком полей, от которых он зависит
+    __slots__ = ("deps", "predicate", "payload", "mask")
+
+    def __init__(self, deps: tuple[str, ...], predicate, payload=None):
+        self.deps = deps
+        self.predicate = predicate
+        self.payload = payload
+        self.mask = 0
+        for name in deps:
+            self.mask |= 1 << _FIELD_INDEX[name]
+
+
+class _RuleCache:
+    __slots__ = ("version", "flags", "values", "results", "matched", "pairs")
+
+    def __init__(self, gs: GameState, results: list[bool], rules: tuple[Rule, ...]):
+        self.store(gs, results, rules)
+
+    def store(self, gs: GameState, results: list[bool], rules: tuple[Rule, ...]):
+        self.version = gs.version
+        self.flags = gs._flags
+        self.values = list(gs._values)
+        self.results = tuple(results)
+        self.matched = tuple(rule.payload for rule, ok in zip(rules, self.results) if ok)
+        self.pairs = tuple((rule.payload, ok) for rule, ok in zip(rules, self.results))
+
+
+class RuleSet:
+    # Правила компилируются один раз: для каждого поля — список зависящих от него правил.
+    # При запросе пересчитываются только правила, чьи поля изменились с прошлого вызова.
+    def __init__(self, rules: list[Rule]):
+        self.rules = tuple(rules)
+        self.mask = 0
+        by_field: dict[int, list[int]] = {}
+        for j, rule in enumerate(self.rules):
+            self.mask |= rule.mask
+            for name in rule.deps:
+                by_field.setdefault(_FIELD_INDEX[name], []).append(j)
+        self._by_field = {i: tuple(js) for i, js in by_field.items()}
+        self._value_fields = tuple(i for i in self._by_field if not isinstance(_STATE_FIELDS[i][1], bool))
+        self._caches: "weakref.WeakKeyDictionary[GameState, _RuleCache]" = weakref.WeakKeyDictionary()
+
+    def _refresh(self, gs: GameState) -> _RuleCache:
+        cache = self._caches.get(gs)
+        if cache is None:
+            cache = _RuleCache(gs, [rule.predicate(gs) for rule in self.rules], self.rules)
+            self._caches[gs] = cache
+            return cache
+        if cache.version == gs.version:
+            return cache
+        changed = (gs._flags ^ cache.flags) & self.mask
+        for i in self._value_fields:
+            old, new = cache.values[i], gs._values[i]
+            if old is not new and old != new:
+                changed |= 1 << i
+        if not changed:
+            cache.version = gs.version
+            cache.values = list(gs._values)
+            return cache
+        stale: set[int] = set()
+        for i, js in self._by_field.items():
+            if changed >> i & 1:
+                stale.update(js)
+        results = list(cache.results)
+        for j in stale:
+            results[j] = bool(self.rules[j].predicate(gs))
+        cache.store(gs, results, self.rules)
+        return cache
+
+    def results(self, gs: GameState) -> tuple[bool, ...]:
+        return self._refresh(gs).results
+
+    def matched(self, gs: GameState) -> tuple:
+        return self._refresh(gs).matched
+
+    def pairs(self, gs: GameState) -> tuple:
+        return self._refresh(gs).pairs
+
+
+QUEST_FLAGS = RuleSet([
+    Rule(("beast_defeated",), lambda gs: gs.beast_defeated, "Зверь изгнан"),
+    Rule(("has_key",), lambda gs: gs.has_key, "Есть ключ"),
+    Rule(("has_sword",), lambda gs: gs.has_sword, "Меч куплен"),
+    Rule(("artifact_found",), lambda gs: gs.artifact_found, "Артефакт найден"),
+    Rule(("companion_joined",), lambda gs: gs.companion_joined, "Спутник присоединился"),
+    Rule(("dungeon_fully_cleared",), lambda gs: gs.dungeon_fully_cleared, "Подземелье зачищено"),
+    Rule(("miniboss_defeated",), lambda gs: gs.miniboss_defeated, "Мини-босс побеждён"),
+    Rule(("final_boss_defeated",), lambda gs: gs.final_boss_defeated, "Финальный босс побеждён"),
+    Rule(("totem_defeated",), lambda gs: gs.totem_defeated, "Испытание тотема"),
+    Rule(("trial_completed",), lambda gs: gs.trial_completed, "Забег на время выполнен"),
+])
+
+QUEST_HINTS = RuleSet([
+    Rule(("beast_defeated",), lambda gs: not gs.beast_defeated,
+         "Подойдите к северным воротам и пройдите скилл-чек (SPACE) против зверя."),
+    Rule(("beast_defeated", "has_key"), lambda gs: gs.beast_defeated and not gs.has_key,
+         "Около двери осмотритесь и найдите ключ (E), либо поговорите с вором."),
+    Rule(("has_key", "dungeon_fully_cleared"), lambda gs: gs.has_key and not gs.dungeon_fully_cleared,
+         "Войдите в подземелье. Победите Стража и двух Часовых (E у них)."),
+    Rule(("dungeon_fully_cleared", "artifact_found"), lambda gs: gs.dungeon_fully_cleared and not gs.artifact_found,
+         "Откройте сундук в подземелье, чтобы взять артефакт (E у сундука)."),
+    Rule(("artifact_found", "miniboss_defeated"), lambda gs: gs.artifact_found and not gs.miniboss_defeated,
+         "После взятия артефакта найдите у выхода мини-босса Лейтенанта и победите его."),
+    Rule(("miniboss_defeated", "final_boss_defeated"), lambda gs: gs.miniboss_defeated and not gs.final_boss_defeated,
+         "Усилите героя: купите меч, соберите травы у Травника для зелий/спутника, повышайте уровень в боях."),
+    Rule(("totem_defeated",), lambda gs: not gs.totem_defeated,
+         "В городе найдите Тотем испытаний и победите его для награды."),
+    Rule(("trial_completed",), lambda gs: not gs.trial_completed,
+         "На полях попробуйте забег на время. Начало — у первой контрольной точки."),
+    Rule(("companion_joined",), lambda gs: not gs.companion_joined,
+         "На полях соберите 3 травы и попросите Травника присоединиться (E)."),
+    Rule(("artifact_found", "honor"), lambda gs: gs.artifact_found and gs.honor < 2,
+         "Поднимите честь (помогите путнику бескорыстно), это влияет на лучшие концовки."),
+])
+_DEFAULT_HINTS = ("Исследуйте мир, начните новый забег (N) для увеличения сложности и прогресса.",)
+
+# Концовки по приоритету: срабатывает первая подходящая. Текст может зависеть от состояния.
+ENDINGS = RuleSet([
+    Rule(("beast_defeated",), lambda gs: not gs.beast_defeated,
+         ("Зверь остался бродить по окраинам...\nГорожане в страхе.", RED)),
+    Rule(("artifact_found", "honor", "companion_joined", "dungeon_fully_cleared"),
+         lambda gs: gs.artifact_found and gs.honor >= 2 and gs.companion_joined and gs.dungeon_fully_cleared,
+         ("С артефактом, доброй славой и поддержкой спутника\n"
+          "город расцвёл. Вы — наставник и защитник.", YELLOW)),
+    Rule(("artifact_found", "honor", "dungeon_fully_cleared"),
+         lambda gs: gs.artifact_found and gs.honor >= 2 and gs.dungeon_fully_cleared,
+         ("С артефактом и доброй славой вы возродили город.\n"
+          "Имя ваше войдёт в летописи.", YELLOW)),
+    Rule(("final_boss_defeated", "run_number"), lambda gs: gs.final_boss_defeated and gs.run_number >= 1,
+         (lambda gs: "Вы сокрушили Владыку Теней, завершив забег №" + str(gs.run_number) + ".\n"
+                     "Город свободен, но новые угрозы ждут в следующих забегах...", YELLOW)),
+    Rule(("artifact_found", "dungeon_fully_cleared"), lambda gs: gs.artifact_found and not gs.dungeon_fully_cleared,
+         ("Вы нашли артефакт, не победив всех стражей...\n"
+          "Сила его нестабильна, и город в опасности.", RED)),
+    Rule(("honor", "gold", "has_sword"), lambda gs: gs.honor >= 1 and gs.gold >= 5 and gs.has_sword,
+         ("Вы помогли путнику и получили плату.\n"
+          "Город спасён, а меч стал символом защиты.", GREEN)),
+    Rule(("has_key", "artifact_found"), lambda gs: gs.has_key and gs.artifact_found,
+         ("Вы нашли артефакт, но ваши поступки двусмысленны...\n"
+          "Горожане сомневаются, кому он служит.", BLUE)),
+    Rule((), lambda gs: True,
+         ("Вы изгнали зверя, но прошли мимо возможностей...\n"
+          "Иногда выбор важнее битвы.", LIGHT_GRAY)),
+])
+
+
+def quest_flag_status(gs: GameState) -> tuple[tuple[str, bool], ...]:
+    return QUEST_FLAGS.pairs(gs)
+
+
+def current_hints(gs: GameState) -> tuple[str, ...]:
+    return QUEST_HINTS.matched(gs) or _DEFAULT_HINTS
+
+
+def reachable_endings(gs: GameState) -> tuple:
+    # Концовки, условия которых выполнены сейчас, в порядке приоритета
+    return ENDINGS.matched(gs)
+
+
+def current_ending(gs: GameState) -> tuple[str, tuple[int, int, int]]:
+    text, color = reachable_endings(gs)[0]
+    return (text(gs) if callable(text) else text), color
+
+
+# ---------- История забегов ----------
+# Каждый завершённый забег (новый забег по N) пишется в SQLite. Запись идёт в фоновом потоке
+# пачками, одной транзакцией на пачку; там же после записи пересчитывается сводка для
+# лидербордов, а сцены читают готовую сводку из атрибута — на главном потоке запросов нет.
+RUN_DB_PATH = "runs.sqlite3"
+RUN_DB_BATCH = 256
+RUN_LEADERBOARD_SIZE = 5
+TRIAL_DURATION = 20.0
+
+_RUN_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS runs (
+        id INTEGER PRIMARY KEY,
+        finished_at REAL NOT NULL,
+        run_number INTEGER NOT NULL,
+        ending TEXT NOT NULL,
+        level INTEGER NOT NULL,
+        gold INTEGER NOT NULL,
+        trial_time REAL,
+        enemies_defeated INTEGER NOT NULL,
+        enemies TEXT NOT NULL,
+        duration REAL
+    )""",
+    # Лидерборды читают только начало индекса, сколько бы забегов ни накопилось
+    "CREATE INDEX IF NOT EXISTS runs_by_trial ON runs (trial_time) WHERE trial_time IS NOT NULL",
+    "CREATE INDEX IF NOT EXISTS runs_by_run_number ON runs (run_number DESC, level DESC)",
+)
+_RUN_INSERT = ("INSERT INTO runs (finished_at, run_number, ending, level, gold, trial_time, enemies_defeated, enemies, duration) "
+               "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)")
+
+
+class RunHistory:
+    def __init__(self, path: str = RUN_DB_PATH, batch: int = RUN_DB_BATCH):
+        self.path = path
+        self.batch = batch
+        self.enabled = False
+        self.written = 0
+        # Сводка заменяется целиком (одно присваивание), поэтому читать её можно без блокировок
+        self.summary: dict = {"runs": 0, "best_trials": (), "top_runs": ()}
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread: threading.Thread | None = None
+        self._started_at: "weakref.WeakKeyDictionary[GameState, float]" = weakref.WeakKeyDictionary()
+        self._atexit = False
+
+    def start(self):
+        if self.enabled:
+            return
+        self.enabled = True
+        self._thread = threading.Thread(target=self._run, name="run-history", daemon=True)
+        self._thread.start()
+        if not self._atexit:
+            atexit.register(self.stop)
+            self._atexit = True
+
+    def stop(self):
+        if not self.enabled:
+            return
+        self.enabled = False
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def track(self, gs: GameState):
+        # Запомнить начало забега для длительности (повторные вызовы не сбрасывают время)
+        self._started_at.setdefault(gs, time.time())
+
+    def record(self, gs: GameState):
+        if not self.enabled:
+            return
+        now = time.time()
+        started = self._started_at.get(gs)
+        self._started_at[gs] = now
+        enemies = gs.defeated_enemies
+        self._queue.put((
+            now, gs.run_number, current_ending(gs)[0].split("\n")[0], gs.level, gs.gold,
+            round(TRIAL_DURATION - gs.trial_time_left, 2) if gs.trial_completed else None,
+            len(enemies), ",".join(enemies), now - started if started is not None else None,
+        ))
+
+    def _summarize(self, conn: sqlite3.Connection, runs: int) -> dict:
+        best = conn.execute("SELECT trial_time, run_number, finished_at FROM runs WHERE trial_time IS NOT NULL "
+                            "ORDER BY trial_time LIMIT ?", (RUN_LEADERBOARD_SIZE,)).fetchall()
+        top = conn.execute("SELECT run_number, level, ending FROM runs ORDER BY run_number DESC, level DESC LIMIT ?",
+                           (RUN_LEADERBOARD_SIZE,)).fetchall()
+        return {"runs": runs, "best_trials": tuple(best), "top_runs": tuple(top)}
+
+    def _run(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        for statement in _RUN_SCHEMA:
+            conn.execute(statement)
+        runs = conn.execute("SELECT COUNT(*) FROM runs").fetchone()[0]
+        self.summary = self._summarize(conn, runs)
+        stopping = False
+        while not stopping:
+            # Ждём первую запись, затем забираем всё накопившееся до размера пачки
+            rows = []
+            item = self._queue.get()
+            while True:
+                if item is None:
+                    stopping = True
+                    break
+                rows.append(item)
+                if len(rows) >= self.batch:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            if rows:
+                with conn:
+                    conn.executemany(_RUN_INSERT, rows)
+                runs += len(rows)
+                self.written += len(rows)
+                self.summary = self._summarize(conn, runs)
+        conn.close()
+
+
+RUN_HISTORY = RunHistory()
+
+
+def format_run_records(summary: dict) -> list[str]:
+    if not summary["runs"]:
+        return []
+    lines = [f"Забегов в истории: {summary['runs']}"]
+    if summary["best_trials"]:
+        lines.append("Забег на время: " + ", ".join(f"{t:.1f} с" for t, _, _ in summary["best_trials"][:3]))
+    if summary["top_runs"]:
+        run_number, level, _ = summary["top_runs"][0]
+        lines.append(f"Дальше всех: забег №{run_number}, уровень {level}")
+    return lines
+
+
+# ---------- Диалоги ----------
+# Деревья диалогов лежат в data/dialogue/<имя>.json и компилируются при первом обращении:
+# условия и эффекты превращаются в замыкания, узлы ищутся по id за O(1).
+DIALOGUE_DIR = os.path.join(DATA_DIR, "dialogue")
+
+
+class DialogueChoice:
+    __slots__ = ("label", "visible", "action")
+
+    def __init__(self, label: str, visible, action):
+        self.label = label
+        self.visible = visible  # visible(gs) -> bool или None
+        # action(gs, scene[, roll]) -> id следующего узла или None; roll() — бросок для "chance"
+        self.action = action
+
+
+class DialogueNode:
+    __slots__ = ("node_id", "text", "choices", "layout")
+
+    def __init__(self, node_id: str, text: str, choices: list[DialogueChoice]):
+        self.node_id = node_id
+        self.text = text
+        self.choices = choices
+        self.layout: "DialogueLayout | None" = None
+
+
+def _check_field(name: str) -> str:
+    if name not in _FIELD_INDEX:
+        raise ValueError(f"Неизвестное поле состояния в диалоге: {name}")
+    return name
+
+
+def _compile_condition(cond: dict):
+    if "flag" in cond:
+        name = _check_field(cond["flag"])
+        return lambda gs, roll: bool(getattr(gs, name))
+    if "not" in cond:
+        name = _check_field(cond["not"])
+        return lambda gs, roll: not getattr(gs, name)
+    if "gte" in cond:
+        name, value = cond["gte"]
+        _check_field(name)
+        return lambda gs, roll: getattr(gs, name) >= value
+    if "lt" in cond:
+        name, value = cond["lt"]
+        _check_field(name)
+        return lambda gs, roll: getattr(gs, name) < value
+    if "chance" in cond:
+        p = float(cond["chance"])
+        return lambda gs, roll: roll() < p
+    if "learnable" in cond:
+        key = cond["learnable"]
+        return lambda gs, roll: not gs.abilities[key].learned
+    raise ValueError(f"Неизвестное условие в диалоге: {cond}")
+
+
+def _compile_conditions(conds: list[dict]):
+    # Бросок для "chance" передаётся явно: игра берёт random.random, исследователь — заданный исход
+    checks = tuple(_compile_condition(c) for c in conds)
+    if not checks:
+        return None
+
+    def test(gs, roll=random.random):
+        for check in checks:
+            if not check(gs, roll):
+                return False
+        return True
+    return test
+
+
+def _compile_effect(effect: dict):
+    # Эффект: (gs, scene) -> id следующего узла или None
+    if "set" in effect:
+        name, value = effect["set"]
+        _check_field(name)
+        return lambda gs, scene: setattr(gs, name, value)
+    if "add" in effect:
+        name, delta = effect["add"]
+        _check_field(name)
+        low = effect.get("min")
+        if low is None:
+            return lambda gs, scene: setattr(gs, name, getattr(gs, name) + delta)
+        return lambda gs, scene: setattr(gs, name, max(low, getattr(gs, name) + delta))
+    if "learn" in effect:
+        key = effect["learn"]
+
+        def learn(gs, scene):
+            gs.learn_ability(key)
+        return learn
+    if "message" in effect:
+        text, seconds = effect["message"], float(effect.get("time", 2.0))
+
+        def show(gs, scene):
+            scene.message = text
+            scene.message_timer = seconds
+        return show
+    if "goto" in effect:
+        target = effect["goto"]
+        return lambda gs, scene: target
+    raise ValueError(f"Неизвестный эффект в диалоге: {effect}")
+
+
+def _compile_effects(effects: list[dict]):
+    steps = tuple(_compile_effect(e) for e in effects)
+
+    def run(gs, scene):
+        next_node = None
+        for step in steps:
+            result = step(gs, scene)
+            if isinstance(result, str):
+                next_node = result
+        return next_node
+    return run
+
+
+def _compile_choice(data: dict) -> DialogueChoice:
+    condition = _compile_conditions(data.get("if", []))
+    on_true = _compile_effects(data.get("do", []))
+    on_false = _compile_effects(data.get("else", []))
+    if condition is None:
+        def action(gs, scene, roll=random.random):
+            return on_true(gs, scene)
+    else:
+        def action(gs, scene, roll=random.random):
+            return on_true(gs, scene) if condition(gs, roll) else on_false(gs, scene)
+    return DialogueChoice(data["label"], _compile_conditions(data.get("show_if", [])), action)
+
+
+class Conversation:
+    def __init__(self, name: str, start: str, nodes: dict[str, DialogueNode]):
+        self.name = name
+        self.start = start
+        self.nodes = nodes
+        if start not in nodes:
+            raise ValueError(f"Диалог {name}: нет стартового узла {start}")
+
+
+_CONVERSATIONS: dict[str, Conversation] = {}
+
+
+def load_conversation(name: str) -> Conversation:
+    # Ленивая загрузка: файл читается и компилируется один раз на разговор
+    conv = _CONVERSATIONS.get(name)
+    if conv is not None:
+        return conv
+    with open(os.path.join(DIALOGUE_DIR, name + ".json"), "r", encoding="utf-8") as f:
+        data = json.load(f)
+    conv = _CONVERSATIONS[name] = compile_conversation(name, data)
+    return conv
+
+
+def compile_conversation(name: str, data: dict) -> Conversation:
+    nodes = {
+        node_id: DialogueNode(node_id, node["text"], [_compile_choice(c) for c in node.get("choices", [])])
+        for node_id, node in data["nodes"].items()
+    }
+    # Переход в несуществующий узел иначе всплыл бы KeyError посреди разговора
+    for node_id, node in data["nodes"].items():
+        for choice in node.get("choices", []):
+            for effect in choice.get("do", []) + choice.get("else", []):
+                if "goto" in effect and effect["goto"] not in nodes:
+                    raise ValueError(f"Диалог {name}: узел {node_id}, вариант «{choice['label']}» "
+                                     f"ведёт в несуществующий узел {effect['goto']}")
+    return Conversation(name, data.get("start", "start"), nodes)
+
+
+class DialogueLayout:
+    # Заранее отрисованный текст узла: строки с переносом и подписи вариантов в двух цветах
+    def __init__(self, text: str):
+        font = load_font(24)
+        self.lines: list[pygame.Surface] = []
+        for line in wrap_text(text, font, WIDTH - 120):
+            self.lines.append(font.render(line, True, WHITE))
+        self.line_step = (self.lines[0].get_height() + 4) if self.lines else 0
+        self.labels: dict[str, tuple[pygame.Surface, pygame.Surface]] = {}
+
+    def label(self, label: str, selected: bool) -> pygame.Surface:
+        pair = self.labels.get(label)
+        if pair is None:
+            font = load_font(28)
+            pair = (font.render(label, True, LIGHT_GRAY), font.render(label, True, BLUE))
+            self.labels[label] = pair
+        return pair[1] if selected else pair[0]
+
+
+# ---------- Мини-карта ----------
+# Статика (фон, стены, неподвижные объекты) рисуется один раз на локацию в кэшированную
+# поверхность; за кадр поверх неё накладываются туман и только подвижные метки.
+# Туман войны — битовая маска клеток в GameState.explored, открывается по мере движения.
+MINIMAP_SIZE = (180, 100)
+MINIMAP_POS = (WIDTH - MINIMAP_SIZE[0] - 16, 30)
+FOG_CELL = 40
+FOG_RADIUS = 3
+FOG_COLS = (WIDTH + FOG_CELL - 1) // FOG_CELL
+FOG_ROWS = (HEIGHT + FOG_CELL - 1) // FOG_CELL
+
+_MINIMAP_STATIC: dict[str, pygame.Surface] = {}
+_FOG_REVEAL_MASKS: dict[int, int] = {}
+
+
+def fog_reveal_mask(cell: int) -> int:
+    # Маска клеток в радиусе FOG_RADIUS вокруг клетки; считается один раз на клетку
+    mask = _FOG_REVEAL_MASKS.get(cell)
+    if mask is None:
+        cx, cy = cell % FOG_COLS, cell // FOG_COLS
+        mask = 0
+        for y in range(max(0, cy - FOG_RADIUS), min(FOG_ROWS, cy + FOG_RADIUS + 1)):
+            for x in range(max(0, cx - FOG_RADIUS), min(FOG_COLS, cx + FOG_RADIUS + 1)):
+                if (x - cx) ** 2 + (y - cy) ** 2 <= FOG_RADIUS ** 2:
+                    mask |= 1 << (y * FOG_COLS + x)
+        _FOG_REVEAL_MASKS[cell] = mask
+    return mask
+
+
+class Minimap:
+    def __init__(self, location: str, game_state: GameState, walls: list[pygame.Rect], static_markers: list[tuple[pygame.Rect, tuple]], wall_color=(70, 70, 90)):
+        self.location = location
+        self.game_state = game_state
+        mw, mh = MINIMAP_SIZE
+        self.scale_x = mw / WIDTH
+        self.scale_y = mh / HEIGHT
+        self.static = _MINIMAP_STATIC.get(location)
+        if self.static is None:
+            self.static = self._render_static(walls, static_markers, wall_color)
+            _MINIMAP_STATIC[location] = self.static
+        self.fog = pygame.Surface((mw, mh), pygame.SRCALPHA)
+        self.fog.fill((10, 10, 12, 255))
+        self.explored = 0
+        self.cell = -1
+        self._marker = pygame.Rect(0, 0, 4, 4)
+        self._clear_cells(game_state.explored.get(location, 0))
+
+    def _render_static(self, walls, static_markers, wall_color) -> pygame.Surface:
+        mw, mh = MINIMAP_SIZE
+        surf = pygame.Surface((mw + 8, mh + 8))
+        surf.fill((0, 0, 0))
+        pygame.draw.rect(surf, (30, 30, 30), (4, 4, mw, mh))
+        for wall in walls:
+            r = pygame.Rect(4 + int(wall.left * self.scale_x), 4 + int(wall.top * self.scale_y), int(wall.width * self.scale_x), int(wall.height * self.scale_y))
+            pygame.draw.rect(surf, wall_color, r)
+        for obj, color in static_markers:
+            r = pygame.Rect(4 + int(obj.centerx * self.scale_x) - 2, 4 + int(obj.centery * self.scale_y) - 2, 4, 4)
+            pygame.draw.rect(surf, color, r)
+        return surf
+
+    def _clear_cells(self, mask: int):
+        # Снять туман с клеток маски, которые ещё не открыты
+        new = mask & ~self.explored
+        if not new:
+            return
+        self.explored |= new
+        i = 0
+        while new:
+            if new & 1:
+                cx, cy = i % FOG_COLS, i // FOG_COLS
+                x0 = int(cx * FOG_CELL * self.scale_x)
+                y0 = int(cy * FOG_CELL * self.scale_y)
+                x1 = int((cx + 1) * FOG_CELL * self.scale_x)
+                y1 = int((cy + 1) * FOG_CELL * self.scale_y)
+                self.fog.fill((0, 0, 0, 0), (x0, y0, x1 - x0, y1 - y0))
+            new >>= 1
+            i += 1
+        mark_surface_changed(self.fog)
+
+    def reveal(self, pos: tuple[int, int]):
+        # Вызывается каждый кадр; работа есть только при входе в новую клетку
+        x = min(max(pos[0], 0), WIDTH - 1)
+        y = min(max(pos[1], 0), HEIGHT - 1)
+        cell = (y // FOG_CELL) * FOG_COLS + x // FOG_CELL
+        if cell == self.cell:
+            return
+        self.cell = cell
+        mask = fog_reveal_mask(cell)
+        if mask & ~self.explored:
+            self._clear_cells(mask)
+            explored = dict(self.game_state.explored)
+            explored[self.location] = self.explored
+            self.game_state.explored = explored
+
+    def draw(self, screen: pygame.Surface, markers, player: pygame.Rect):
+        mx, my = MINIMAP_POS
+        screen.blit(self.static, (mx - 4, my - 4))
+        screen.blit(self.fog, (mx, my))
+        r = self._marker
+        for obj, color in markers:
+            r.topleft = (mx + int(obj.centerx * self.scale_x) - 2, my + int(obj.centery * self.scale_y) - 2)
+            draw_rect(screen, color, r)
+        r.topleft = (mx + int(player.centerx * self.scale_x) - 2, my + int(player.centery * self.scale_y) - 2)
+        draw_rect(screen, (80, 220, 80), r)
+
+
+# ---------- Освещение подземелья ----------
+# Свет считается на грубой сетке LIGHT_CELL: статические источники (факелы, сундук, выход)
+# запекаются один раз с тенями от стен, свет игрока с полем зрения пересчитывается только
+# при переходе игрока в другую клетку. Итог растягивается до экрана и накладывается одним
+# умножающим блитом. Без NumPy освещение отключено.
+LIGHT_CELL = 10
+LIGHT_COLS = WIDTH // LIGHT_CELL
+LIGHT_ROWS = HEIGHT // LIGHT_CELL
+
+_LIGHT_BAKES: dict[str, pygame.Surface] = {}
+
+
+class DungeonLighting:
+    def __init__(self, location: str, walls: list[pygame.Rect], lights: list[tuple[tuple[int, int], int, tuple]], player_radius: int = 180, player_color=(255, 236, 200), ambient=(60, 54, 72)):
+        self.enabled = np is not None
+        if not self.enabled:
+            return
+        self.opaque = np.zeros((LIGHT_COLS, LIGHT_ROWS), bool)
+        for wall in walls:
+            x0, y0 = wall.left // LIGHT_CELL, wall.top // LIGHT_CELL
+            x1, y1 = -(-wall.right // LIGHT_CELL), -(-wall.bottom // LIGHT_CELL)
+            self.opaque[max(0, x0):x1, max(0, y0):y1] = True
+        self.static = _LIGHT_BAKES.get(location)
+        if self.static is None:
+            light = np.zeros((LIGHT_COLS, LIGHT_ROWS, 3), np.float32)
+            light[:] = np.array(ambient, np.float32) / 255.0
+            for pos, radius, color in lights:
+                window, intensity = self._visibility(pos, radius)
+                light[window] += intensity[:, :, None] * (np.array(color, np.float32) / 255.0)
+            small = pygame.Surface((LIGHT_COLS, LIGHT_ROWS))
+            pygame.surfarray.blit_array(small, (np.clip(light, 0.0, 1.0) * 255.0).astype(np.uint8))
+            self.static = pygame.transform.smoothscale(small, (WIDTH, HEIGHT))
+            _LIGHT_BAKES[location] = self.static
+        self.player_radius = player_radius
+        self.player_color = np.array(player_color, np.float32)
+        self.full: pygame.Surface | None = None
+        self.cell: tuple[int, int] | None = None
+
+    def _visibility(self, pos: tuple[int, int], radius: int):
+        # Окно сетки вокруг источника и интенсивность в нём (0 в тени стен)
+        cx = min(max(pos[0], 0), WIDTH - 1) / LIGHT_CELL
+        cy = min(max(pos[1], 0), HEIGHT - 1) / LIGHT_CELL
+        r = radius / LIGHT_CELL
+        x0, x1 = max(0, int(cx - r)), min(LIGHT_COLS, int(cx + r) + 1)
+        y0, y1 = max(0, int(cy - r)), min(LIGHT_ROWS, int(cy + r) + 1)
+        gx, gy = np.mgrid[x0:x1, y0:y1].astype(np.float32)
+        gx += 0.5
+        gy += 0.5
+        dx, dy = gx - cx, gy - cy
+        dist = np.sqrt(dx * dx + dy * dy)
+        # Лучи от источника к центру клетки: клетка видна, если по пути нет стены
+        steps = max(2, int(r * 1.5))
+        t = np.linspace(0.0, 1.0, steps, endpoint=False, dtype=np.float32)[:, None, None]
+        sx = np.clip((cx + dx * t).astype(np.intp), 0, LIGHT_COLS - 1)
+        sy = np.clip((cy + dy * t).astype(np.intp), 0, LIGHT_ROWS - 1)
+        visible = ~self.opaque[sx, sy].any(axis=0)
+        falloff = np.clip(1.0 - dist / r, 0.0, 1.0)
+        return (slice(x0, x1), slice(y0, y1)), falloff * falloff * visible
+
+    def update(self, player_pos: tuple[int, int]):
+        # Запечённый статический свет + окно света игрока, добавленное насыщающим блитом
+        if not self.enabled:
+            return
+        cell = (player_pos[0] // LIGHT_CELL, player_pos[1] // LIGHT_CELL)
+        if cell == self.cell:
+            return
+        self.cell = cell
+        if self.full is None:
+            self.full = pygame.Surface((WIDTH, HEIGHT))
+        self.full.blit(self.static, (0, 0))
+        (wx, wy), intensity = self._visibility(player_pos, self.player_radius)
+        pixels = (intensity[:, :, None] * self.player_color).astype(np.uint8)
+        window = pygame.surfarray.make_surface(pixels)
+        size = (pixels.shape[0] * LIGHT_CELL, pixels.shape[1] * LIGHT_CELL)
+        self.full.blit(pygame.transform.smoothscale(window, size), (wx.start * LIGHT_CELL, wy.start * LIGHT_CELL), special_flags=pygame.BLEND_RGB_ADD)
+        mark_surface_changed(self.full)
+
+    def apply(self, screen: pygame.Surface):
+        if self.enabled and self.cell is not None:
+            screen.blit(self.full, (0, 0), special_flags=pygame.BLEND_RGB_MULT)
+
+
+# ---------- Взаимодействия ----------
+# Сцена один раз регистрирует интерактивные объекты: зону (уже расширенный прямоугольник),
+# подсказку и действие на E. resolve() выбирает ближайший доступный объект, в зону которого
+# попал игрок, и запоминает его вместе с текстом подсказки; обработчик ввода и отрисовка
+# подсказки читают готовый результат. Пересчёт — только если игрок сдвинулся или изменился
+# GameState (его версия), так что на тик приходится не больше одного запроса.
+class Interaction:
+    __slots__ = ("zone", "prompt", "action", "available")
+
+    def __init__(self, zone: pygame.Rect, prompt, action, available=None):
+        self.zone = zone
+        # Подсказка: строка, None или функция (подсказка зависит от состояния)
+        self.prompt = prompt
+        self.action = action
+        self.available = available
+
+
+class InteractionResolver:
+    def __init__(self, game_state: GameState):
+        self.game_state = game_state
+        self.entries: list[Interaction] = []
+        self.current: Interaction | None = None
+        self.prompt: str | None = None
+        self.queries = 0
+        self._key: tuple | None = None
+
+    def add(self, rect: pygame.Rect, pad: int, prompt, action, available=None) -> Interaction:
+        entry = Interaction(rect.inflate(pad, pad), prompt, action, available)
+        self.entries.append(entry)
+        self._key = None
+        return entry
+
+    def invalidate(self):
+        # Для состояния сцены вне GameState (например, собранные травы)
+        self._key = None
+
+    def resolve(self, player: pygame.Rect) -> Interaction | None:
+        key = (player.x, player.y, self.game_state.version)
+        if key == self._key:
+            return self.current
+        self._key = key
+        self.queries += 1
+        px, py = player.center
+        best = None
+        best_dist = 0
+        for entry in self.entries:
+            if not entry.zone.colliderect(player):
+                continue
+            if entry.available is not None and not entry.available():
+                continue
+            cx, cy = entry.zone.center
+            dist = (cx - px) * (cx - px) + (cy - py) * (cy - py)
+            if best is None or dist < best_dist:
+                best, best_dist = entry, dist
+        self.current = best
+        prompt = best.prompt if best is not None else None
+        self.prompt = prompt() if callable(prompt) else prompt
+        return best
+
+    def interact(self, player: pygame.Rect) -> bool:
+        entry = self.resolve(player)
+        if entry is None:
+            return False
+        entry.action()
+        return True
+
+    def draw_prompt(self, screen, player: pygame.Rect):
+        self.resolve(player)
+        if self.prompt:
+            draw_text(screen, self.prompt, 18, LIGHT_GRAY, WIDTH // 2, HEIGHT - 60, center=True)
 
 
 # ---------- Игровые сцены ----------
@@ -325,7 +2932,7 @@ class TitleScene(Scene):
         self.menu_items = ["Новая игра", "Продолжить", "Выход"]
         self.index = 0
         self.blink = 0
-        self.has_save = os.path.exists("savegame.json")
+        self.has_save = manager.save_path is not None and os.path.exists(manager.save_path)
         self.bg_image = load_menu_background((WIDTH, HEIGHT))
 
     def handle_event(self, event):
@@ -341,9 +2948,7 @@ class TitleScene(Scene):
                 elif self.index == 1:
                     if self.has_save:
                         try:
-                            with open("savegame.json", "r", encoding="utf-8") as f:
-                                data = json.load(f)
-                            gs = GameState.from_dict(data)
+                            gs = load_game(self.manager.save_path)
                             if gs.last_location == "dungeon":
                                 self.manager.change(make_scene_switch("DungeonScene", gs))
                             elif gs.last_location == "fields":
@@ -353,24 +2958,33 @@ class TitleScene(Scene):
                         except Exception:
                             self.manager.change(lambda m: OverworldScene(m, GameState()))
                 else:
-                    pygame.quit()
-                    sys.exit(0)
+                    self.manager.request_quit()
 
     def update(self, dt):
         self.blink = (self.blink + dt) % 1.0
 
+    def idle_for(self):
+        # До следующего мигания подсказки
+        return 0.5 - self.blink % 0.5
+
+    def assets_reloaded(self, names):
+        if "menu_bg.png" in names:
+            self.bg_image = load_menu_background((WIDTH, HEIGHT))
+
     def draw(self, screen):
         screen.blit(self.bg_image, (0, 0))
         draw_text(screen, TITLE, 48, YELLOW, WIDTH // 2, HEIGHT // 2 - 120, center=True)
-        items = list(self.menu_items)
-        if not self.has_save and "Продолжить" in items:
-            items[1] = "Продолжить (нет сохранения)"
-        for i, item in enumerate(items):
+        for i, item in enumerate(self.menu_items):
+            if i == 1 and not self.has_save and item == "Продолжить":
+                item = "Продолжить (нет сохранения)"
             color = WHITE if i != self.index else BLUE
             draw_text(screen, item, 32, color, WIDTH // 2, HEIGHT // 2 - 20 + i * 50, center=True)
         if self.blink < 0.5:
             draw_text(screen, "Стрелки — выбор, Enter — подтвердить", 20, LIGHT_GRAY, WIDTH // 2, HEIGHT - 60, center=True)
             draw_text(screen, "Совет: N — начать новый забег (рогалик)", 18, LIGHT_GRAY, WIDTH // 2, HEIGHT - 30, center=True)
+        # Рекорды из истории забегов (сводка готовится в фоновом потоке)
+        for i, line in enumerate(format_run_records(RUN_HISTORY.summary)):
+            draw_text(screen, line, 20, LIGHT_GRAY, WIDTH // 2, HEIGHT // 2 + 150 + i * 26, center=True)
 
 
 class OverworldScene(Scene):
@@ -378,6 +2992,7 @@ class OverworldScene(Scene):
         super().__init__(manager)
         self.game_state = game_state
         self.game_state.last_location = "overworld"
+        RUN_HISTORY.track(game_state)
         # Карта: прямоугольная область с простыми препятствиями
         self.walls = [
             pygame.Rect(0, 0, WIDTH, 32),
@@ -388,7 +3003,8 @@ class OverworldScene(Scene):
             pygame.Rect(280, 360, 400, 24),
         ]
         self.player = pygame.Rect(100, HEIGHT // 2, 28, 28)
-        self.player_sprite = load_player_sprite((self.player.width, self.player.height))
+        self._step = pygame.Rect(self.player)
+        self.player_sprite = AnimatedSprite(load_player_animations((self.player.width, self.player.height)))
         self.speed = 260
         self.npc = pygame.Rect(WIDTH - 200, HEIGHT // 2 - 20, 32, 32)
         self.door = pygame.Rect(WIDTH - 80, 72, 40, 64)
@@ -399,9 +3015,28 @@ class OverworldScene(Scene):
         self.altar = pygame.Rect(220, 120, 36, 36)
         self.totem = pygame.Rect(WIDTH // 2 - 18, HEIGHT // 2 + 80, 36, 36)
         self.shrine = pygame.Rect(WIDTH - 220, HEIGHT - 140, 36, 36)
+        gs = self.game_state
+        self.interaction = InteractionResolver(gs)
+        self.interaction.add(self.npc, 40, "Нажмите E, чтобы поговорить", self.talk_to_npc)
+        self.interaction.add(self.shop, 40, "Нажмите E, чтобы открыть лавку", self.enter_shop)
+        self.interaction.add(self.thief, 40, "Нажмите E, чтобы поговорить с вором", self.meet_thief)
+        self.interaction.add(self.altar, 28, "Нажмите E, чтобы использовать алтарь (выучить способность)", self.use_altar)
+        self.interaction.add(self.totem, 28, lambda: None if gs.totem_defeated else "Нажмите E, чтобы начать испытание тотема",
+                             self.challenge_totem)
+        self.interaction.add(self.shrine, 28, "Нажмите E, чтобы помолиться у святыни", self.use_shrine)
+        self.interaction.add(self.fields_gate, 20, "Нажмите E, чтобы выйти на поля",
+                             lambda: self.manager.change(make_scene_switch("FieldsScene", self.game_state)))
+        self.interaction.add(self.door, 20, "Нажмите E, чтобы войти", self.enter_dungeon)
         self.message_timer = 0.0
         self.message = ""
         self.show_minimap = False
+        self.minimap = Minimap("overworld", self.game_state, self.walls, [
+            (self.npc, (50, 120, 255)),
+            (self.shop, (220, 150, 60)),
+            (self.thief, (140, 140, 140)),
+            (self.door, (220, 220, 60)),
+            (self.fields_gate, (80, 200, 120)),
+        ])
 
     def collide(self, rect: pygame.Rect) -> bool:
         for wall in self.walls:
@@ -410,46 +3045,37 @@ class OverworldScene(Scene):
         return False
 
     def try_move(self, dx: float, dy: float, dt: float):
-        step_x = pygame.Rect(self.player)
-        step_x.x += int(dx * self.speed * dt)
-        if not self.collide(step_x):
-            self.player = step_x
-        step_y = pygame.Rect(self.player)
-        step_y.y += int(dy * self.speed * dt)
-        if not self.collide(step_y):
-            self.player = step_y
+        self.player_sprite.set_motion(dx, dy)
+        # Пробный шаг — в одном переиспользуемом прямоугольнике, игрок сдвигается на месте
+        step = self._step
+        step.update(self.player)
+        step.x += int(dx * self.speed * dt)
+        if not self.collide(step):
+            self.player.x = step.x
+        step.update(self.player)
+        step.y += int(dy * self.speed * dt)
+        if not self.collide(step):
+            self.player.y = step.y
 
     def handle_event(self, event):
         if event.type == pygame.KEYDOWN and event.key == pygame.K_e:
-            if self.player.colliderect(self.npc.inflate(40, 40)):
-                self.talk_to_npc()
-            elif self.player.colliderect(self.shop.inflate(40, 40)):
-                self.enter_shop()
-            elif self.player.colliderect(self.thief.inflate(40, 40)):
-                self.meet_thief()
-            elif self.player.colliderect(self.altar.inflate(28, 28)):
-                self.use_altar()
-            elif self.player.colliderect(self.totem.inflate(28, 28)):
-                self.challenge_totem()
-            elif self.player.colliderect(self.shrine.inflate(28, 28)):
-                self.use_shrine()
-            elif self.player.colliderect(self.fields_gate.inflate(20, 20)):
-                self.manager.change(make_scene_switch("FieldsScene", self.game_state))
-            elif self.player.colliderect(self.door.inflate(20, 20)):
-                self.enter_dungeon()
+            self.interaction.interact(self.player)
         elif event.type == pygame.KEYDOWN and event.key == pygame.K_q:
             self.open_quest_log()
         elif event.type == pygame.KEYDOWN and event.key == pygame.K_m:
             self.show_minimap = not self.show_minimap
         elif event.type == pygame.KEYDOWN and event.key == pygame.K_n:
             # Начать новый забег (рогалик) — быстрый рестарт с переносом прогресса
+            RUN_HISTORY.record(self.game_state)
             self.game_state.start_new_run()
             self.message = "Начат новый забег! Сложность возросла."
             self.message_timer = 2.5
+        elif event.type == pygame.KEYDOWN and event.key in (pygame.K_F5, pygame.K_F9) and self.manager.save_path is None:
+            self.message = "Сохранения недоступны в сетевой игре."
+            self.message_timer = 2.0
         elif event.type == pygame.KEYDOWN and event.key == pygame.K_F5:
             try:
-                with open("savegame.json", "w", encoding="utf-8") as f:
-                    json.dump(self.game_state.to_dict(), f, ensure_ascii=False, indent=2)
+                save_game_delta(self.game_state, self.manager.save_path)
                 self.message = "Игра сохранена (F5)."
                 self.message_timer = 2.0
             except Exception:
@@ -457,126 +3083,38 @@ class OverworldScene(Scene):
                 self.message_timer = 2.0
         elif event.type == pygame.KEYDOWN and event.key == pygame.K_F9:
             try:
-                with open("savegame.json", "r", encoding="utf-8") as f:
-                    data = json.load(f)
-                gs = GameState.from_dict(data)
+                gs = load_game(self.manager.save_path)
                 self.manager.change(make_scene_switch("OverworldScene", gs))
             except Exception:
                 self.message = "Загрузка не удалась."
                 self.message_timer = 2.0
 
     def talk_to_npc(self):
-        def on_choice(choice_id: int):
-            if choice_id == 0:
-                self.game_state.honor += 1
-                self.game_state.helped_npc = True
-                self.message = "Вы пообещали помочь. Честь +1"
-                self.message_timer = 2.0
-            elif choice_id == 1:
-                self.game_state.gold += 5
-                self.message = "Вы потребовали плату. Золото +5"
-                self.message_timer = 2.0
-            else:
-                self.message = "Вы отказались. Кто-то другой поможет..."
-                self.message_timer = 2.0
-
-        text = (
-            "Путник: Говорят, древний артефакт хранит подземелье у ворот.\n"
-            "Но прежде — зверь у северных ворот и стражи внизу. Без этого дверь не откроется.\n"
-            "Поможешь городу?"
-        )
-        choices = [
-            ("Помочь бескорыстно", 0),
-            ("Помочь за 5 золота", 1),
-            ("Отказать", 2),
-        ]
-        self.manager.change(lambda m: DialogueScene(m, text, choices, on_choice, self))
+        self.manager.change(lambda m: DialogueScene.conversation(m, "traveler", self.game_state, self))
 
     def enter_dungeon(self):
-        def after_key(choice_id: int):
-            if choice_id == 0:
-                self.game_state.has_key = True
-                self.message = "Вы нашли ключ под ковриком у двери."
-                self.message_timer = 2.0
-
         if not self.game_state.beast_defeated:
             # Перед боем — короткая сцена проверки навыка/удачи
             self.manager.change(lambda m: SkillCheckScene(m, self.game_state, self))
         else:
             # После победы можно открыть тайник, если есть ключ
             if not self.game_state.has_key:
-                text = "Дверь заперта. Осмотреться у порога?"
-                choices = [("Да, поискать ключ", 0), ("Нет", 1)]
-                self.manager.change(lambda m: DialogueScene(m, text, choices, after_key, self))
+                self.manager.change(lambda m: DialogueScene.conversation(m, "door", self.game_state, self))
             else:
                 # Внутри двери теперь подземелье
                 self.manager.change(lambda m: DungeonScene(m, self.game_state))
 
     def enter_shop(self):
-        def on_choice(choice_id: int):
-            if choice_id == 0 and self.game_state.gold >= 5:
-                self.game_state.gold -= 5
-                self.game_state.potions += 1
-                self.message = "Куплено: зелье (+1)."
-                self.message_timer = 2.0
-            elif choice_id == 1 and self.game_state.gold >= 8 and not self.game_state.has_sword:
-                self.game_state.gold -= 8
-                self.game_state.has_sword = True
-                self.message = "Куплен меч (урон +2)."
-                self.message_timer = 2.0
-            elif choice_id == 2:
-                self.message = "Может, в другой раз..."
-                self.message_timer = 1.5
-            else:
-                self.message = "Недостаточно золота."
-                self.message_timer = 1.5
-
-        text = "Лавочник: Лучший товар в городе! Что берёте?"
-        items = [
-            ("Купить зелье (5 золота)", 0),
-            ("Купить меч (8 золота)", 1),
-            ("Ничего", 2),
-        ]
-        self.manager.change(lambda m: DialogueScene(m, text, items, on_choice, self))
+        self.manager.change(lambda m: DialogueScene.conversation(m, "shop", self.game_state, self))
 
     def meet_thief(self):
-        def on_choice(choice_id: int):
-            if choice_id == 0:
-                # Взять ключ у вора за честь
-                if not self.game_state.has_key:
-                    self.game_state.has_key = True
-                    self.game_state.honor = max(0, self.game_state.honor - 1)
-                    self.message = "Вы приняли сомнительный ключ. Честь -1."
-                    self.message_timer = 2.0
-                else:
-                    self.message = "У вас уже есть ключ."
-                    self.message_timer = 1.5
-            elif choice_id == 1:
-                # Попытка карманной кражи
-                success = random.random() < 0.5
-                if success:
-                    self.game_state.gold += 4
-                    self.game_state.honor = max(0, self.game_state.honor - 1)
-                    self.message = "Вы стащили немного золота. Честь -1."
-                else:
-                    self.message = "Провал! Вас заметили, пришлось сбежать."
-                self.message_timer = 2.0
-            else:
-                self.message = "Вы отвергли предложение вора."
-                self.message_timer = 1.5
-
-        text = (
-            "Вор: Ключ от северной двери, говоришь?\n"
-            "Могу достать 'альтернативный' ключ... или подзаработать вместе."
-        )
-        choices = [("Взять ключ (Честь -1)", 0), ("Обокрасть прохожего", 1), ("Уйти", 2)]
-        self.manager.change(lambda m: DialogueScene(m, text, choices, on_choice, self))
+        self.manager.change(lambda m: DialogueScene.conversation(m, "thief", self.game_state, self))
 
     def open_quest_log(self):
         self.manager.change(lambda m: QuestLogScene(m, self.game_state, self))
 
     def update(self, dt):
-        keys = pygame.key.get_pressed()
+        keys = self.manager.pressed()
         dx = dy = 0
         if keys[pygame.K_LEFT] or keys[pygame.K_a]:
             dx -= 1
@@ -591,6 +3129,8 @@ class OverworldScene(Scene):
             dx *= inv
             dy *= inv
         self.try_move(dx, dy, dt)
+        self.minimap.reveal(self.player.center)
+        self.interaction.resolve(self.player)
 
         if self.message_timer > 0:
             self.message_timer -= dt
@@ -600,11 +3140,7 @@ class OverworldScene(Scene):
     def draw(self, screen):
         screen.fill((18, 22, 28))
         # Пол (плитка)
-        tile_size = 32
-        for x in range(0, WIDTH, tile_size):
-            for y in range(0, HEIGHT, tile_size):
-                rect = pygame.Rect(x, y, tile_size, tile_size)
-                draw_textured_rect(screen, rect, "tiles/overworld_floor.png", fallback_color=(24, 28, 34))
+        draw_floor(screen, "tiles/overworld_floor.png", (24, 28, 34))
         # Стены
         for wall in self.walls:
             draw_textured_rect(screen, wall, "tiles/overworld_wall.png", fallback_color=GRAY)
@@ -612,16 +3148,16 @@ class OverworldScene(Scene):
         draw_textured_rect(screen, self.door, "objects/door.png", fallback_color=YELLOW, border_radius=4)
         draw_text(screen, "Северные ворота", 18, YELLOW, self.door.centerx, self.door.top - 20, center=True)
         # Выход на поля
-        pygame.draw.rect(screen, (80, 160, 80), self.fields_gate)
+        draw_rect(screen, (80, 160, 80), self.fields_gate)
         draw_text(screen, "На поля", 18, WHITE, self.fields_gate.centerx, self.fields_gate.top - 16, center=True)
         # NPC
-        draw_textured_rect(screen, self.npc, "characters/npc.png", fallback_color=BLUE, border_radius=4)
+        draw_animated_rect(screen, self.npc, "characters/npc.png", fallback_color=BLUE, border_radius=4)
         draw_text(screen, "Путник", 18, WHITE, self.npc.centerx, self.npc.top - 16, center=True)
         # Лавочник
         draw_textured_rect(screen, self.shop, "objects/shop.png", fallback_color=(200, 120, 40), border_radius=4)
         draw_text(screen, "Лавка", 18, WHITE, self.shop.centerx, self.shop.top - 16, center=True)
         # Вор
-        draw_textured_rect(screen, self.thief, "characters/thief.png", fallback_color=(120, 120, 120), border_radius=4)
+        draw_animated_rect(screen, self.thief, "characters/thief.png", fallback_color=(120, 120, 120), border_radius=4)
         # Новые активности
         draw_textured_rect(screen, self.altar, "objects/altar.png", fallback_color=(160, 120, 200), border_radius=6)
         draw_textured_rect(screen, self.totem, "objects/totem.png", fallback_color=(180, 90, 50), border_radius=6)
@@ -631,7 +3167,7 @@ class OverworldScene(Scene):
         draw_text(screen, "Святыня", 16, WHITE, self.shrine.centerx, self.shrine.top - 14, center=True)
         draw_text(screen, "Вор", 18, WHITE, self.thief.centerx, self.thief.top - 16, center=True)
         # Игрок (спрайт)
-        screen.blit(self.player_sprite, self.player.topleft)
+        screen.blit(self.player_sprite.image(), self.player.topleft)
 
         # HUD
         hud = (
@@ -641,24 +3177,9 @@ class OverworldScene(Scene):
             f"Травы: {self.game_state.herbs}   Ур: {self.game_state.level} ({self.game_state.xp}/{self.game_state.xp_to_next})   "
             f"HP: {self.game_state.max_hp}   ATK: {self.game_state.base_atk}   Артефакт: {self.game_state.artifact_level}   Забег: {self.game_state.run_number}"
         )
-        draw_text(screen, hud, 20, WHITE, 16, 12, center=False)
-
-        if self.player.colliderect(self.npc.inflate(40, 40)):
-            draw_text(screen, "Нажмите E, чтобы поговорить", 18, LIGHT_GRAY, WIDTH // 2, HEIGHT - 60, center=True)
-        elif self.player.colliderect(self.shop.inflate(40, 40)):
-            draw_text(screen, "Нажмите E, чтобы открыть лавку", 18, LIGHT_GRAY, WIDTH // 2, HEIGHT - 60, center=True)
-        elif self.player.colliderect(self.thief.inflate(40, 40)):
-            draw_text(screen, "Нажмите E, чтобы поговорить с вором", 18, LIGHT_GRAY, WIDTH // 2, HEIGHT - 60, center=True)
-        elif self.player.colliderect(self.altar.inflate(28, 28)):
-            draw_text(screen, "Нажмите E, чтобы использовать алтарь (выучить способность)", 18, LIGHT_GRAY, WIDTH // 2, HEIGHT - 60, center=True)
-        elif self.player.colliderect(self.totem.inflate(28, 28)) and not self.game_state.totem_defeated:
-            draw_text(screen, "Нажмите E, чтобы начать испытание тотема", 18, LIGHT_GRAY, WIDTH // 2, HEIGHT - 60, center=True)
-        elif self.player.colliderect(self.shrine.inflate(28, 28)):
-            draw_text(screen, "Нажмите E, чтобы помолиться у святыни", 18, LIGHT_GRAY, WIDTH // 2, HEIGHT - 60, center=True)
-        elif self.player.colliderect(self.door.inflate(20, 20)):
-            draw_text(screen, "Нажмите E, чтобы войти", 18, LIGHT_GRAY, WIDTH // 2, HEIGHT - 60, center=True)
-        elif self.player.colliderect(self.fields_gate.inflate(20, 20)):
-            draw_text(screen, "Нажмите E, чтобы выйти на поля", 18, LIGHT_GRAY, WIDTH // 2, HEIGHT - 60, center=True)
+        draw_glyphs(screen, hud, 20, WHITE, 16, 12, center=False)
+
+        self.interaction.draw_prompt(screen, self.player)
 
         if self.message:
             draw_text(screen, self.message, 20, YELLOW, WIDTH // 2, 40, center=True)
@@ -668,29 +3189,11 @@ class OverworldScene(Scene):
             self.draw_minimap(screen)
 
     def use_altar(self):
-        options: list[tuple[str, int]] = []
-        order = [
-            ("q", "Выучить Q — Рывок-удар"),
-            ("e", "Выучить E — Барьер"),
-            ("r", "Выучить R — Арканный взрыв"),
-        ]
-        for key, label in order:
-            if not self.game_state.abilities[key]["learned"]:
-                options.append((label, 100 + ord(key)))
-        if not options:
+        if all(ab.learned for ab in self.game_state.abilities.values()):
             self.message = "Вы уже постигли все способности."
             self.message_timer = 2.0
             return
-
-        def on_choice(choice_id: int):
-            key = chr(choice_id - 100)
-            if key in self.game_state.abilities and not self.game_state.abilities[key]["learned"]:
-                self.game_state.abilities[key]["learned"] = True
-                self.message = f"Вы обучились способности {self.game_state.abilities[key]['name']}!"
-                self.message_timer = 2.0
-
-        text = "Алтарь знаний: выберите способность для обучения"
-        self.manager.change(lambda m: DialogueScene(m, text, options + [("Отмена", 0)], on_choice, self))
+        self.manager.change(lambda m: DialogueScene.conversation(m, "altar", self.game_state, self))
 
     def challenge_totem(self):
         if self.game_state.totem_defeated:
@@ -709,69 +3212,95 @@ class OverworldScene(Scene):
         if self.game_state.potions < 2:
             self.game_state.potions += 1
             self.message = "Святыня благословила вас зельем."
+            AUDIO.play("potion")
         else:
             heal = min(self.game_state.max_hp, self.game_state.max_hp)  # привлекательный текст; фактического HP нет вне боя
             self.message = "Святыня укрепила дух и тело."
         self.message_timer = 2.0
 
     def draw_minimap(self, screen: pygame.Surface):
-        mw, mh = 180, 100
-        mx, my = WIDTH - mw - 16, 30
-        pygame.draw.rect(screen, (0, 0, 0), (mx - 4, my - 4, mw + 8, mh + 8))
-        pygame.draw.rect(screen, (30, 30, 30), (mx, my, mw, mh))
-        scale_x = mw / WIDTH
-        scale_y = mh / HEIGHT
-        for wall in self.walls:
-            r = pygame.Rect(mx + int(wall.left * scale_x), my + int(wall.top * scale_y), int(wall.width * scale_x), int(wall.height * scale_y))
-            pygame.draw.rect(screen, (70, 70, 90), r)
-        for obj, color in [
-            (self.npc, (50, 120, 255)),
-            (self.shop, (220, 150, 60)),
-            (self.thief, (140, 140, 140)),
-            (self.door, (220, 220, 60)),
-            (self.fields_gate, (80, 200, 120)),
-        ]:
-            r = pygame.Rect(mx + int(obj.centerx * scale_x) - 2, my + int(obj.centery * scale_y) - 2, 4, 4)
-            pygame.draw.rect(screen, color, r)
-        pr = pygame.Rect(mx + int(self.player.centerx * scale_x) - 2, my + int(self.player.centery * scale_y) - 2, 4, 4)
-        pygame.draw.rect(screen, (80, 220, 80), pr)
+        self.minimap.draw(screen, (), self.player)
 
 
 class DialogueScene(Scene):
     def __init__(self, manager: SceneManager, text: str, choices: list[tuple[str, int]], on_choice, return_scene: Scene):
-        super().__init__(manager)
-        self.text = text
-        self.choices = choices
-        self.on_choice = on_choice
-        self.index = 0
+        # Разовый диалог из кода: один узел, выбор передаётся в on_choice
+        def make_action(choice_id: int):
+            def action(gs, scene):
+                if on_choice:
+                    on_choice(choice_id)
+            return action
+        node = DialogueNode("", text, [DialogueChoice(label, None, make_action(cid)) for label, cid in choices])
+        self._setup(manager, return_scene, None, None, node)
+
+    @classmethod
+    def conversation(cls, manager: SceneManager, name: str, game_state: GameState, return_scene: Scene) -> "DialogueScene":
+        conv = load_conversation(name)
+        scene = cls.__new__(cls)
+        scene._setup(manager, return_scene, game_state, conv, conv.nodes[conv.start])
+        return scene
+
+    def _setup(self, manager, return_scene, game_state, conv, node):
+        Scene.__init__(self, manager)
         self.return_scene = return_scene
+        self.game_state = game_state
+        # Скомпилированный разговор; у разовых диалогов из кода — None
+        self.conv = conv
+        self.enter(node)
+
+    def enter(self, node: DialogueNode):
+        # Текст узла раскладывается и отрисовывается один раз, при первом входе
+        self.node = node
+        if node.layout is None and not self.manager.headless:
+            node.layout = DialogueLayout(node.text)
+        self.choices = [c for c in node.choices if c.visible is None or c.visible(self.game_state)]
+        self.index = 0
 
     def handle_event(self, event):
         if event.type == pygame.KEYDOWN:
-            if event.key in (pygame.K_UP, pygame.K_w):
+            if not self.choices or event.key in (pygame.K_ESCAPE,):
+                self.manager.current = self.return_scene
+            elif event.key in (pygame.K_UP, pygame.K_w):
                 self.index = (self.index - 1) % len(self.choices)
             elif event.key in (pygame.K_DOWN, pygame.K_s):
                 self.index = (self.index + 1) % len(self.choices)
             elif event.key in (pygame.K_RETURN, pygame.K_SPACE):
-                choice_id = self.choices[self.index][1]
-                if self.on_choice:
-                    self.on_choice(choice_id)
-                # Вернуться в указанную сцену (обычно — мир)
-                self.manager.current = self.return_scene
-            elif event.key in (pygame.K_ESCAPE,):
-                self.manager.current = self.return_scene
+                next_node = self.choices[self.index].action(self.game_state, self.return_scene)
+                if next_node and self.conv is not None:
+                    self.enter(self.conv.nodes[next_node])
+                else:
+                    # Вернуться в указанную сцену (обычно — мир)
+                    self.manager.current = self.return_scene
 
     def update(self, dt):
         pass
 
+    def idle_for(self):
+        return IDLE_MAX_WAIT
+
+    def assets_reloaded(self, names):
+        # Поменялся файл текущего разговора — остаёмся в том же узле новой версии
+        if self.conv is None or f"dialogue/{self.conv.name}.json" not in names:
+            return
+        try:
+            self.conv = load_conversation(self.conv.name)
+        except (OSError, ValueError, KeyError):
+            return
+        nodes = self.conv.nodes
+        self.enter(nodes.get(self.node.node_id) or nodes[self.conv.start])
+
     def draw(self, screen):
         screen.fill((10, 10, 14))
+        layout = self.node.layout
         # Текст
-        draw_text(screen, self.text, 24, WHITE, WIDTH // 2, HEIGHT // 2 - 100, center=True)
+        y = HEIGHT // 2 - 100 - sum(s.get_height() for s in layout.lines) // 2
+        for i, surf in enumerate(layout.lines):
+            rect = surf.get_rect(center=(WIDTH // 2, y + i * layout.line_step))
+            screen.blit(surf, rect)
         # Выбор
-        for i, (label, _) in enumerate(self.choices):
-            color = BLUE if i == self.index else LIGHT_GRAY
-            draw_text(screen, label, 28, color, WIDTH // 2, HEIGHT // 2 - 10 + i * 40, center=True)
+        for i, choice in enumerate(self.choices):
+            surf = layout.label(choice.label, i == self.index)
+            screen.blit(surf, surf.get_rect(center=(WIDTH // 2, HEIGHT // 2 - 10 + i * 40)))
         draw_text(screen, "Enter — выбрать, Esc — назад", 18, LIGHT_GRAY, WIDTH // 2, HEIGHT - 40, center=True)
 
 
@@ -788,6 +3317,9 @@ class QuestLogScene(Scene):
     def update(self, dt):
         pass
 
+    def idle_for(self):
+        return IDLE_MAX_WAIT
+
     def draw(self, screen):
         screen.fill((14, 14, 18))
         draw_text(screen, "Квесты и подсказки", 36, YELLOW, WIDTH // 2, 48, center=True)
@@ -803,47 +3335,14 @@ class QuestLogScene(Scene):
         # Состояние ключевых флагов
         y = 200
         font_size = 22
-        flags = [
-            ("Зверь изгнан", self.game_state.beast_defeated),
-            ("Есть ключ", self.game_state.has_key),
-            ("Меч куплен", self.game_state.has_sword),
-            ("Артефакт найден", self.game_state.artifact_found),
-            ("Спутник присоединился", self.game_state.companion_joined),
-            ("Подземелье зачищено", self.game_state.dungeon_fully_cleared),
-            ("Мини-босс побеждён", getattr(self.game_state, "miniboss_defeated", False)),
-            ("Финальный босс побеждён", getattr(self.game_state, "final_boss_defeated", False)),
-            ("Испытание тотема", getattr(self.game_state, "totem_defeated", False)),
-            ("Забег на время выполнен", getattr(self.game_state, "trial_completed", False)),
-        ]
+        flags = quest_flag_status(self.game_state)
         for title, done in flags:
             color = GREEN if done else LIGHT_GRAY
             draw_text(screen, ("[✓] " if done else "[ ] ") + title, font_size, color, WIDTH // 2, y, center=True)
             y += 28
 
-        # Динамические подсказки
-        tips: list[str] = []
-        if not self.game_state.beast_defeated:
-            tips.append("Подойдите к северным воротам и пройдите скилл-чек (SPACE) против зверя.")
-        if self.game_state.beast_defeated and not self.game_state.has_key:
-            tips.append("Около двери осмотритесь и найдите ключ (E), либо поговорите с вором.")
-        if self.game_state.has_key and not self.game_state.dungeon_fully_cleared:
-            tips.append("Войдите в подземелье. Победите Стража и двух Часовых (E у них).")
-        if self.game_state.dungeon_fully_cleared and not self.game_state.artifact_found:
-            tips.append("Откройте сундук в подземелье, чтобы взять артефакт (E у сундука).")
-        if self.game_state.artifact_found and not getattr(self.game_state, "miniboss_defeated", False):
-            tips.append("После взятия артефакта найдите у выхода мини-босса Лейтенанта и победите его.")
-        if getattr(self.game_state, "miniboss_defeated", False) and not getattr(self.game_state, "final_boss_defeated", False):
-            tips.append("Усилите героя: купите меч, соберите травы у Травника для зелий/спутника, повышайте уровень в боях.")
-        if not getattr(self.game_state, "totem_defeated", False):
-            tips.append("В городе найдите Тотем испытаний и победите его для награды.")
-        if not getattr(self.game_state, "trial_completed", False):
-            tips.append("На полях попробуйте забег на время. Начало — у первой контрольной точки.")
-        if self.game_state.companion_joined is False:
-            tips.append("На полях соберите 3 травы и попросите Травника присоединиться (E).")
-        if self.game_state.artifact_found and self.game_state.honor < 2:
-            tips.append("Поднимите честь (помогите путнику бескорыстно), это влияет на лучшие концовки.")
-        if len(tips) == 0:
-            tips.append("Исследуйте мир, начните новый забег (N) для увеличения сложности и прогресса.")
+        # Динамические подсказки (пересчитываются только при изменении состояния)
+        tips = current_hints(self.game_state)
 
         draw_text(screen, "Подсказки", 24, YELLOW, WIDTH // 2, y + 16, center=True)
         y += 56
@@ -851,6 +3350,9 @@ class QuestLogScene(Scene):
             draw_text(screen, "• " + tip, 20, WHITE, WIDTH // 2, y, center=True)
             y += 26
 
+        for i, line in enumerate(format_run_records(RUN_HISTORY.summary)):
+            draw_text(screen, line, 16, LIGHT_GRAY, 16, 12 + i * 20, center=False)
+
         draw_text(screen, "Нажмите любую клавишу, чтобы вернуться", 18, LIGHT_GRAY, WIDTH // 2, HEIGHT - 36, center=True)
 
 
@@ -907,14 +3409,14 @@ class SkillCheckScene(Scene):
         draw_text(screen, "Изгнание зверя", 36, YELLOW, WIDTH // 2, 60, center=True)
         # Полоса
         bar_rect = pygame.Rect(120, HEIGHT // 2 - 12, WIDTH - 240, 24)
-        pygame.draw.rect(screen, LIGHT_GRAY, bar_rect, 2)
+        draw_rect(screen, LIGHT_GRAY, bar_rect, 2)
         # Зона успеха
         zone_w = int(bar_rect.width * self.success_width)
         zone_x = int(bar_rect.left + bar_rect.width * (self.success_center - self.success_width / 2))
-        pygame.draw.rect(screen, (60, 120, 60), (zone_x, bar_rect.top + 2, zone_w, bar_rect.height - 4))
+        draw_rect(screen, (60, 120, 60), (zone_x, bar_rect.top + 2, zone_w, bar_rect.height - 4))
         # Бегунок
         knob_x = int(bar_rect.left + bar_rect.width * self.slider_x)
-        pygame.draw.circle(screen, BLUE, (knob_x, bar_rect.centery), 10)
+        draw_circle(screen, BLUE, (knob_x, bar_rect.centery), 10)
 
         if not self.resolved:
             draw_text(screen, "Нажмите ПРОБЕЛ в зелёной зоне", 22, WHITE, WIDTH // 2, HEIGHT // 2 + 80, center=True)
@@ -932,28 +3434,7 @@ class EndingScene(Scene):
         self.text, self.color = self.compute_ending()
 
     def compute_ending(self):
-        if not self.game_state.beast_defeated:
-            return ("Зверь остался бродить по окраинам...\nГорожане в страхе.", RED)
-        if self.game_state.artifact_found and self.game_state.honor >= 2 and self.game_state.companion_joined and self.game_state.dungeon_fully_cleared:
-            return ("С артефактом, доброй славой и поддержкой спутника\n"
-                    "город расцвёл. Вы — наставник и защитник.", YELLOW)
-        if self.game_state.artifact_found and self.game_state.honor >= 2 and self.game_state.dungeon_fully_cleared:
-            return ("С артефактом и доброй славой вы возродили город.\n"
-                    "Имя ваше войдёт в летописи.", YELLOW)
-        if self.game_state.final_boss_defeated and self.game_state.run_number >= 1:
-            return ("Вы сокрушили Владыку Теней, завершив забег №" + str(self.game_state.run_number) + ".\n"
-                    "Город свободен, но новые угрозы ждут в следующих забегах...", YELLOW)
-        if self.game_state.artifact_found and not self.game_state.dungeon_fully_cleared:
-            return ("Вы нашли артефакт, не победив всех стражей...\n"
-                    "Сила его нестабильна, и город в опасности.", RED)
-        if self.game_state.honor >= 1 and self.game_state.gold >= 5 and self.game_state.has_sword:
-            return ("Вы помогли путнику и получили плату.\n"
-                    "Город спасён, а меч стал символом защиты.", GREEN)
-        if self.game_state.has_key and self.game_state.artifact_found:
-            return ("Вы нашли артефакт, но ваши поступки двусмысленны...\n"
-                    "Горожане сомневаются, кому он служит.", BLUE)
-        return ("Вы изгнали зверя, но прошли мимо возможностей...\n"
-                "Иногда выбор важнее битвы.", LIGHT_GRAY)
+        return current_ending(self.game_state)
 
     def handle_event(self, event):
         if event.type == pygame.KEYDOWN:
@@ -964,6 +3445,9 @@ class EndingScene(Scene):
     def update(self, dt):
         pass
 
+    def idle_for(self):
+        return IDLE_MAX_WAIT
+
     def draw(self, screen):
         screen.fill((12, 10, 10))
         draw_text(screen, "Концовка", 40, self.color, WIDTH // 2, 100, center=True)
@@ -974,6 +3458,10 @@ class EndingScene(Scene):
 
 
 class CombatScene(Scene):
+    # Точки на экране боя, откуда летят эффекты
+    PLAYER_POS = (WIDTH // 2 - 200, 140)
+    ENEMY_POS = (WIDTH // 2 + 200, 140)
+
     def __init__(self, manager: SceneManager, game_state: GameState, return_scene: Scene, enemy_name: str = "Страж", enemy_hp: int = 8, enemy_atk: int = 2, enemy_id: str | None = None, on_win=None, xp_reward: int = 4):
         super().__init__(manager)
         self.game_state = game_state
@@ -995,6 +3483,8 @@ class CombatScene(Scene):
         self.xp_reward = int(xp_reward * (1.0 + self.game_state.run_number * 0.3))
         # Щит от способности E (поглощает часть урона следующей атаки)
         self.temp_shield = 0
+        self.turns = 0
+        TELEMETRY.emit("combat_start", enemy=self.enemy_id or enemy_name, level=self.game_state.level, run=self.game_state.run_number)
 
     def handle_event(self, event):
         if event.type == pygame.KEYDOWN and self.turn == "player" and self.player_hp > 0 and self.enemy_hp > 0:
@@ -1003,9 +3493,11 @@ class CombatScene(Scene):
                 dmg = max(1, dmg)
                 self.enemy_hp -= dmg
                 self.log.append(f"Вы ударили: -{dmg} HP")
+                self.effect("hit", self.ENEMY_POS)
                 self.turn = "enemy"
             elif event.key == pygame.K_2 and self.game_state.potions > 0:
                 self.game_state.potions -= 1
+                AUDIO.play("potion")
                 heal = random.randint(3, 6)
                 self.player_hp = min(12, self.player_hp + heal)
                 self.log.append(f"Вы выпили зелье: +{heal} HP")
@@ -1014,60 +3506,91 @@ class CombatScene(Scene):
                 dmg = 3 + (1 if self.game_state.artifact_found else 0)
                 self.enemy_hp -= dmg
                 self.log.append(f"Огненное заклинание: -{dmg} HP")
+                self.effect("fire", self.ENEMY_POS)
                 self.spell_cooldown = 3.0
                 self.turn = "enemy"
             # Способности Q/E/R
-            elif event.key == pygame.K_q and self.game_state.abilities["q"]["learned"] and self.game_state.abilities["q"]["cd"] <= 0.0:
+            elif event.key == pygame.K_q and self.game_state.abilities["q"].ready():
                 # Рывок-удар: мощный удар 150% урона
                 base = random.randint(self.player_atk - 1, self.player_atk + 1)
                 dmg = max(2, int(base * 1.5))
                 self.enemy_hp -= dmg
-                self.game_state.abilities["q"]["cd"] = self.game_state.abilities["q"]["max_cd"]
+                self.game_state.abilities["q"].trigger()
                 self.log.append(f"Q — Рывок-удар: -{dmg} HP")
+                self.effect("dash", self.ENEMY_POS)
+                self.effect("hit", self.ENEMY_POS)
                 self.turn = "enemy"
-            elif event.key == pygame.K_e and self.game_state.abilities["e"]["learned"] and self.game_state.abilities["e"]["cd"] <= 0.0:
+            elif event.key == pygame.K_e and self.game_state.abilities["e"].ready():
                 # Барьер: щит на следующий входящий удар (-50% урона)
                 self.temp_shield = 50  # проценты
-                self.game_state.abilities["e"]["cd"] = self.game_state.abilities["e"]["max_cd"]
+                self.game_state.abilities["e"].trigger()
                 self.log.append("E — Барьер активирован: следующий удар по вам слабее")
+                self.effect("barrier", self.PLAYER_POS)
                 self.turn = "enemy"
-            elif event.key == pygame.K_r and self.game_state.abilities["r"]["learned"] and self.game_state.abilities["r"]["cd"] <= 0.0:
+            elif event.key == pygame.K_r and self.game_state.abilities["r"].ready():
                 # Арканный взрыв: большой урон, зависит от артефакта
                 bonus = 2 * (1 if self.game_state.artifact_found else 0)
                 dmg = 5 + bonus
                 self.enemy_hp -= dmg
-                self.game_state.abilities["r"]["cd"] = self.game_state.abilities["r"]["max_cd"]
+                self.game_state.abilities["r"].trigger()
                 self.log.append(f"R — Арканный взрыв: -{dmg} HP")
+                self.effect("arcane", self.ENEMY_POS)
                 self.turn = "enemy"
+            if self.turn == "enemy":
+                self.turns += 1
+        elif event.type == pygame.KEYDOWN and self.player_hp <= 0 and event.key in (pygame.K_BACKSPACE, pygame.K_HOME):
+            # Перемотка: Backspace — к началу последнего хода, Home — к началу боя
+            rewind = self.manager.rewind
+            if event.key == pygame.K_BACKSPACE:
+                point = rewind.rewind(self.game_state, 1)
+            else:
+                point = rewind.rewind_to(self.game_state, "CombatScene")
+            if point is not None and point.extra is not None:
+                self.restore_rewind_state(point.extra)
         elif event.type == pygame.KEYDOWN and (self.player_hp <= 0 or self.enemy_hp <= 0):
             # Завершить бой
             self.manager.current = self.return_scene
+            TELEMETRY.emit("combat_end", enemy=self.enemy_id or self.enemy_name, won=self.enemy_hp <= 0, turns=self.turns, hp=self.player_hp)
             if self.enemy_hp <= 0:
-                if self.enemy_id and self.enemy_id not in self.game_state.defeated_enemies:
-                    self.game_state.defeated_enemies.append(self.enemy_id)
+                if self.enemy_id:
+                    self.game_state.defeat_enemy(self.enemy_id)
                 # Обратная совместимость: отметим стража
                 if self.enemy_name == "Страж":
                     self.game_state.guard_defeated = True
                 # Выдать опыт, повысить уровень/характеристики
+                level_before = self.game_state.level
                 self.game_state.grant_xp(self.xp_reward)
                 if callable(self.on_win):
                     try:
                         self.on_win(self.game_state)
                     except Exception:
                         pass
+                if self.game_state.level > level_before:
+                    emit_level_up(self.return_scene)
+
+    def rewind_state(self):
+        return (self.player_hp, self.enemy_hp, self.turn, self.spell_cooldown, self.temp_shield, self.turns, len(self.log))
+
+    def restore_rewind_state(self, state):
+        self.player_hp, self.enemy_hp, self.turn, self.spell_cooldown, self.temp_shield, self.turns, log_len = state
+        del self.log[log_len:]
+        self.log.append(f"Перемотка к ходу {self.turns + 1}")
+
+    def effect(self, name: str, pos: tuple[int, int]):
+        self.manager.particles.emit_effect(name, pos[0], pos[1])
+        AUDIO.play(EFFECT_SFX.get(name, "hit"))
 
     def update(self, dt):
         if self.spell_cooldown > 0.0:
             self.spell_cooldown = max(0.0, self.spell_cooldown - dt)
         # Кулдауны способностей
-        for k in ("q", "e", "r"):
-            if self.game_state.abilities.get(k, {}).get("cd", 0.0) > 0.0:
-                self.game_state.abilities[k]["cd"] = max(0.0, self.game_state.abilities[k]["cd"] - dt)
+        self.game_state.tick_cooldowns(dt)
         if self.turn == "enemy" and self.player_hp > 0 and self.enemy_hp > 0:
             if self.game_state.companion_joined and self.enemy_hp > 0:
                 cdmg = random.randint(1, 2)
                 self.enemy_hp -= cdmg
                 self.log.append(f"Спутник атакует: -{cdmg} HP")
+                self.effect("hit", self.ENEMY_POS)
                 if self.enemy_hp <= 0:
                     return
             dmg = random.randint(self.enemy_atk - 1, self.enemy_atk + 1)
@@ -1080,29 +3603,33 @@ class CombatScene(Scene):
                 self.temp_shield = 0
             self.player_hp -= dmg
             self.log.append(f"{self.enemy_name} ударил: -{dmg} HP")
+            self.effect("hit", self.PLAYER_POS)
             self.turn = "player"
+            if self.player_hp > 0:
+                self.manager.rewind.capture(self.game_state, "turn", self.rewind_state())
 
     def draw(self, screen):
         screen.fill((20, 16, 18))
         draw_text(screen, f"Бой: {self.enemy_name}", 34, YELLOW, WIDTH // 2, 60, center=True)
-        draw_text(screen, f"Ваше HP: {self.player_hp}", 26, GREEN, WIDTH // 2 - 200, 140, center=True)
-        draw_text(screen, f"HP врага: {self.enemy_hp}", 26, RED, WIDTH // 2 + 200, 140, center=True)
+        draw_glyphs(screen, f"Ваше HP: {self.player_hp}", 26, GREEN, *self.PLAYER_POS, center=True)
+        draw_glyphs(screen, f"HP врага: {self.enemy_hp}", 26, RED, *self.ENEMY_POS, center=True)
         y = 220
-        for line in self.log[-6:]:
-            draw_text(screen, line, 22, WHITE, WIDTH // 2, y, center=True)
+        for i in range(max(0, len(self.log) - 6), len(self.log)):
+            draw_glyphs(screen, self.log[i], 22, WHITE, WIDTH // 2, y, center=True)
             y += 28
         if self.player_hp > 0 and self.enemy_hp > 0 and self.turn == "player":
             spell_txt = "F — Заклинание" + (f" ({self.spell_cooldown:.1f}s)" if self.spell_cooldown > 0 else "")
-            q_cd = self.game_state.abilities["q"]["cd"]
-            e_cd = self.game_state.abilities["e"]["cd"]
-            r_cd = self.game_state.abilities["r"]["cd"]
-            q_txt = "Q — Рывок" + (f" ({q_cd:.1f}s)" if q_cd > 0 else "") if self.game_state.abilities["q"]["learned"] else "Q — ???"
-            e_txt = "E — Барьер" + (f" ({e_cd:.1f}s)" if e_cd > 0 else "") if self.game_state.abilities["e"]["learned"] else "E — ???"
-            r_txt = "R — Взрыв" + (f" ({r_cd:.1f}s)" if r_cd > 0 else "") if self.game_state.abilities["r"]["learned"] else "R — ???"
-            draw_text(screen, f"1 — Атака   2 — Зелье   {spell_txt}   {q_txt}   {e_txt}   {r_txt}", 20, LIGHT_GRAY, WIDTH // 2, HEIGHT - 80, center=True)
+            q, e, r = self.game_state.abilities["q"], self.game_state.abilities["e"], self.game_state.abilities["r"]
+            q_cd, e_cd, r_cd = q.cd, e.cd, r.cd
+            q_txt = "Q — Рывок" + (f" ({q_cd:.1f}s)" if q_cd > 0 else "") if q.learned else "Q — ???"
+            e_txt = "E — Барьер" + (f" ({e_cd:.1f}s)" if e_cd > 0 else "") if e.learned else "E — ???"
+            r_txt = "R — Взрыв" + (f" ({r_cd:.1f}s)" if r_cd > 0 else "") if r.learned else "R — ???"
+            draw_glyphs(screen, f"1 — Атака   2 — Зелье   {spell_txt}   {q_txt}   {e_txt}   {r_txt}", 20, LIGHT_GRAY, WIDTH // 2, HEIGHT - 80, center=True)
         else:
             text = "Победа! Нажмите любую клавишу" if self.enemy_hp <= 0 else "Поражение... Нажмите любую клавишу"
             draw_text(screen, text, 22, LIGHT_GRAY, WIDTH // 2, HEIGHT - 80, center=True)
+            if self.player_hp <= 0 and len(self.manager.rewind):
+                draw_text(screen, "Backspace — переиграть ход   Home — начать бой заново", 18, LIGHT_GRAY, WIDTH // 2, HEIGHT - 50, center=True)
 
 
 class DungeonScene(Scene):
@@ -1111,7 +3638,8 @@ class DungeonScene(Scene):
         self.game_state = game_state
         self.game_state.last_location = "dungeon"
         self.player = pygame.Rect(80, HEIGHT - 100, 28, 28)
-        self.player_sprite = load_player_sprite((self.player.width, self.player.height))
+        self._step = pygame.Rect(self.player)
+        self.player_sprite = AnimatedSprite(load_player_animations((self.player.width, self.player.height)))
         self.speed = 240
         self.walls = [
             pygame.Rect(0, 0, WIDTH, 24),
@@ -1126,9 +3654,30 @@ class DungeonScene(Scene):
         self.sentry_right = pygame.Rect(WIDTH - 220, 260, 28, 28)
         self.chest = pygame.Rect(WIDTH - 140, 80, 28, 28)
         self.exit_rect = pygame.Rect(40, HEIGHT - 60, 40, 40)
+        gs = self.game_state
+        self.interaction = InteractionResolver(gs)
+        self.interaction.add(self.guard, 30, "Нажмите E, чтобы сразиться со стражем", lambda: self.fight(
+            enemy_name="Страж", enemy_hp=10, enemy_atk=3, enemy_id="guardian", xp_reward=6), lambda: not gs.guard_defeated)
+        for enemy_id in ("sentry_left", "sentry_right"):
+            self.interaction.add(getattr(self, enemy_id), 28, "Нажмите E, чтобы сразиться с часовым", lambda enemy_id=enemy_id: self.fight(
+                enemy_name="Часовой", enemy_hp=7, enemy_atk=2, enemy_id=enemy_id, xp_reward=4),
+                lambda enemy_id=enemy_id: enemy_id not in gs.defeated_enemies)
+        self.interaction.add(self.chest, 20, "Нажмите E, чтобы открыть сундук", self.open_chest)
+        self.interaction.add(self.exit_rect, 10, "Нажмите E, чтобы уйти",
+                             lambda: self.manager.change(lambda m: OverworldScene(m, self.game_state)))
         self.message = ""
         self.message_timer = 0.0
         self.show_minimap = False
+        self.minimap = Minimap("dungeon", self.game_state, self.walls, [
+            (self.chest, (200, 180, 60)),
+            (self.exit_rect, (120, 100, 80)),
+        ])
+        # Освещение: факелы на стенах, свечение сундука и выхода
+        self.torches = [(120, 40), (WIDTH - 120, 40), (WIDTH // 2, 212), (WIDTH - 60, HEIGHT - 40)]
+        lights = [(pos, 220, (255, 150, 60)) for pos in self.torches]
+        lights.append((self.chest.center, 120, (255, 210, 90)))
+        lights.append((self.exit_rect.center, 140, (150, 220, 160)))
+        self.lighting = DungeonLighting("dungeon", self.walls, lights)
 
     def collide(self, rect: pygame.Rect) -> bool:
         for wall in self.walls:
@@ -1137,52 +3686,29 @@ class DungeonScene(Scene):
         return False
 
     def try_move(self, dx: float, dy: float, dt: float):
-        step_x = pygame.Rect(self.player)
-        step_x.x += int(dx * self.speed * dt)
-        if not self.collide(step_x):
-            self.player = step_x
-        step_y = pygame.Rect(self.player)
-        step_y.y += int(dy * self.speed * dt)
-        if not self.collide(step_y):
-            self.player = step_y
+        self.player_sprite.set_motion(dx, dy)
+        # Пробный шаг — в одном переиспользуемом прямоугольнике, игрок сдвигается на месте
+        step = self._step
+        step.update(self.player)
+        step.x += int(dx * self.speed * dt)
+        if not self.collide(step):
+            self.player.x = step.x
+        step.update(self.player)
+        step.y += int(dy * self.speed * dt)
+        if not self.collide(step):
+            self.player.y = step.y
 
     def handle_event(self, event):
         if event.type == pygame.KEYDOWN and event.key == pygame.K_e:
-            if self.player.colliderect(self.guard.inflate(30, 30)) and not self.game_state.guard_defeated:
-                # Начать бой со стражем
-                self.manager.change(lambda m: CombatScene(m, self.game_state, self, enemy_name="Страж", enemy_hp=10, enemy_atk=3, enemy_id="guardian", xp_reward=6))
-            elif self.player.colliderect(self.sentry_left.inflate(28, 28)) and "sentry_left" not in self.game_state.defeated_enemies:
-                self.manager.change(lambda m: CombatScene(m, self.game_state, self, enemy_name="Часовой", enemy_hp=7, enemy_atk=2, enemy_id="sentry_left", xp_reward=4))
-            elif self.player.colliderect(self.sentry_right.inflate(28, 28)) and "sentry_right" not in self.game_state.defeated_enemies:
-                self.manager.change(lambda m: CombatScene(m, self.game_state, self, enemy_name="Часовой", enemy_hp=7, enemy_atk=2, enemy_id="sentry_right", xp_reward=4))
-            elif self.player.colliderect(self.chest.inflate(20, 20)):
-                # Открытие сундука только после зачистки всех врагов
-                required = {"guardian", "sentry_left", "sentry_right"}
-                cleared = required.issubset(set(self.game_state.defeated_enemies)) or (self.game_state.guard_defeated and "sentry_left" in self.game_state.defeated_enemies and "sentry_right" in self.game_state.defeated_enemies)
-                if cleared:
-                    self.game_state.dungeon_fully_cleared = True
-                    if not self.game_state.artifact_found:
-                        self.game_state.artifact_found = True
-                        self.game_state.artifact_level += 1
-                        self.message = "Вы нашли древний артефакт!"
-                        self.message_timer = 2.0
-                        # Спавн мини-босса у выхода
-                        self.spawn_miniboss()
-                    else:
-                        self.message = "Сундук пуст."
-                        self.message_timer = 1.5
-                else:
-                    self.message = "Сундук запечатан. Победите всех стражей подземелья."
-                    self.message_timer = 2.0
-            elif self.player.colliderect(self.exit_rect.inflate(10, 10)):
-                # Вернуться на поверхность
-                self.manager.change(lambda m: OverworldScene(m, self.game_state))
+            self.interaction.interact(self.player)
         elif event.type == pygame.KEYDOWN and event.key == pygame.K_m:
             self.show_minimap = not self.show_minimap
+        elif event.type == pygame.KEYDOWN and event.key in (pygame.K_F5, pygame.K_F9) and self.manager.save_path is None:
+            self.message = "Сохранения недоступны в сетевой игре."
+            self.message_timer = 2.0
         elif event.type == pygame.KEYDOWN and event.key == pygame.K_F5:
             try:
-                with open("savegame.json", "w", encoding="utf-8") as f:
-                    json.dump(self.game_state.to_dict(), f, ensure_ascii=False, indent=2)
+                save_game_delta(self.game_state, self.manager.save_path)
                 self.message = "Игра сохранена (F5)."
                 self.message_timer = 2.0
             except Exception:
@@ -1190,16 +3716,14 @@ class DungeonScene(Scene):
                 self.message_timer = 2.0
         elif event.type == pygame.KEYDOWN and event.key == pygame.K_F9:
             try:
-                with open("savegame.json", "r", encoding="utf-8") as f:
-                    data = json.load(f)
-                gs = GameState.from_dict(data)
+                gs = load_game(self.manager.save_path)
                 self.manager.change(make_scene_switch("DungeonScene", gs))
             except Exception:
                 self.message = "Загрузка не удалась."
                 self.message_timer = 2.0
 
     def update(self, dt):
-        keys = pygame.key.get_pressed()
+        keys = self.manager.pressed()
         dx = dy = 0
         if keys[pygame.K_LEFT] or keys[pygame.K_a]:
             dx -= 1
@@ -1214,15 +3738,17 @@ class DungeonScene(Scene):
             dx *= inv
             dy *= inv
         self.try_move(dx, dy, dt)
+        self.minimap.reveal(self.player.center)
+        self.interaction.resolve(self.player)
 
         if self.message_timer > 0:
             self.message_timer -= dt
             if self.message_timer <= 0:
                 self.message = ""
 
-        # Если мини-босс создан и не побеждён — возможность столкновения
+        # Если мини-босс создан и не побеждён — бой при столкновении
         if hasattr(self, "miniboss") and not self.game_state.miniboss_defeated:
-            if self.player.colliderect(self.miniboss.inflate(30, 30)):
+            if self.player.colliderect(self.miniboss_zone):
                 def on_win(gs: GameState):
                     gs.miniboss_defeated = True
                 self.manager.change(lambda m: CombatScene(m, self.game_state, self, enemy_name="Лейтенант Теней", enemy_hp=14, enemy_atk=4, enemy_id="miniboss", on_win=on_win, xp_reward=8))
@@ -1230,25 +3756,22 @@ class DungeonScene(Scene):
     def draw(self, screen):
         screen.fill((10, 8, 12))
         # Плитка пола и стены
-        tile_size = 32
-        for x in range(0, WIDTH, tile_size):
-            for y in range(0, HEIGHT, tile_size):
-                rect = pygame.Rect(x, y, tile_size, tile_size)
-                draw_textured_rect(screen, rect, "tiles/dungeon_floor.png", fallback_color=(18, 16, 22))
+        draw_floor(screen, "tiles/dungeon_floor.png", (18, 16, 22))
         for wall in self.walls:
             draw_textured_rect(screen, wall, "tiles/dungeon_wall.png", fallback_color=(60, 60, 80))
         # Выход
         draw_textured_rect(screen, self.exit_rect, "objects/exit.png", fallback_color=(100, 80, 60), border_radius=4)
         draw_text(screen, "Выход", 18, WHITE, self.exit_rect.centerx, self.exit_rect.top - 16, center=True)
         # Страж
-        color_guard = (180, 40, 40) if not self.game_state.guard_defeated else (40, 140, 60)
-        draw_textured_rect(screen, self.guard, "enemies/guardian.png", fallback_color=color_guard, border_radius=4)
+        # Побеждённые враги рисуются запечённым зелёным вариантом
+        tint_guard = DEFEATED_TINT if self.game_state.guard_defeated else None
+        draw_animated_rect(screen, self.guard, "enemies/guardian.png", fallback_color=(180, 40, 40), border_radius=4, tint=tint_guard)
         draw_text(screen, "Страж", 18, WHITE, self.guard.centerx, self.guard.top - 16, center=True)
         # Часовые
-        color_sl = (180, 40, 40) if "sentry_left" not in self.game_state.defeated_enemies else (40, 140, 60)
-        color_sr = (180, 40, 40) if "sentry_right" not in self.game_state.defeated_enemies else (40, 140, 60)
-        draw_textured_rect(screen, self.sentry_left, "enemies/sentry.png", fallback_color=color_sl, border_radius=4)
-        draw_textured_rect(screen, self.sentry_right, "enemies/sentry.png", fallback_color=color_sr, border_radius=4)
+        tint_sl = DEFEATED_TINT if "sentry_left" in self.game_state.defeated_enemies else None
+        tint_sr = DEFEATED_TINT if "sentry_right" in self.game_state.defeated_enemies else None
+        draw_animated_rect(screen, self.sentry_left, "enemies/sentry.png", fallback_color=(180, 40, 40), border_radius=4, tint=tint_sl)
+        draw_animated_rect(screen, self.sentry_right, "enemies/sentry.png", fallback_color=(180, 40, 40), border_radius=4, tint=tint_sr)
         draw_text(screen, "Часовой", 16, WHITE, self.sentry_left.centerx, self.sentry_left.top - 14, center=True)
         draw_text(screen, "Часовой", 16, WHITE, self.sentry_right.centerx, self.sentry_right.top - 14, center=True)
         # Сундук
@@ -1256,23 +3779,18 @@ class DungeonScene(Scene):
         draw_text(screen, "Сундук", 18, WHITE, self.chest.centerx, self.chest.top - 16, center=True)
         # Мини-босс
         if hasattr(self, "miniboss") and not self.game_state.miniboss_defeated:
-            draw_textured_rect(screen, self.miniboss, "enemies/miniboss.png", fallback_color=(200, 80, 200), border_radius=4)
+            draw_animated_rect(screen, self.miniboss, "enemies/miniboss.png", fallback_color=(200, 80, 200), border_radius=4)
             draw_text(screen, "Лейтенант", 16, WHITE, self.miniboss.centerx, self.miniboss.top - 14, center=True)
+        # Факелы
+        for pos in self.torches:
+            draw_circle(screen, (255, 170, 60), pos, 4)
         # Игрок (спрайт)
-        screen.blit(self.player_sprite, self.player.topleft)
-
-        if self.player.colliderect(self.guard.inflate(30, 30)) and not self.game_state.guard_defeated:
-            draw_text(screen, "Нажмите E, чтобы сразиться со стражем", 18, LIGHT_GRAY, WIDTH // 2, HEIGHT - 60, center=True)
-        elif self.player.colliderect(self.sentry_left.inflate(28, 28)) and "sentry_left" not in self.game_state.defeated_enemies:
-            draw_text(screen, "Нажмите E, чтобы сразиться с часовым", 18, LIGHT_GRAY, WIDTH // 2, HEIGHT - 60, center=True)
-        elif self.player.colliderect(self.sentry_right.inflate(28, 28)) and "sentry_right" not in self.game_state.defeated_enemies:
-            draw_text(screen, "Нажмите E, чтобы сразиться с часовым", 18, LIGHT_GRAY, WIDTH // 2, HEIGHT - 60, center=True)
-        elif self.player.colliderect(self.chest.inflate(20, 20)):
-            draw_text(screen, "Нажмите E, чтобы открыть сундук", 18, LIGHT_GRAY, WIDTH // 2, HEIGHT - 60, center=True)
-        elif self.player.colliderect(self.exit_rect.inflate(10, 10)):
-            draw_text(screen, "Нажмите E, чтобы уйти", 18, LIGHT_GRAY, WIDTH // 2, HEIGHT - 60, center=True)
-        elif hasattr(self, "miniboss") and not self.game_state.miniboss_defeated and self.player.colliderect(self.miniboss.inflate(30, 30)):
-            draw_text(screen, "Сразиться с Лейтенантом (подойдите ближе)", 18, LIGHT_GRAY, WIDTH // 2, HEIGHT - 60, center=True)
+        screen.blit(self.player_sprite.image(), self.player.topleft)
+        # Свет и тени поверх мира, но под подсказками и интерфейсом
+        self.lighting.update(self.player.center)
+        self.lighting.apply(screen)
+
+        self.interaction.draw_prompt(screen, self.player)
 
         if self.message:
             draw_text(screen, self.message, 20, YELLOW, WIDTH // 2, 40, center=True)
@@ -1280,28 +3798,45 @@ class DungeonScene(Scene):
             self.draw_minimap(screen)
 
     def draw_minimap(self, screen: pygame.Surface):
-        mw, mh = 180, 100
-        mx, my = WIDTH - mw - 16, 30
-        pygame.draw.rect(screen, (0, 0, 0), (mx - 4, my - 4, mw + 8, mh + 8))
-        pygame.draw.rect(screen, (30, 30, 30), (mx, my, mw, mh))
-        scale_x = mw / WIDTH
-        scale_y = mh / HEIGHT
-        for wall in self.walls:
-            r = pygame.Rect(mx + int(wall.left * scale_x), my + int(wall.top * scale_y), int(wall.width * scale_x), int(wall.height * scale_y))
-            pygame.draw.rect(screen, (70, 70, 90), r)
-        for obj, color in [
-            (self.guard, (200, 60, 60)),
-            (self.chest, (200, 180, 60)),
-            (self.exit_rect, (120, 100, 80)),
-        ]:
-            r = pygame.Rect(mx + int(obj.centerx * scale_x) - 2, my + int(obj.centery * scale_y) - 2, 4, 4)
-            pygame.draw.rect(screen, color, r)
-        pr = pygame.Rect(mx + int(self.player.centerx * scale_x) - 2, my + int(self.player.centery * scale_y) - 2, 4, 4)
-        pygame.draw.rect(screen, (80, 220, 80), pr)
+        # Подвижные метки: только живые враги
+        markers = []
+        if not self.game_state.guard_defeated:
+            markers.append((self.guard, (200, 60, 60)))
+        for enemy_id, rect in (("sentry_left", self.sentry_left), ("sentry_right", self.sentry_right)):
+            if enemy_id not in self.game_state.defeated_enemies:
+                markers.append((rect, (200, 60, 60)))
+        if hasattr(self, "miniboss") and not self.game_state.miniboss_defeated:
+            markers.append((self.miniboss, (200, 80, 200)))
+        self.minimap.draw(screen, markers, self.player)
+
+    def fight(self, **enemy):
+        self.manager.change(lambda m: CombatScene(m, self.game_state, self, **enemy))
+
+    def open_chest(self):
+        # Открытие сундука только после зачистки всех врагов
+        required = {"guardian", "sentry_left", "sentry_right"}
+        cleared = required.issubset(set(self.game_state.defeated_enemies)) or (self.game_state.guard_defeated and "sentry_left" in self.game_state.defeated_enemies and "sentry_right" in self.game_state.defeated_enemies)
+        if cleared:
+            self.game_state.dungeon_fully_cleared = True
+            if not self.game_state.artifact_found:
+                self.game_state.artifact_found = True
+                self.game_state.artifact_level += 1
+                self.message = "Вы нашли древний артефакт!"
+                AUDIO.play("chest")
+                self.message_timer = 2.0
+                # Спавн мини-босса у выхода
+                self.spawn_miniboss()
+            else:
+                self.message = "Сундук пуст."
+                self.message_timer = 1.5
+        else:
+            self.message = "Сундук запечатан. Победите всех стражей подземелья."
+            self.message_timer = 2.0
 
     def spawn_miniboss(self):
-        # Появляется у выхода
+        # Появляется у выхода; бой начинается при касании, без E
         self.miniboss = pygame.Rect(self.exit_rect.centerx - 16, self.exit_rect.top - 48, 32, 32)
+        self.miniboss_zone = self.miniboss.inflate(30, 30)
 
 
 class FieldsScene(Scene):
@@ -1310,7 +3845,8 @@ class FieldsScene(Scene):
         self.game_state = game_state
         self.game_state.last_location = "fields"
         self.player = pygame.Rect(WIDTH - 100, HEIGHT // 2, 28, 28)
-        self.player_sprite = load_player_sprite((self.player.width, self.player.height))
+        self._step = pygame.Rect(self.player)
+        self.player_sprite = AnimatedSprite(load_player_animations((self.player.width, self.player.height)))
         self.speed = 260
         self.walls = [
             pygame.Rect(0, 0, WIDTH, 24),
@@ -1340,6 +3876,27 @@ class FieldsScene(Scene):
             pygame.Rect(680, 280, 22, 22),
         ]
         self.active_checkpoint = 0
+        # Запись текущего забега и воспроизведение лучшего
+        self.recorder: GhostRecorder | None = None
+        self.ghost: GhostPlayer | None = None
+        self.ghost_image: pygame.Surface | None = None
+        self.checkpoint_zones = [cp.inflate(10, 10) for cp in self.checkpoints]
+        gs = self.game_state
+        self.interaction = InteractionResolver(gs)
+        self.interaction.add(self.herbalist, 30, "Нажмите E, чтобы говорить с травником", self.talk_herbalist)
+        self.interaction.add(self.exit_gate, 20, "Нажмите E, чтобы вернуться в город",
+                             lambda: self.manager.change(make_scene_switch("OverworldScene", self.game_state)))
+        for i, node in enumerate(self.herb_nodes):
+            self.interaction.add(node, 20, "Нажмите E, чтобы собрать травы", lambda i=i: self.collect_herb(i),
+                                 lambda i=i: i not in self.collected)
+        # Старт/рестарт забега у первой точки
+        self.interaction.add(self.checkpoints[0], 20, "Нажмите E у стартовой точки, чтобы начать забег", self.start_trial,
+                             lambda: not gs.trial_active and not gs.trial_completed)
+        self.minimap = Minimap("fields", self.game_state, self.walls, [
+            (self.herbalist, (100, 160, 240)),
+            (self.exit_gate, (100, 200, 100)),
+            (self.checkpoints[0], (200, 200, 80)),
+        ], wall_color=(70, 90, 70))
 
     def collide(self, rect: pygame.Rect) -> bool:
         for wall in self.walls:
@@ -1348,39 +3905,29 @@ class FieldsScene(Scene):
         return False
 
     def try_move(self, dx: float, dy: float, dt: float):
-        step_x = pygame.Rect(self.player)
-        step_x.x += int(dx * self.speed * dt)
-        if not self.collide(step_x):
-            self.player = step_x
-        step_y = pygame.Rect(self.player)
-        step_y.y += int(dy * self.speed * dt)
-        if not self.collide(step_y):
-            self.player = step_y
+        self.player_sprite.set_motion(dx, dy)
+        # Пробный шаг — в одном переиспользуемом прямоугольнике, игрок сдвигается на месте
+        step = self._step
+        step.update(self.player)
+        step.x += int(dx * self.speed * dt)
+        if not self.collide(step):
+            self.player.x = step.x
+        step.update(self.player)
+        step.y += int(dy * self.speed * dt)
+        if not self.collide(step):
+            self.player.y = step.y
 
     def handle_event(self, event):
         if event.type == pygame.KEYDOWN and event.key == pygame.K_e:
-            if self.player.colliderect(self.herbalist.inflate(30, 30)):
-                self.talk_herbalist()
-            elif self.player.colliderect(self.exit_gate.inflate(20, 20)):
-                self.manager.change(make_scene_switch("OverworldScene", self.game_state))
-            else:
-                # Сбор травы
-                for i, node in enumerate(self.herb_nodes):
-                    if i not in self.collected and self.player.colliderect(node.inflate(20, 20)):
-                        self.collected.add(i)
-                        self.game_state.herbs += 1
-                        self.message = "Вы собрали травы (+1)"
-                        self.message_timer = 1.5
-                        break
-                # Старт/рестарт забега у первой точки
-                if self.player.colliderect(self.checkpoints[0].inflate(20, 20)) and not self.game_state.trial_active and not self.game_state.trial_completed:
-                    self.start_trial()
+            self.interaction.interact(self.player)
         elif event.type == pygame.KEYDOWN and event.key == pygame.K_m:
             self.show_minimap = not self.show_minimap
+        elif event.type == pygame.KEYDOWN and event.key in (pygame.K_F5, pygame.K_F9) and self.manager.save_path is None:
+            self.message = "Сохранения недоступны в сетевой игре."
+            self.message_timer = 2.0
         elif event.type == pygame.KEYDOWN and event.key == pygame.K_F5:
             try:
-                with open("savegame.json", "w", encoding="utf-8") as f:
-                    json.dump(self.game_state.to_dict(), f, ensure_ascii=False, indent=2)
+                save_game_delta(self.game_state, self.manager.save_path)
                 self.message = "Игра сохранена (F5)."
                 self.message_timer = 2.0
             except Exception:
@@ -1388,40 +3935,24 @@ class FieldsScene(Scene):
                 self.message_timer = 2.0
         elif event.type == pygame.KEYDOWN and event.key == pygame.K_F9:
             try:
-                with open("savegame.json", "r", encoding="utf-8") as f:
-                    data = json.load(f)
-                gs = GameState.from_dict(data)
+                gs = load_game(self.manager.save_path)
                 self.manager.change(make_scene_switch("FieldsScene", gs))
             except Exception:
                 self.message = "Загрузка не удалась."
                 self.message_timer = 2.0
 
+    def collect_herb(self, i: int):
+        self.collected.add(i)
+        self.interaction.invalidate()
+        self.game_state.herbs += 1
+        self.message = "Вы собрали травы (+1)"
+        self.message_timer = 1.5
+
     def talk_herbalist(self):
-        def on_choice(choice_id: int):
-            if choice_id == 0:
-                if self.game_state.herbs >= 3 and not self.game_state.companion_joined:
-                    self.game_state.herbs -= 3
-                    self.game_state.companion_joined = True
-                    self.message = "Травник присоединился как спутник!"
-                    self.message_timer = 2.0
-                else:
-                    self.message = "Недостаточно трав или спутник уже с вами."
-                    self.message_timer = 2.0
-            elif choice_id == 1:
-                if self.game_state.herbs >= 1:
-                    self.game_state.herbs -= 1
-                    self.game_state.potions += 1
-                    self.message = "Травник приготовил зелье из трав."
-                    self.message_timer = 2.0
-                else:
-                    self.message = "Нет трав для зелья."
-                    self.message_timer = 2.0
-        text = "Травник: Травы редки. Принесёшь три — отправлюсь с тобой, или сделаю зелье."
-        choices = [("Попросить спутничества (3 травы)", 0), ("Сделать зелье (1 трава)", 1), ("Ничего", 2)]
-        self.manager.change(lambda m: DialogueScene(m, text, choices, on_choice, self))
+        self.manager.change(lambda m: DialogueScene.conversation(m, "herbalist", self.game_state, self))
 
     def update(self, dt):
-        keys = pygame.key.get_pressed()
+        keys = self.manager.pressed()
         dx = dy = 0
         if keys[pygame.K_LEFT] or keys[pygame.K_a]:
             dx -= 1
@@ -1436,6 +3967,8 @@ class FieldsScene(Scene):
             dx *= inv
             dy *= inv
         self.try_move(dx, dy, dt)
+        self.minimap.reveal(self.player.center)
+        self.interaction.resolve(self.player)
 
         if self.message_timer > 0:
             self.message_timer -= dt
@@ -1445,9 +3978,13 @@ class FieldsScene(Scene):
         # Логика забега на время
         if self.game_state.trial_active:
             self.game_state.trial_time_left = max(0.0, self.game_state.trial_time_left - dt)
+            if self.recorder is not None:
+                self.recorder.tick(dt, self.player.topleft)
+            if self.ghost is not None:
+                self.ghost.advance(dt)
             # Проверка чекпоинта
             if self.active_checkpoint < len(self.checkpoints):
-                if self.player.colliderect(self.checkpoints[self.active_checkpoint].inflate(10, 10)):
+                if self.player.colliderect(self.checkpoint_zones[self.active_checkpoint]):
                     self.active_checkpoint += 1
                     self.message = f"Чекпоинт {self.active_checkpoint}/{len(self.checkpoints)}!"
                     self.message_timer = 1.5
@@ -1456,29 +3993,38 @@ class FieldsScene(Scene):
                 self.game_state.trial_active = False
                 self.game_state.trial_completed = True
                 self.game_state.gold += 8
+                TELEMETRY.emit("trial", completed=True, time_left=round(self.game_state.trial_time_left, 2))
+                level_before = self.game_state.level
                 self.game_state.grant_xp(5)
+                if self.game_state.level > level_before:
+                    emit_level_up(self)
                 self.message = "Забег пройден! Награда получена."
                 self.message_timer = 2.0
+                if self.recorder is not None:
+                    try:
+                        if save_ghost(self.recorder.track(TRIAL_DURATION - self.game_state.trial_time_left)):
+                            self.message = "Забег пройден! Новый рекорд — призрак сохранён."
+                    except OSError:
+                        pass
+                self.recorder = self.ghost = None
             elif self.game_state.trial_time_left <= 0:
                 # Провал
                 self.game_state.trial_active = False
+                self.recorder = self.ghost = None
+                TELEMETRY.emit("trial", completed=False, time_left=0.0)
                 self.message = "Время вышло! Попробуйте снова."
                 self.message_timer = 2.0
 
     def draw(self, screen):
         screen.fill((18, 26, 18))
         # Плитка пола и стены
-        tile_size = 32
-        for x in range(0, WIDTH, tile_size):
-            for y in range(0, HEIGHT, tile_size):
-                rect = pygame.Rect(x, y, tile_size, tile_size)
-                draw_textured_rect(screen, rect, "tiles/fields_floor.png", fallback_color=(20, 34, 20))
+        draw_floor(screen, "tiles/fields_floor.png", (20, 34, 20))
         for wall in self.walls:
             draw_textured_rect(screen, wall, "tiles/fields_wall.png", fallback_color=(40, 70, 40))
         # Объекты
         draw_textured_rect(screen, self.exit_gate, "objects/gate.png", fallback_color=(100, 200, 100), border_radius=4)
         draw_text(screen, "К городу", 18, WHITE, self.exit_gate.centerx, self.exit_gate.top - 16, center=True)
-        draw_textured_rect(screen, self.herbalist, "characters/herbalist.png", fallback_color=(100, 160, 240), border_radius=4)
+        draw_animated_rect(screen, self.herbalist, "characters/herbalist.png", fallback_color=(100, 160, 240), border_radius=4)
         draw_text(screen, "Травник", 18, WHITE, self.herbalist.centerx, self.herbalist.top - 16, center=True)
         # Травы
         for i, node in enumerate(self.herb_nodes):
@@ -1488,24 +4034,16 @@ class FieldsScene(Scene):
         for i, cp in enumerate(self.checkpoints):
             color = (200, 200, 80) if i == self.active_checkpoint and self.game_state.trial_active else (120, 120, 60)
             draw_textured_rect(screen, cp, "objects/checkpoint.png", fallback_color=color, border_radius=4)
+        # Призрак лучшего забега под игроком
+        if self.ghost is not None and not self.ghost.finished:
+            screen.blit(self.ghost_image, self.ghost.position())
         # Игрок (спрайт)
-        screen.blit(self.player_sprite, self.player.topleft)
+        screen.blit(self.player_sprite.image(), self.player.topleft)
 
-        if self.player.colliderect(self.herbalist.inflate(30, 30)):
-            draw_text(screen, "Нажмите E, чтобы говорить с травником", 18, LIGHT_GRAY, WIDTH // 2, HEIGHT - 60, center=True)
-        elif self.player.colliderect(self.exit_gate.inflate(20, 20)):
-            draw_text(screen, "Нажмите E, чтобы вернуться в город", 18, LIGHT_GRAY, WIDTH // 2, HEIGHT - 60, center=True)
-        else:
-            for i, node in enumerate(self.herb_nodes):
-                if i not in self.collected and self.player.colliderect(node.inflate(20, 20)):
-                    draw_text(screen, "Нажмите E, чтобы собрать травы", 18, LIGHT_GRAY, WIDTH // 2, HEIGHT - 60, center=True)
-                    break
-            if not self.game_state.trial_completed:
-                if self.player.colliderect(self.checkpoints[0].inflate(20, 20)) and not self.game_state.trial_active:
-                    draw_text(screen, "Нажмите E у стартовой точки, чтобы начать забег", 18, LIGHT_GRAY, WIDTH // 2, HEIGHT - 60, center=True)
+        self.interaction.draw_prompt(screen, self.player)
 
         if self.game_state.trial_active:
-            draw_text(screen, f"Забег — время: {self.game_state.trial_time_left:.1f}s", 20, YELLOW, WIDTH // 2, 40, center=True)
+            draw_glyphs(screen, f"Забег — время: {self.game_state.trial_time_left:.1f}s", 20, YELLOW, WIDTH // 2, 40, center=True)
 
         if self.message:
             draw_text(screen, self.message, 20, YELLOW, WIDTH // 2, 40, center=True)
@@ -1514,60 +4052,1779 @@ class FieldsScene(Scene):
             self.draw_minimap(screen)
 
     def draw_minimap(self, screen: pygame.Surface):
-        mw, mh = 180, 100
-        mx, my = WIDTH - mw - 16, 30
-        pygame.draw.rect(screen, (0, 0, 0), (mx - 4, my - 4, mw + 8, mh + 8))
-        pygame.draw.rect(screen, (30, 30, 30), (mx, my, mw, mh))
-        scale_x = mw / WIDTH
-        scale_y = mh / HEIGHT
-        for wall in self.walls:
-            r = pygame.Rect(mx + int(wall.left * scale_x), my + int(wall.top * scale_y), int(wall.width * scale_x), int(wall.height * scale_y))
-            pygame.draw.rect(screen, (70, 90, 70), r)
-        for node in self.herb_nodes:
-            r = pygame.Rect(mx + int(node.centerx * scale_x) - 2, my + int(node.centery * scale_y) - 2, 4, 4)
-            pygame.draw.rect(screen, (120, 220, 120), r)
-        for obj, color in [
-            (self.herbalist, (100, 160, 240)),
-            (self.exit_gate, (100, 200, 100)),
-            (self.checkpoints[0], (200, 200, 80)),
-        ]:
-            r = pygame.Rect(mx + int(obj.centerx * scale_x) - 2, my + int(obj.centery * scale_y) - 2, 4, 4)
-            pygame.draw.rect(screen, color, r)
+        # Подвижные метки: только несобранные травы
+        herbs = [(node, (120, 220, 120)) for i, node in enumerate(self.herb_nodes) if i not in self.collected]
+        self.minimap.draw(screen, herbs, self.player)
+
     def start_trial(self):
         self.game_state.trial_active = True
-        self.game_state.trial_time_left = 20.0
+        self.game_state.trial_time_left = TRIAL_DURATION
         self.game_state.trial_stage = 0
         self.active_checkpoint = 0
         self.message = "Забег начат! Доберитесь до всех чекпоинтов."
         self.message_timer = 2.0
+        if self.manager.headless:
+            return  # боты и сервер призраков не пишут
+        self.recorder = GhostRecorder(self.player.topleft)
+        best = load_ghost()
+        self.ghost = GhostPlayer(best) if best is not None else None
+        if self.ghost is not None and self.ghost_image is None:
+            self.bake_ghost_image()
+        if best is not None:
+            self.message = f"Забег начат! Рекорд призрака: {best.time:.1f}s"
+
+    def bake_ghost_image(self):
+        # Полупрозрачная копия спрайта запекается один раз
+        self.ghost_image = load_player_animations(self.player.size)["idle_down"].frames[0].copy()
+        self.ghost_image.fill((255, 255, 255, GHOST_ALPHA), special_flags=pygame.BLEND_RGBA_MULT)
+
+    def assets_reloaded(self, names):
+        if self.ghost_image is not None and not names.isdisjoint(PLAYER_ASSETS):
+            self.bake_ghost_image()
+
+
+# ---------- Headless-сервер ----------
+# Много независимых сессий (SceneManager + GameState) без окна в одном процессе asyncio.
+# Все сессии тикаются одной задачей с фиксированной частотой; ввод и состояние ходят
+# по локальному сокету (TCP на 127.0.0.1 или unix-сокет) компактными бинарными кадрами:
+#   клиент -> сервер: INPUT_FRAME  b"D"/b"U" + код клавиши (нажата/отпущена)
+#   сервер -> клиент: b"H" + id сессии при подключении, затем STATE_FRAME при изменениях
+# Кадр состояния полный, поэтому клиенту, который не успевает читать, кадры не копятся: пока
+# в буфере сокета больше SERVER_WRITE_HIGH_WATER, новые не пишутся, а после разгрузки уйдёт
+# только последнее состояние. Не читает дольше SERVER_STALL_SECONDS — сессия закрывается.
+SERVER_TICK_RATE = 30
+INPUT_FRAME = struct.Struct("<cI")
+HELLO_FRAME = struct.Struct("<cI")
+STATE_FRAME = struct.Struct("<cIBhhIIhiHIHHH")
+SERVER_WRITE_HIGH_WATER = 32 * STATE_FRAME.size
+SERVER_STALL_SECONDS = 10.0
+STATE_FIELDS = ("tick", "scene", "x", "y", "flags", "version", "honor", "gold", "level", "xp", "potions", "herbs", "run_number")
+SCENE_CODES = ("TitleScene", "OverworldScene", "DialogueScene", "QuestLogScene", "SkillCheckScene",
+               "EndingScene", "CombatScene", "DungeonScene", "FieldsScene")
+_SCENE_CODE = {name: i for i, name in enumerate(SCENE_CODES)}
+
+
+def ensure_headless_display():
+    # Для convert()/convert_alpha() нужен режим экрана; без окна — драйвер dummy
+    if not pygame.display.get_init() or pygame.display.get_surface() is None:
+        os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+        pygame.display.init()
+        pygame.display.set_mode((1, 1))
+
+
+class GameSession:
+    def __init__(self, session_id: int, start_scene_factory=None):
+        self.session_id = session_id
+        self._game_state = GameState()
+        factory = start_scene_factory or (lambda m: OverworldScene(m, self._game_state))
+        self.manager = SceneManager(factory, headless=True)
+        self.inbox: list[tuple[bytes, int]] = []
+        self.tick_count = 0
+        self.tick_time = 0.0
+        self.tick_time_max = 0.0
+        self._last_state: tuple | None = None
+
+    @property
+    def game_state(self) -> GameState:
+        # Состояние живёт в сцене: новая игра или перемотка подменяют объект целиком
+        scene_state = getattr(self.manager.current, "game_state", None)
+        if scene_state is not None:
+            self._game_state = scene_state
+        return self._game_state
+
+    def push_input(self, op: bytes, key: int):
+        self.inbox.append((op, key))
+
+    def tick(self, dt: float):
+        start = time.perf_counter()
+        held = self.manager.held_keys
+        for op, key in self.inbox:
+            if op == b"D":
+                held.down.add(key)
+                self.manager.handle_event(pygame.event.Event(pygame.KEYDOWN, key=key, mod=0, unicode=""))
+            else:
+                held.down.discard(key)
+                self.manager.handle_event(pygame.event.Event(pygame.KEYUP, key=key, mod=0, unicode=""))
+        self.inbox.clear()
+        self.manager.update(dt)
+        self.tick_count += 1
+        cost = time.perf_counter() - start
+        self.tick_time += cost
+        if cost > self.tick_time_max:
+            self.tick_time_max = cost
+
+    def state_frame(self) -> bytes | None:
+        # Кадр состояния, только если что-то изменилось с прошлой отправки
+        scene = self.manager.current
+        player = getattr(scene, "player", None)
+        x, y = (player.x, player.y) if player is not None else (-1, -1)
+        gs = self.game_state
+        key = (_SCENE_CODE.get(type(scene).__name__, 255), x, y, id(gs), gs.version)
+        if key == self._last_state:
+            return None
+        self._last_state = key
+        return STATE_FRAME.pack(b"S", self.tick_count, key[0], x, y, gs._flags, gs.version, gs.honor, gs.gold,
+                                gs.level, gs.xp, gs.potions, gs.herbs, gs.run_number)
+
+    def stats(self) -> dict:
+        return {
+            "ticks": self.tick_count,
+            "avg_ms": self.tick_time / self.tick_count * 1000 if self.tick_count else 0.0,
+            "max_ms": self.tick_time_max * 1000,
+        }
+
+
+class GameServer:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, path: str | None = None, tick_rate: int = SERVER_TICK_RATE, start_scene_factory=None):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.tick_rate = tick_rate
+        self.start_scene_factory = start_scene_factory
+        self.sessions: dict[int, GameSession] = {}
+        self._writers: dict[int, asyncio.StreamWriter] = {}
+        self._next_id = 1
+        self._server: asyncio.AbstractServer | None = None
+        self._ticker: asyncio.Task | None = None
+        self._stalled: dict[int, int] = {}  # id сессии -> тиков подряд с переполненным буфером
+        self.tick_overruns = 0
+        self.frames_coalesced = 0
+        self.stall_disconnects = 0
+
+    async def start(self):
+        ensure_headless_display()
+        if self.path:
+            self._server = await asyncio.start_unix_server(self._handle, path=self.path)
+        else:
+            self._server = await asyncio.start_server(self._handle, self.host, self.port)
+            self.port = self._server.sockets[0].getsockname()[1]
+        self._ticker = asyncio.create_task(self._run_ticks())
+
+    async def stop(self):
+        if self._ticker:
+            self._ticker.cancel()
+            try:
+                await self._ticker
+            except asyncio.CancelledError:
+                pass
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+        for writer in list(self._writers.values()):
+            writer.close()
+
+    def open_session(self) -> GameSession:
+        session = GameSession(self._next_id, self.start_scene_factory)
+        self.sessions[session.session_id] = session
+        self._next_id += 1
+        return session
+
+    def close_session(self, session_id: int):
+        self.sessions.pop(session_id, None)
+        self._writers.pop(session_id, None)
+        self._stalled.pop(session_id, None)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        session = self.open_session()
+        self._writers[session.session_id] = writer
+        writer.write(HELLO_FRAME.pack(b"H", session.session_id))
+        try:
+            while True:
+                data = await reader.readexactly(INPUT_FRAME.size)
+                op, key = INPUT_FRAME.unpack(data)
+                session.push_input(op, key)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.close_session(session.session_id)
+            writer.close()
+
+    async def _run_ticks(self):
+        # Фиксированный шаг; если тик не уложился в период, следующий идёт сразу
+        loop = asyncio.get_running_loop()
+        period = 1.0 / self.tick_rate
+        stall_ticks = int(SERVER_STALL_SECONDS * self.tick_rate)
+        next_tick = loop.time()
+        while True:
+            for session in list(self.sessions.values()):
+                session.tick(period)
+                writer = self._writers.get(session.session_id)
+                if session.manager.quit_requested:
+                    self.close_session(session.session_id)
+                    if writer:
+                        writer.close()
+                    continue
+                if not writer or writer.is_closing():
+                    continue
+                if writer.transport.get_write_buffer_size() > SERVER_WRITE_HIGH_WATER:
+                    # Состояние не берём: после разгрузки state_frame отдаст разницу с отправленным
+                    stalled = self._stalled[session.session_id] = self._stalled.get(session.session_id, 0) + 1
+                    self.frames_coalesced += 1
+                    if stalled >= stall_ticks:
+                        self.stall_disconnects += 1
+                        self.close_session(session.session_id)
+                        writer.transport.abort()
+                    continue
+                self._stalled.pop(session.session_id, None)
+                frame = session.state_frame()
+                if frame:
+                    writer.write(frame)
+            next_tick += period
+            delay = next_tick - loop.time()
+            if delay < 0:
+                self.tick_overruns += 1
+                next_tick = loop.time()
+                delay = 0
+            await asyncio.sleep(delay)
+
+    def stats(self) -> dict:
+        per_session = {sid: s.stats() for sid, s in self.sessions.items()}
+        total = sum(s.tick_time for s in self.sessions.values())
+        return {"sessions": len(self.sessions), "overruns": self.tick_overruns, "tick_seconds": total,
+                "coalesced": self.frames_coalesced, "stall_disconnects": self.stall_disconnects, "per_session": per_session}
+
+
+class HeadlessClient:
+    # Локальный клиент для ботов и проверки сервера
+    def __init__(self):
+        self.reader: asyncio.StreamReader | None = None
+        self.writer: asyncio.StreamWriter | None = None
+        self.session_id = 0
+
+    async def connect(self, host: str = "127.0.0.1", port: int = 0, path: str | None = None):
+        if path:
+            self.reader, self.writer = await asyncio.open_unix_connection(path)
+        else:
+            self.reader, self.writer = await asyncio.open_connection(host, port)
+        _, self.session_id = HELLO_FRAME.unpack(await self.reader.readexactly(HELLO_FRAME.size))
+
+    async def key(self, key: int, down: bool = True):
+        self.writer.write(INPUT_FRAME.pack(b"D" if down else b"U", key))
+        await self.writer.drain()
+
+    async def tap(self, key: int):
+        await self.key(key, True)
+        await self.key(key, False)
+
+    async def read_state(self) -> dict:
+        values = STATE_FRAME.unpack(await self.reader.readexactly(STATE_FRAME.size))
+        state = dict(zip(STATE_FIELDS, values[1:]))
+        state["scene"] = SCENE_CODES[state["scene"]] if state["scene"] < len(SCENE_CODES) else None
+        return state
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+
+
+def run_server(host: str = "127.0.0.1", port: int = 7777, path: str | None = None, tick_rate: int = SERVER_TICK_RATE):
+    async def serve():
+        server = GameServer(host, port, path, tick_rate)
+        await server.start()
+        print(f"Сервер запущен: {path or f'{host}:{server.port}'}, {tick_rate} тиков/с")
+        try:
+            while True:
+                await asyncio.sleep(10)
+                stats = server.stats()
+                print(f"Сессий: {stats['sessions']}, время тиков: {stats['tick_seconds']:.2f}s, опозданий: {stats['overruns']}")
+        finally:
+            await server.stop()
+
+    pygame.init()
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    pygame.quit()
+
+
+# ---------- Ферма прохождений ----------
+# Скриптовый бот проходит игру без окна (мир -> поля -> подземелье -> концовка) через те же
+# обработчики ввода, что и игрок; прохождения раскидываются по всем ядрам пулом процессов,
+# у каждого свой seed, результаты сводятся в один отчёт.
+FARM_DT = 1.0 / 60
+FARM_MAX_RETRIES = 20
+FARM_MILESTONES = ("start", "npc", "fields", "shop", "beast", "key", "guardian", "sentry_left", "sentry_right", "artifact", "miniboss", "end")
+
+
+class PlaythroughBot:
+    def __init__(self, seed: int):
+        random.seed(seed)  # случайность самой игры
+        self.seed = seed
+        self.rng = random.Random(seed ^ 0x5EED)  # решения бота
+        self.game_state = GameState()
+        self.manager = SceneManager(lambda m: OverworldScene(m, self.game_state), headless=True)
+        self.sim_time = 0.0
+        self.deaths = 0
+        self.combats = 0
+        self.level_at_miniboss: int | None = None
+        self.curve: list[tuple[str, float, int, int, int]] = []
+
+    @property
+    def scene(self) -> Scene:
+        return self.manager.current
+
+    def mark(self, milestone: str):
+        gs = self.game_state
+        self.curve.append((milestone, round(self.sim_time, 3), gs.gold, gs.level, gs.xp))
+
+    def tick(self, frames: int = 1):
+        for _ in range(frames):
+            self.manager.update(FARM_DT)
+            self.sim_time += FARM_DT
+
+    def press(self, key: int):
+        self.manager.handle_event(pygame.event.Event(pygame.KEYDOWN, key=key, mod=0, unicode=""))
+        self.tick()
+
+    def interact(self, target: pygame.Rect):
+        # Бот не ищет путь: встаёт на объект и нажимает E
+        self.scene.player.center = target.center
+        self.press(pygame.K_e)
+
+    def choose(self, index: int):
+        if isinstance(self.scene, DialogueScene):
+            for _ in range(index):
+                self.press(pygame.K_DOWN)
+            self.press(pygame.K_RETURN)
+
+    def fight(self):
+        # Простая тактика: зелье при низком HP, затем способности, заклинание, обычная атака
+        while isinstance(self.scene, CombatScene):
+            combat = self.scene
+            if combat.player_hp <= 0 or combat.enemy_hp <= 0:
+                self.combats += 1
+                if combat.player_hp <= 0:
+                    self.deaths += 1
+                self.press(pygame.K_ESCAPE)
+                return combat.enemy_hp <= 0
+            if combat.turn != "player":
+                self.tick()
+                continue
+            abilities = self.game_state.abilities
+            if combat.player_hp <= max(3, combat.enemy_atk) and self.game_state.potions > 0:
+                self.press(pygame.K_2)
+            elif abilities["r"].ready():
+                self.press(pygame.K_r)
+            elif abilities["q"].ready():
+                self.press(pygame.K_q)
+            elif combat.spell_cooldown <= 0.0:
+                self.press(pygame.K_f)
+            else:
+                self.press(pygame.K_1)
+            self.tick()
+        return False
+
+    def fight_until_won(self, start_fight) -> bool:
+        for _ in range(FARM_MAX_RETRIES):
+            start_fight()
+            if not isinstance(self.scene, CombatScene):
+                return False
+            if self.fight():
+                return True
+        return False
+
+    def visit_fields(self):
+        self.interact(self.scene.fields_gate)
+        fields = self.scene
+        for node in fields.herb_nodes:
+            self.interact(node)
+        if self.game_state.herbs >= 3 and self.rng.random() < 0.7:
+            self.interact(fields.herbalist)
+            self.choose(0)
+        self.interact(fields.exit_gate)
+        self.mark("fields")
+
+    def play(self) -> dict:
+        started = time.perf_counter()
+        self.mark("start")
+        for _ in range(self.rng.randint(1, 3)):
+            self.interact(self.scene.npc)
+            self.choose(self.rng.choice((0, 0, 1, 2)))
+        self.mark("npc")
+        if self.rng.random() < 0.5:
+            self.visit_fields()
+        if self.rng.random() < 0.6:
+            self.interact(self.scene.altar)
+            self.choose(self.rng.randrange(3))
+        if self.game_state.gold >= 5:
+            self.interact(self.scene.shop)
+            self.choose(1 if self.game_state.gold >= 8 else 0)
+            self.mark("shop")
+        # Скилл-чек против зверя: жмём пробел в случайный момент
+        for _ in range(FARM_MAX_RETRIES):
+            self.interact(self.scene.door)
+            if not isinstance(self.scene, SkillCheckScene):
+                break
+            self.tick(self.rng.randrange(10, 120))
+            self.press(pygame.K_SPACE)
+            self.press(pygame.K_SPACE)
+            if self.game_state.beast_defeated:
+                break
+        if self.game_state.beast_defeated:
+            self.mark("beast")
+            if self.rng.random() < 0.25:
+                self.interact(self.scene.thief)
+                self.choose(0)
+            else:
+                self.interact(self.scene.door)
+                self.choose(0)
+            self.mark("key")
+            self.interact(self.scene.door)
+        if isinstance(self.scene, DungeonScene):
+            dungeon = self.scene
+            for enemy_id, rect in (("guardian", dungeon.guard), ("sentry_left", dungeon.sentry_left), ("sentry_right", dungeon.sentry_right)):
+                if self.fight_until_won(lambda rect=rect: self.interact(rect)):
+                    self.mark(enemy_id)
+            self.interact(dungeon.chest)
+            if self.game_state.artifact_found:
+                self.mark("artifact")
+                self.level_at_miniboss = self.game_state.level
+
+                def approach_miniboss():
+                    dungeon.player.center = dungeon.miniboss.center
+                    self.tick()
+                if self.fight_until_won(approach_miniboss):
+                    self.mark("miniboss")
+        text, _ = current_ending(self.game_state)
+        self.mark("end")
+        return {
+            "seed": self.seed,
+            "ending": text.split("\n")[0],
+            "gold": self.game_state.gold,
+            "level": self.game_state.level,
+            "level_at_miniboss": self.level_at_miniboss,
+            "deaths": self.deaths,
+            "combats": self.combats,
+            "sim_time": self.sim_time,
+            "wall_time": time.perf_counter() - started,
+            "curve": self.curve,
+        }
+
+
+def _farm_worker_init():
+    ensure_headless_display()
+
+
+def run_playthrough(seed: int) -> dict:
+    ensure_headless_display()
+    return PlaythroughBot(seed).play()
+
+
+def aggregate_playthroughs(results: list[dict]) -> dict:
+    def mean(values):
+        values = [v for v in values if v is not None]
+        return sum(values) / len(values) if values else None
+
+    endings: dict[str, int] = {}
+    levels_at_miniboss: dict[int, int] = {}
+    for res in results:
+        endings[res["ending"]] = endings.get(res["ending"], 0) + 1
+        if res["level_at_miniboss"] is not None:
+            levels_at_miniboss[res["level_at_miniboss"]] = levels_at_miniboss.get(res["level_at_miniboss"], 0) + 1
+    # Кривые золота/уровня: среднее по каждой вехе среди прохождений, дошедших до неё
+    curves = {}
+    for milestone in FARM_MILESTONES:
+        points = [p for res in results for p in res["curve"] if p[0] == milestone]
+        if points:
+            curves[milestone] = {
+                "reached": len(points),
+                "time": mean(p[1] for p in points),
+                "gold": mean(p[2] for p in points),
+                "level": mean(p[3] for p in points),
+                "xp": mean(p[4] for p in points),
+            }
+    return {
+        "runs": len(results),
+        "endings": dict(sorted(endings.items(), key=lambda kv: -kv[1])),
+        "level_at_miniboss": dict(sorted(levels_at_miniboss.items())),
+        "deaths_mean": mean(r["deaths"] for r in results),
+        "deaths_total": sum(r["deaths"] for r in results),
+        "combats_mean": mean(r["combats"] for r in results),
+        "gold_mean": mean(r["gold"] for r in results),
+        "level_mean": mean(r["level"] for r in results),
+        "sim_time_mean": mean(r["sim_time"] for r in results),
+        "wall_time_mean": mean(r["wall_time"] for r in results),
+        "curves": curves,
+    }
+
+
+def run_farm(runs: int, workers: int | None = None, base_seed: int = 0) -> dict:
+    from concurrent.futures import ProcessPoolExecutor
+
+    workers = workers or os.cpu_count() or 1
+    seeds = range(base_seed, base_seed + runs)
+    started = time.perf_counter()
+    if workers == 1:
+        results = [run_playthrough(seed) for seed in seeds]
+    else:
+        # Крупные порции заданий — меньше накладных расходов на обмен между процессами
+        chunk = max(1, runs // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers, initializer=_farm_worker_init) as pool:
+            results = list(pool.map(run_playthrough, seeds, chunksize=chunk))
+    report = aggregate_playthroughs(results)
+    report["workers"] = workers
+    report["elapsed"] = time.perf_counter() - started
+    return report
+
+
+def format_farm_report(report: dict) -> str:
+    lines = [f"Прохождений: {report['runs']}  процессов: {report['workers']}  время: {report['elapsed']:.2f}s"]
+    lines.append("Концовки:")
+    for ending, count in report["endings"].items():
+        lines.append(f"  {count:6d}  {ending}")
+    lines.append(f"Уровень у мини-босса: {report['level_at_miniboss']}")
+    lines.append(f"Смертей в бою: {report['deaths_total']} (в среднем {report['deaths_mean']:.2f}), боёв в среднем: {report['combats_mean']:.2f}")
+    lines.append(f"Золото в конце: {report['gold_mean']:.1f}  уровень: {report['level_mean']:.2f}  игровое время: {report['sim_time_mean']:.1f}s")
+    lines.append("Вехи (дошли / время / золото / уровень / опыт):")
+    for milestone, c in report["curves"].items():
+        lines.append(f"  {milestone:13s} {c['reached']:6d} {c['time']:7.1f}s {c['gold']:6.1f} {c['level']:5.2f} {c['xp']:5.1f}")
+    return "\n".join(lines)
+
+
+# ---------- Пространство состояний квестов ----------
+# Поиск в ширину по абстрактным состояниям игры: из GameState берутся только сюжетные поля.
+# Сами состояния хранят настоящие числа; в ключе таблицы число обрезается до
+# «порог + наибольшая потеря за шаг × оставшиеся шаги до горизонта EXPLORE_MAX_DEPTH»: выше этого
+# значения состояния неотличимы ни одной проверкой до конца поиска (числа только растут, падают
+# не больше чем на потерю за шаг или сбрасываются в константу), так что склеиваются лишь
+# действительно равные. Переходы повторяют действия сцен: варианты диалогов
+# (прямо из data/dialogue, обе ветки "chance"), лавка, бои (считаются выигранными — проигрыш
+# состояние не меняет), травы, забег на время, новый забег. Алтарь пропускается: способности
+# на сюжет не влияют, поэтому копии состояний разделяют контейнеры. Таблица транспозиций хранит
+# ключ состояния -> (ключ родителя, действие): память ограничена числом уникальных состояний,
+# в очереди лежит лишь текущий слой, а кратчайший путь восстанавливается по родителям.
+EXPLORE_MAX_STATES = 500_000
+EXPLORE_MAX_DEPTH = 16
+# (поле, наибольший порог в правилах, наибольшая потеря за один шаг): честь 2 у лучших концовок,
+# вор -1; меч + зелье (8 + 5), меч -8; спутник 3 травы, -3; номер забега только растёт
+_EXPLORE_LIMITS = tuple((_FIELD_INDEX[name], threshold, loss) for name, threshold, loss in
+                        (("honor", 2, 1), ("gold", 13, 8), ("herbs", 3, 3), ("run_number", 1, 0)))
+# Флаги, от которых зависят переходы и концовки (helped_npc ни на что не влияет, guard_defeated
+# дублирует "guardian" в defeated_enemies)
+_EXPLORE_FLAGS = 0
+for _name in ("has_key", "beast_defeated", "has_sword", "artifact_found", "companion_joined", "dungeon_fully_cleared", "miniboss_defeated", "final_boss_defeated",
+              "totem_defeated", "trial_completed"):
+    _EXPLORE_FLAGS |= 1 << _FIELD_INDEX[_name]
+del _name
+_EXPLORE_DIALOGUES = {"overworld": ("traveler", "shop", "thief"), "fields": ("herbalist",)}
+_DUNGEON_ENEMIES = ("guardian", "sentry_left", "sentry_right")
+
+
+class _ExploreScene:
+    # Заглушка сцены для эффектов диалога (сообщения исследователю не нужны)
+    __slots__ = ("message", "message_timer")
+
+    def __init__(self):
+        self.message = ""
+        self.message_timer = 0.0
+
+
+_DEFEATED_INDEX = _FIELD_INDEX["defeated_enemies"]
+_LOCATION_INDEX = _FIELD_INDEX["last_location"]
+
+
+def _explore_key(gs: GameState, remaining: int | None = None) -> tuple:
+    # remaining — шагов до горизонта (None — точные числа)
+    values = gs._values
+    key = [gs._flags & _EXPLORE_FLAGS, tuple(sorted(values[_DEFEATED_INDEX])), values[_LOCATION_INDEX]]
+    for i, threshold, loss in _EXPLORE_LIMITS:
+        value = values[i]
+        if remaining is not None:
+            value = min(value, threshold + loss * remaining)
+        key.append(value)
+    return tuple(key)
+
+
+def _explore_ending(gs: GameState) -> int:
+    for i, rule in enumerate(ENDINGS.rules):
+        if rule.predicate(gs):
+            return i
+    return -1
+
+
+def _explore_dialogue(gs: GameState, conv: Conversation, node_id: str, prefix: str, depth: int = 0):
+    # Все исходы разговора: каждый видимый вариант, для "chance" — удача и неудача
+    scene = _ExploreScene()
+    for choice in conv.nodes[node_id].choices:
+        if choice.visible is not None and not choice.visible(gs):
+            continue
+        outcomes = []
+        rolled = []
+        for roll in (0.0, 1.0):
+            child = gs.copy(True)
+            next_node = choice.action(child, scene, lambda: rolled.append(roll) or roll)
+            if not outcomes or _explore_key(child) != _explore_key(outcomes[0][0]):
+                outcomes.append((child, next_node))
+            if not rolled:
+                break  # вариант не зависит от случая — вторая ветка не нужна
+        for child, next_node in outcomes:
+            label = prefix + ": " + choice.label
+            if len(outcomes) > 1:
+                label += " (удача)" if child is outcomes[0][0] else " (неудача)"
+            if next_node in conv.nodes and depth < 16:
+                yield from _explore_dialogue(child, conv, next_node, label, depth + 1)
+            else:
+                yield label, child
+
+
+def _explore_win(gs: GameState, enemy_id: str) -> GameState:
+    # Та же награда, что CombatScene выдаёт при победе
+    gs.defeat_enemy(enemy_id)
+    if enemy_id == "guardian":
+        gs.guard_defeated = True
+    return gs
+
+
+def _explore_successors(gs: GameState):
+    location = gs.last_location
+    for name in _EXPLORE_DIALOGUES.get(location, ()):
+        yield from _explore_dialogue(gs, load_conversation(name), load_conversation(name).start, name)
+    if location == "overworld":
+        if not gs.beast_defeated:
+            child = gs.copy(True)
+            child.beast_defeated = True
+            yield "скилл-чек: зверь изгнан", child
+        elif not gs.has_key:
+            yield from _explore_dialogue(gs, load_conversation("door"), load_conversation("door").start, "door")
+        else:
+            child = gs.copy(True)
+            child.last_location = "dungeon"
+            yield "войти в подземелье", child
+        if not gs.totem_defeated:
+            child = _explore_win(gs.copy(True), "totem_challenge")
+            child.totem_defeated = True
+            child.gold += 10
+            yield "бой: тотем", child
+        child = gs.copy(True)
+        child.last_location = "fields"
+        yield "выйти на поля", child
+        child = gs.copy(True)
+        child.start_new_run()
+        yield "новый забег (N)", child
+    elif location == "fields":
+        child = gs.copy(True)
+        child.herbs += 1
+        yield "собрать траву", child
+        if not gs.trial_completed:
+            child = gs.copy(True)
+            child.trial_completed = True
+            child.gold += 8
+            yield "забег на время", child
+        child = gs.copy(True)
+        child.last_location = "overworld"
+        yield "вернуться в город", child
+    elif location == "dungeon":
+        for enemy_id in _DUNGEON_ENEMIES:
+            if enemy_id not in gs.defeated_enemies and not (enemy_id == "guardian" and gs.guard_defeated):
+                yield "бой: " + enemy_id, _explore_win(gs.copy(True), enemy_id)
+        cleared = all(e in gs.defeated_enemies for e in _DUNGEON_ENEMIES[1:]) and gs.guard_defeated
+        if cleared and not gs.artifact_found:
+            child = gs.copy(True)
+            child.dungeon_fully_cleared = True
+            child.artifact_found = True
+            yield "открыть сундук", child
+        if gs.artifact_found and not gs.miniboss_defeated:
+            child = _explore_win(gs.copy(True), "miniboss")
+            child.miniboss_defeated = True
+            yield "бой: мини-босс", child
+        child = gs.copy(True)
+        child.last_location = "overworld"
+        yield "выйти из подземелья", child
+
+
+def explore_quest_states(max_states: int = EXPLORE_MAX_STATES, start: GameState | None = None,
+                         max_depth: int = EXPLORE_MAX_DEPTH) -> dict:
+    started = time.perf_counter()
+    root = start.copy() if start is not None else GameState()
+    root_key = _explore_key(root, max_depth)
+    labels: list[str] = []
+    label_ids: dict[str, int] = {}
+    # Ключ -> (ключ родителя, номер действия); ключ — сам кортеж, без хэшей и коллизий
+    table: dict[tuple, tuple[tuple, int]] = {root_key: (root_key, -1)}
+    endings: dict[int, tuple[tuple, str]] = {}
+
+    def record_ending(key: tuple, gs: GameState):
+        index = _explore_ending(gs)
+        if index not in endings:
+            text = ENDINGS.rules[index].payload[0]
+            endings[index] = (key, text(gs) if callable(text) else text)
+
+    record_ending(root_key, root)
+    frontier = [(root_key, root)]
+    depth = transitions = 0
+    truncated = horizon = False
+    while frontier and not truncated:
+        if depth >= max_depth:
+            horizon = True
+            break
+        next_frontier = []
+        remaining = max_depth - depth - 1
+        for parent, gs in frontier:
+            for label, child in _explore_successors(gs):
+                transitions += 1
+                key = _explore_key(child, remaining)
+                if key in table:
+                    continue
+                if len(table) >= max_states:
+                    truncated = True
+                    break
+                label_id = label_ids.get(label)
+                if label_id is None:
+                    label_id = label_ids[label] = len(labels)
+                    labels.append(label)
+                table[key] = (parent, label_id)
+                record_ending(key, child)
+                next_frontier.append((key, child))
+            if truncated:
+                break
+        frontier = next_frontier
+        if frontier:
+            depth += 1
+
+    def path_to(key: tuple) -> list[str]:
+        steps = []
+        parent, label_id = table[key]
+        while label_id >= 0:
+            steps.append(labels[label_id])
+            key = parent
+            parent, label_id = table[key]
+        steps.reverse()
+        return steps
+
+    report_endings = []
+    for i, rule in enumerate(ENDINGS.rules):
+        text, _ = rule.payload
+        if i in endings:
+            key, text = endings[i]
+            report_endings.append({"index": i, "text": text, "reachable": True, "path": path_to(key)})
+        else:
+            report_endings.append({"index": i, "text": text(root) if callable(text) else text,
+                                   "reachable": False, "path": None})
+    return {
+        "states": len(table),
+        "transitions": transitions,
+        "depth": depth,
+        "truncated": truncated,
+        "horizon": max_depth if horizon else None,
+        "elapsed": time.perf_counter() - started,
+        "endings": report_endings,
+    }
+
+
+def format_explore_report(report: dict) -> str:
+    lines = [f"Состояний: {report['states']}  переходов: {report['transitions']}  глубина: {report['depth']}  "
+             f"время: {report['elapsed']:.2f}s" + ("  (обрезано по лимиту)" if report["truncated"] else "")]
+    for ending in report["endings"]:
+        title = ending["text"].split("\n")[0]
+        if ending["reachable"]:
+            lines.append(f"[+] #{ending['index']} {title} — {len(ending['path'])} шагов")
+            for step in ending["path"]:
+                lines.append(f"      {step}")
+        else:
+            if report["truncated"]:
+                verdict = "не найдена до лимита"
+            elif report["horizon"] is not None:
+                verdict = f"не найдена за {report['horizon']} шагов"
+            else:
+                verdict = "недостижима"
+            lines.append(f"[-] #{ending['index']} {title} — {verdict}")
+    return "\n".join(lines)
+
+
+# ---------- Вывод кадра ----------
+# Сцены рисуют во внутреннюю поверхность логического размера WIDTH x HEIGHT, поэтому игровые
+# координаты не зависят от окна. Если окно другого размера, кадр масштабируется с сохранением
+# пропорций (поля по краям) или с целым коэффициентом (пиксель в пиксель). Самая дорогая часть
+# на большом окне — сглаживающее масштабирование, поэтому динамическое разрешение управляет им:
+# кадр сглаживается в промежуточное разрешение 1/n от итогового и растягивается в n раз
+# (целый множитель nearest почти бесплатен). Шаг выбирается автоматически по времени кадра.
+RENDER_SCALES = (1.0, 0.5, 0.25)
+RENDER_BUDGET_MS = 1000.0 / 60
+RENDER_ADAPT_INTERVAL = 1.0  # не чаще раза в секунду, чтобы разрешение не «дрожало»
+
+
+class FramePresenter:
+    def __init__(self, window_size: tuple[int, int] = (WIDTH, HEIGHT), integer_scaling: bool = False,
+                 auto_scale: bool = True, budget_ms: float = RENDER_BUDGET_MS):
+        self.integer_scaling = integer_scaling
+        self.auto_scale = auto_scale
+        self.budget_ms = budget_ms
+        self.scale_index = 0
+        self.frame_ms = 0.0
+        self.since_adapt = 0.0
+        self.window = pygame.display.set_mode(window_size, pygame.RESIZABLE)
+        self.canvas = pygame.Surface((WIDTH, HEIGHT)).convert()
+        self._layout()
+
+    @property
+    def render_scale(self) -> float:
+        return RENDER_SCALES[self.scale_index]
+
+    def set_render_scale(self, scale: float):
+        # Ручной выбор шага отключает автоподстройку
+        self.auto_scale = False
+        self.scale_index = min(range(len(RENDER_SCALES)), key=lambda i: abs(RENDER_SCALES[i] - scale))
+        self._layout()
+
+    def resize(self, size: tuple[int, int]):
+        self.window = pygame.display.set_mode((max(1, size[0]), max(1, size[1])), pygame.RESIZABLE)
+        self._layout()
+
+    def _layout(self):
+        win_w, win_h = self.window.get_size()
+        k = min(win_w // WIDTH, win_h // HEIGHT)
+        if self.integer_scaling and k >= 1:
+            w, h = WIDTH * k, HEIGHT * k
+        else:
+            fit = min(win_w / WIDTH, win_h / HEIGHT)
+            w, h = max(1, int(WIDTH * fit)), max(1, int(HEIGHT * fit))
+        self.dest = pygame.Rect((win_w - w) // 2, (win_h - h) // 2, w, h)
+        # Окно ровно логического размера — сцены рисуют прямо в него, без копирования
+        self.direct = self.dest.size == (WIDTH, HEIGHT)
+        self.pixel_perfect = self.integer_scaling and k >= 1
+        self._target = None if self.direct else self.window.subsurface(self.dest)
+        self._internal = None
+        if not self.direct and not self.pixel_perfect and self.render_scale < 1.0:
+            n = round(1 / self.render_scale)
+            iw, ih = max(1, w // n), max(1, h // n)
+            self._internal = pygame.Surface((iw, ih)).convert()
+            # Растянутый кадр может быть на пару пикселей меньше dest — центрируем его
+            upscaled = pygame.Rect(0, 0, iw * n, ih * n)
+            upscaled.center = self.dest.center
+            self._target = self.window.subsurface(upscaled)
+        self.window.fill(BLACK)
+
+    def surface(self) -> pygame.Surface:
+        return self.window if self.direct else self.canvas
+
+    def present(self):
+        if not self.direct:
+            if self.pixel_perfect:
+                pygame.transform.scale(self.canvas, self.dest.size, self._target)
+            elif self._internal is None:
+                pygame.transform.smoothscale(self.canvas, self.dest.size, self._target)
+            else:
+                pygame.transform.smoothscale(self.canvas, self._internal.get_size(), self._internal)
+                pygame.transform.scale(self._internal, self._target.get_size(), self._target)
+        pygame.display.flip()
+
+    def record(self, frame_seconds: float):
+        # Сглаженное время работы кадра (без ожидания clock.tick) и шаг разрешения с гистерезисом
+        ms = frame_seconds * 1000.0
+        self.frame_ms = ms if self.frame_ms == 0.0 else self.frame_ms * 0.9 + ms * 0.1
+        self.since_adapt += frame_seconds
+        if not self.auto_scale or self.direct or self.pixel_perfect or self.since_adapt < RENDER_ADAPT_INTERVAL:
+            return
+        if self.frame_ms > self.budget_ms * 1.1 and self.scale_index < len(RENDER_SCALES) - 1:
+            self.scale_index += 1
+        elif self.frame_ms < self.budget_ms * 0.6 and self.scale_index > 0:
+            self.scale_index -= 1
+        else:
+            return
+        self.since_adapt = 0.0
+        self._layout()
+
+
+class RendererPresenter:
+    # Тот же интерфейс, что у FramePresenter, но кадр собирает SDL Renderer (в том числе
+    # программный, accelerated=0); вписывание в окно делает сам рендерер через logical_size
+    def __init__(self, window_size: tuple[int, int] = (WIDTH, HEIGHT), accelerated: int = -1):
+        if SDLRenderer is None:
+            raise RuntimeError("pygame._sdl2.video недоступен")
+        # convert()/convert_alpha() в загрузчиках требуют режим экрана — заводим скрытый
+        pygame.display.set_mode((1, 1), pygame.HIDDEN)
+        self.window = SDLWindow(TITLE, window_size, resizable=True)
+        self.renderer = SDLRenderer(self.window, accelerated=accelerated)
+        self.renderer.logical_size = (WIDTH, HEIGHT)
+        self.target = RendererTarget(self.renderer)
+        self.render_scale = 1.0
+        self.frame_ms = 0.0
+
+    def resize(self, size: tuple[int, int]):
+        pass
+
+    def set_render_scale(self, scale: float):
+        pass
+
+    def surface(self) -> RendererTarget:
+        return self.target
+
+    def present(self):
+        self.renderer.present()
+
+    def record(self, frame_seconds: float):
+        ms = frame_seconds * 1000.0
+        self.frame_ms = ms if self.frame_ms == 0.0 else self.frame_ms * 0.9 + ms * 0.1
+
+    def close(self):
+        self.window.destroy()
+
+
+def make_presenter(backend: str, window_size: tuple[int, int] = (WIDTH, HEIGHT), integer_scaling: bool = False,
+                   accelerated: int = -1):
+    if backend == "renderer":
+        return RendererPresenter(window_size, accelerated)
+    return FramePresenter(window_size, integer_scaling)
+
+
+# ---------- Сравнение бэкендов ----------
+# Одни и те же сцены с одинаковым seed и одинаковым вводом (удержание «вправо», периодические
+# эффекты частиц) прогоняются через оба бэкенда; меряется update + draw + present.
+BENCH_SCENES = ("TitleScene", "OverworldScene", "FieldsScene", "DungeonScene", "CombatScene", "DialogueScene", "QuestLogScene")
+BENCH_WARMUP = 10
+
+
+def _bench_scene(name: str, manager: SceneManager, gs: GameState) -> Scene:
+    if name == "TitleScene":
+        return TitleScene(manager)
+    if name == "CombatScene":
+        return CombatScene(manager, gs, OverworldScene(manager, gs))
+    if name == "DialogueScene":
+        return DialogueScene.conversation(manager, "traveler", gs, OverworldScene(manager, gs))
+    if name == "QuestLogScene":
+        return QuestLogScene(manager, gs, OverworldScene(manager, gs))
+    return globals()[name](manager, gs)
+
+
+def benchmark_backends(frames: int = 240, backends: tuple[str, ...] = ("surface", "renderer"), accelerated: int = 0) -> dict:
+    pygame.init()
+    results: dict[str, dict[str, float]] = {name: {} for name in BENCH_SCENES}
+    for backend in backends:
+        presenter = make_presenter(backend, accelerated=accelerated)
+        for name in BENCH_SCENES:
+            random.seed(0)
+            gs = GameState()
+            gs.beast_defeated = gs.has_key = True
+            manager = SceneManager(lambda m: _bench_scene(name, m, gs))
+            manager.held_keys = HeldKeys()
+            manager.held_keys.down.add(pygame.K_RIGHT)
+            total = 0.0
+            for i in range(BENCH_WARMUP + frames):
+                started = time.perf_counter()
+                if i % 30 == 0:
+                    manager.particles.emit_effect("fire", WIDTH // 2, HEIGHT // 2)
+                pygame.event.pump()
+                manager.update(1.0 / 60)
+                manager.draw(presenter.surface())
+                presenter.present()
+                if i >= BENCH_WARMUP:
+                    total += time.perf_counter() - started
+            results[name][backend] = total / frames * 1000.0
+        if hasattr(presenter, "close"):
+            presenter.close()
+    return {"frames": frames, "backends": list(backends), "scenes": results}
+
+
+def format_backend_benchmark(report: dict) -> str:
+    backends = report["backends"]
+    lines = [f"Кадров на сцену: {report['frames']}, мс на кадр (update + draw + present)"]
+    lines.append(f"  {'сцена':16s}" + "".join(f"{b:>12s}" for b in backends))
+    for name, per_backend in report["scenes"].items():
+        lines.append(f"  {name:16s}" + "".join(f"{per_backend[b]:12.2f}" for b in backends))
+    return "\n".join(lines)
+
+
+# ---------- Захват кадров ----------
+# F12 — скриншот, F10 — «баг-репорт»: последние CAPTURE_SECONDS секунд игры кадрами PNG.
+# На главном потоке кадр только копируется в заранее выделенный буфер (скриншот — в полном
+# размере, кольцо последних секунд — в уменьшенном и с пониженной частотой, объём кольца
+# ограничен CAPTURE_MEMORY_MB). Кодирование PNG — в фоновом потоке: пишем PNG сами через zlib,
+# который отпускает GIL при сжатии, так что поток не тормозит отрисовку.
+CAPTURE_DIR = "captures"
+CAPTURE_FPS = 20
+CAPTURE_SECONDS = 10
+CAPTURE_SCALE = 0.5
+CAPTURE_MEMORY_MB = 64
+CAPTURE_SHOT_BUFFERS = 2
+
+
+def write_png(path: str, width: int, height: int, rgb: bytes, level: int = 6):
+    stride = width * 3
+    view = memoryview(rgb)
+    raw = bytearray()
+    for y in range(height):
+        raw.append(0)  # фильтр строки: None
+        raw += view[y * stride:(y + 1) * stride]
+
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+        f.write(chunk(b"IDAT", zlib.compress(bytes(raw), level)))
+        f.write(chunk(b"IEND", b""))
+
+
+class FrameCapture:
+    def __init__(self, fps: int = CAPTURE_FPS, seconds: float = CAPTURE_SECONDS, scale: float = CAPTURE_SCALE,
+                 memory_mb: int = CAPTURE_MEMORY_MB, directory: str = CAPTURE_DIR):
+        self.directory = directory
+        self.fps = fps
+        self.interval = 1.0 / fps
+        self.size = (max(1, int(WIDTH * scale)), max(1, int(HEIGHT * scale)))
+        frame_bytes = self.size[0] * self.size[1] * 4
+        capacity = max(1, min(int(fps * seconds), memory_mb * 1024 * 1024 // frame_bytes))
+        self.ring = [pygame.Surface(self.size) for _ in range(capacity)]
+        self.times = [0.0] * capacity
+        self.count = 0
+        self.accum = 0.0
+        self.shots = [pygame.Surface((WIDTH, HEIGHT)) for _ in range(CAPTURE_SHOT_BUFFERS)]
+        self.shot_busy = [False] * CAPTURE_SHOT_BUFFERS
+        # Пока поток выгружает кольцо, новые кадры в него не пишутся
+        self.dumping = False
+        self.want_shot = False
+        self.want_dump = False
+        self.notice = ""
+        self.notice_timer = 0.0
+        self._jobs: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name="capture", daemon=True)
+        self._thread.start()
+
+    def memory_bytes(self) -> int:
+        return len(self.ring) * self.size[0] * self.size[1] * 4 + len(self.shots) * WIDTH * HEIGHT * 4
+
+    def handle_event(self, event) -> bool:
+        if event.type != pygame.KEYDOWN:
+            return False
+        if event.key == pygame.K_F12:
+            self.want_shot = True
+            return True
+        if event.key == pygame.K_F10:
+            self.want_dump = True
+            return True
+        return False
+
+    def _source(self, target) -> pygame.Surface:
+        if isinstance(target, pygame.Surface):
+            return target
+        return target.renderer.to_surface()
+
+    def frame(self, target, dt: float):
+        # Вызывается после отрисовки сцены, до показа кадра
+        if self.want_shot:
+            self.want_shot = False
+            self._screenshot(self._source(target))
+        if self.want_dump:
+            self.want_dump = False
+            self._dump()
+        self.accum += dt
+        if self.dumping or self.accum < self.interval:
+            return
+        self.accum = min(self.accum - self.interval, self.interval)
+        i = self.count % len(self.ring)
+        pygame.transform.scale(self._source(target), self.size, self.ring[i])
+        self.times[i] = time.time()
+        self.count += 1
+
+    def _say(self, text: str):
+        self.notice = text
+        self.notice_timer = 2.0
+
+    def _screenshot(self, source: pygame.Surface):
+        for i, busy in enumerate(self.shot_busy):
+            if not busy:
+                break
+        else:
+            self._say("Скриншот пропущен: предыдущие ещё сохраняются")
+            return
+        if source.get_size() == (WIDTH, HEIGHT):
+            self.shots[i].blit(source, (0, 0))
+        else:
+            pygame.transform.smoothscale(source, (WIDTH, HEIGHT), self.shots[i])
+        self.shot_busy[i] = True
+        path = os.path.join(self.directory, time.strftime("shot-%Y%m%d-%H%M%S") + f"-{self.count}.png")
+        self._jobs.put(("shot", i, path))
+        self._say("Скриншот: " + path)
+
+    def _dump(self):
+        if self.dumping or not self.count:
+            return
+        n = min(self.count, len(self.ring))
+        order = [(self.count - n + k) % len(self.ring) for k in range(n)]
+        path = os.path.join(self.directory, time.strftime("bug-%Y%m%d-%H%M%S"))
+        self.dumping = True
+        self._jobs.put(("dump", order, path))
+        self._say(f"Баг-репорт: последние {n / self.fps:.0f} с -> {path}")
+
+    def draw_notice(self, target, dt: float):
+        if self.notice_timer > 0:
+            self.notice_timer -= dt
+            draw_text(target, self.notice, 18, YELLOW, WIDTH // 2, HEIGHT - 90, center=True)
+
+    def stop(self):
+        self._jobs.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                if job[0] == "shot":
+                    _, i, path = job
+                    rgb = pygame.image.tobytes(self.shots[i], "RGB")
+                    self.shot_busy[i] = False
+                    write_png(path, WIDTH, HEIGHT, rgb)
+                    TELEMETRY.emit("capture", what="screenshot", path=path)
+                else:
+                    _, order, path = job
+                    os.makedirs(path, exist_ok=True)
+                    w, h = self.size
+                    for k, i in enumerate(order):
+                        write_png(os.path.join(path, f"frame_{k:04d}.png"), w, h, pygame.image.tobytes(self.ring[i], "RGB"), level=1)
+                    with open(os.path.join(path, "meta.json"), "w", encoding="utf-8") as f:
+                        json.dump({"fps": self.fps, "frames": len(order), "size": [w, h],
+                                   "times": [self.times[i] for i in order]}, f)
+                    TELEMETRY.emit("capture", what="bug_report", path=path, frames=len(order))
+            except OSError:
+                pass  # не удалось записать — игра продолжается
+            finally:
+                if job[0] == "shot":
+                    self.shot_busy[job[1]] = False
+                else:
+                    self.dumping = False
+
+
+# ---------- Поток симуляции ----------
+# Необязательный конвейер из двух потоков (--threaded). Поток симуляции обрабатывает ввод,
+# тикает сцену и GameState и «рисует» кадр в RecordingTarget — тот только записывает команды
+# в неизменяемый снимок (кортеж). Прямоугольники копируются, динамические поверхности (туман,
+# свет — те, что отмечены mark_surface_changed) копируются при смене поколения, буферы частиц —
+# в момент записи, так что следующий тик снимок не трогает. Снимок публикуется в двойной буфер.
+# Главный поток (события SDL и окно должны жить на нём) воспроизводит последний снимок
+# в настоящую цель и показывает кадр: блиты и flip отпускают GIL и идут параллельно с логикой.
+SIM_SNAPSHOT_WAIT = 0.1
+
+
+class RecordingTarget:
+    def __init__(self):
+        self.commands: list[tuple] = []
+        # Копии динамических поверхностей: поверхность -> (поколение, копия)
+        self._copies: "weakref.WeakKeyDictionary[pygame.Surface, tuple]" = weakref.WeakKeyDictionary()
+
+    def get_size(self) -> tuple[int, int]:
+        return (WIDTH, HEIGHT)
+
+    def get_width(self) -> int:
+        return WIDTH
+
+    def get_height(self) -> int:
+        return HEIGHT
+
+    def _frozen(self, surf: pygame.Surface) -> pygame.Surface:
+        generation = _SURFACE_GENERATION.get(surf)
+        if generation is None:
+            return surf  # кэшированные текстуры и кадры не меняются
+        entry = self._copies.get(surf)
+        if entry is None or entry[0] != generation:
+            entry = self._copies[surf] = (generation, surf.copy())
+        return entry[1]
+
+    def fill(self, color, rect=None):
+        self.commands.append(("fill", color, None if rect is None else tuple(rect)))
+
+    def blit(self, source: pygame.Surface, dest, area=None, special_flags: int = 0):
+        self.commands.append(("blit", self._frozen(source), (dest[0], dest[1]),
+                              None if area is None else tuple(area), special_flags))
+
+    def draw_rect(self, color, rect, width: int = 0):
+        self.commands.append(("rect", color, tuple(rect), width))
+
+    def draw_circle(self, color, center, radius: int, width: int = 0):
+        self.commands.append(("circle", color, (center[0], center[1]), radius, width))
+
+    def draw_text(self, text: str, size: int, color, x: int, y: int, center=True):
+        self.commands.append(("text", text, size, color, x, y, center))
+
+    def draw_glyphs(self, text: str, size: int, color, x: int, y: int, center=True):
+        self.commands.append(("glyphs", text, size, color, x, y, center))
+
+    def draw_points(self, xs, ys, colors, size: int = 2):
+        self.commands.append(("points", xs.copy(), ys.copy(), colors.copy()))
+
+    def snapshot(self) -> tuple:
+        commands = tuple(self.commands)
+        self.commands.clear()
+        return commands
+
+
+def replay_snapshot(commands: tuple, target):
+    surface = isinstance(target, pygame.Surface)
+    for command in commands:
+        op = command[0]
+        if op == "blit":
+            target.blit(command[1], command[2], command[3], command[4])
+        elif op == "text":
+            draw_text(target, *command[1:])
+        elif op == "glyphs":
+            draw_glyphs(target, *command[1:])
+        elif op == "rect":
+            draw_rect(target, command[1], command[2], command[3])
+        elif op == "fill":
+            if command[2] is None:
+                target.fill(command[1])
+            else:
+                target.fill(command[1], command[2])
+        elif op == "circle":
+            draw_circle(target, command[1], command[2], command[3], command[4])
+        elif op == "points":
+            _, xs, ys, rgb = command
+            if not surface:
+                target.draw_points(xs, ys, rgb)
+                continue
+            # Частицы 2×2, как в ParticlePool.draw
+            try:
+                pixels = pygame.surfarray.pixels3d(target)
+            except (ValueError, pygame.error):
+                continue
+            try:
+                pixels[xs, ys] = rgb
+                pixels[xs + 1, ys] = rgb
+                pixels[xs, ys + 1] = rgb
+                pixels[xs + 1, ys + 1] = rgb
+            finally:
+                del pixels
+
+
+class SnapshotBuffer:
+    def __init__(self):
+        self._cond = threading.Condition()
+        # Передний слот читает отрисовка, в задний пишет симуляция; публикация — обмен
+        self._slots: list[tuple | None] = [None, None]
+        self._front = 0
+        self.seq = 0
+        self.closed = False
+
+    def publish(self, snapshot: tuple):
+        with self._cond:
+            back = 1 - self._front
+            self._slots[back] = snapshot
+            self._front = back
+            self.seq += 1
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def wait(self, seen: int, timeout: float) -> tuple[int, tuple | None]:
+        # Ждём снимок новее seen; по таймауту возвращаем текущий номер (кадр пропускается)
+        with self._cond:
+            self._cond.wait_for(lambda: self.seq != seen or self.closed, timeout)
+            return self.seq, self._slots[self._front]
+
+
+class SimulationThread:
+    def __init__(self, manager: SceneManager, fps: int = FPS, idle: bool = True):
+        self.manager = manager
+        manager.exit_on_quit = False
+        self.interval = 1.0 / fps
+        self.idle = idle
+        self.buffer = SnapshotBuffer()
+        self.error: BaseException | None = None
+        self.ticks = 0
+        self.tick_time = 0.0
+        self._events: queue.SimpleQueue = queue.SimpleQueue()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="simulation", daemon=True)
+        self._thread.start()
+
+    @property
+    def alive(self) -> bool:
+        return self._thread.is_alive()
+
+    def post(self, event):
+        self._events.put(event)
+
+    def stop(self):
+        self._running = False
+        self._events.put(None)  # разбудить, если симуляция ждёт ввода
+        self._thread.join()
+
+    def _run(self):
+        recorder = RecordingTarget()
+        manager = self.manager
+        last = time.perf_counter()
+        held = None
+        dt_cap = None
+        try:
+            while self._running and not manager.quit_requested:
+                now = time.perf_counter()
+                if now - last < self.interval:
+                    time.sleep(self.interval - (now - last))
+                    continue
+                dt = now - last
+                last = now
+                if dt_cap is not None:
+                    dt = min(dt, dt_cap)
+                    dt_cap = None
+                if held is not None:
+                    manager.handle_event(held)
+                    held = None
+                while True:
+                    try:
+                        event = self._events.get_nowait()
+                    except queue.Empty:
+                        break
+                    if event is not None:
+                        manager.handle_event(event)
+                manager.update(dt)
+                manager.draw(recorder)
+                self.buffer.publish(recorder.snapshot())
+                self.ticks += 1
+                self.tick_time += time.perf_counter() - now
+                # Статичная сцена: следующий тик — по вводу или когда она сама изменится
+                idle = manager.idle_for() if self.idle else None
+                if idle is not None and self._running:
+                    # Как в FramePacer: ожидание не превращается в большой шаг симуляции
+                    timeout = min(idle, IDLE_MAX_WAIT)
+                    try:
+                        held = self._events.get(timeout=timeout)
+                        dt_cap = self.interval
+                    except queue.Empty:
+                        dt_cap = timeout
+        except BaseException as exc:  # пробросим в главный поток
+            self.error = exc
+        finally:
+            self.buffer.close()
+
+
+# ---------- Темп кадров ----------
+# Статичные экраны (меню, диалог, журнал, концовка) не перерисовываются без нужды: цикл спит
+# в pygame.event.wait до ввода или до момента, когда сцена сама изменится. Без фокуса или
+# в свёрнутом окне — FPS_BACKGROUND. Лимит кадров ступенчато подстраивается под замеренное
+# время работы кадра. Точный tick_busy_loop жжёт ядро, поэтому включается только на высоких
+# ступенях и только если обычный tick на этой системе заметно просыпает (грубый таймер сна).
+FPS_STEPS = (120, 90, 60, 45, 30)
+FPS_BACKGROUND = 5
+IDLE_MAX_WAIT = 1.0
+PRECISE_FPS = 90
+PACING_WINDOW = 60
+PACING_HEADROOM_LOW = 0.85
+PACING_HEADROOM_HIGH = 0.5
+PACING_OVERSLEEP = 0.15  # доля бюджета кадра, которую tick в среднем может проспать
+
+
+class FramePacer:
+    def __init__(self, clock: pygame.time.Clock, fps: int = FPS):
+        self.clock = clock
+        self.steps = tuple(step for step in FPS_STEPS if step <= fps) or (fps,)
+        self.level = 0
+        self.focused = True
+        self.minimized = False
+        self._work = 0.0
+        self._late = 0.0
+        self._frames = 0
+        self.coarse_sleep = False
+        self.idle_waits = 0
+        self.precise_frames = 0
+
+    @property
+    def cap(self) -> int:
+        return self.steps[self.level]
+
+    @property
+    def background(self) -> bool:
+        return self.minimized or not self.focused
+
+    @property
+    def rate(self) -> int:
+        return FPS_BACKGROUND if self.background else self.cap
+
+    def handle_event(self, event):
+        # Только наблюдает за окном, событие дальше идёт как обычно
+        if event.type == pygame.WINDOWFOCUSLOST:
+            self.focused = False
+        elif event.type == pygame.WINDOWFOCUSGAINED:
+            self.focused = True
+        elif event.type in (pygame.WINDOWMINIMIZED, pygame.WINDOWHIDDEN):
+            self.minimized = True
+        elif event.type in (pygame.WINDOWRESTORED, pygame.WINDOWSHOWN, pygame.WINDOWMAXIMIZED):
+            self.minimized = False
+
+    def next_frame(self, idle: float | None) -> tuple[float, list]:
+        # idle — сколько сцена может не перерисовываться; возвращает (dt, события)
+        if idle is not None or self.background:
+            timeout = 1.0 / FPS_BACKGROUND if idle is None else min(idle, IDLE_MAX_WAIT)
+            if self.background:
+                timeout = max(timeout, 1.0 / FPS_BACKGROUND)
+            first = pygame.event.wait(max(1, int(timeout * 1000)))
+            events = pygame.event.get()
+            if first.type != pygame.NOEVENT:
+                events.insert(0, first)
+            self.idle_waits += 1
+            dt = self.clock.tick(self.rate) / 1000.0
+            # Ввод после ожидания часто меняет сцену, и новая не должна шагнуть на всё
+            # проспанное время (сквозь стены, минус секунды забега). Проснулись по таймауту
+            # без ввода — сцена сама просила столько ждать, отдаём ей это время (мигание меню).
+            if events or self.background:
+                return min(dt, 1.0 / self.cap), events
+            return min(dt, timeout), events
+        if self.coarse_sleep and self.cap >= PRECISE_FPS:
+            self.precise_frames += 1
+            dt = self.clock.tick_busy_loop(self.cap)
+        else:
+            dt = self.clock.tick(self.cap)
+            # Сколько сон проспал сверх бюджета (если кадр сам в бюджет уложился)
+            self._late += max(0.0, dt - max(1000.0 / self.cap, self.clock.get_rawtime())) / 1000.0
+        return dt / 1000.0, pygame.event.get()
+
+    def record(self, work: float):
+        # Средняя работа кадра за окно: не влезает в бюджет — ступень вниз, много запаса — вверх
+        self._work += work
+        self._frames += 1
+        if self._frames < PACING_WINDOW:
+            return
+        average = self._work / self._frames
+        if not self.coarse_sleep and self._late / self._frames > PACING_OVERSLEEP / self.cap:
+            self.coarse_sleep = True
+            TELEMETRY.emit("frame_pacing", precise=True, late_ms=round(self._late / self._frames * 1000, 2))
+        self._work = 0.0
+        self._late = 0.0
+        self._frames = 0
+        level = self.level
+        if average > PACING_HEADROOM_LOW / self.cap and level + 1 < len(self.steps):
+            level += 1
+        elif level > 0 and average < PACING_HEADROOM_HIGH / self.steps[level - 1]:
+            level -= 1
+        if level != self.level:
+            self.level = level
+            TELEMETRY.emit("frame_cap", fps=self.cap, work_ms=round(average * 1000, 2))
+
+
+# ---------- Горячая перезагрузка ----------
+# Режим разработки (--hot-reload): фоновый поток раз в HOT_RELOAD_INTERVAL опрашивает mtime
+# и размер файлов в assets/ и data/dialogue/. Файл считается готовым, когда его отметка не
+# менялась два опроса подряд (редактор дописал). Картинки декодируются и JSON разбирается
+# в том же потоке, а в кадре (в потоке, который обновляет сцены) остаются только
+# convert_alpha и точечная подмена: из кэшей текстур и анимаций уходят лишь записи с этим
+# путём, общие словари анимаций игрока обновляются на месте, разговор перекомпилируется,
+# а активная сцена и сцены под ней получают assets_reloaded для того, что держат сами.
+# Испорченный файл (недописанный PNG, битый JSON) пропускается — остаётся старая версия.
+HOT_RELOAD_INTERVAL = 0.5
+HOT_RELOAD_EVENT = pygame.event.custom_type()
+
+
+class HotReloader:
+    def __init__(self, roots: dict[str, str] | None = None, interval: float = HOT_RELOAD_INTERVAL):
+        # префикс имени -> каталог: "menu_bg.png", "dialogue/door.json"
+        self.roots = roots if roots is not None else {"": "assets", "dialogue/": DIALOGUE_DIR}
+        self.interval = interval
+        self.reloads = 0
+        self._stamps: dict[str, tuple[int, int]] = {}
+        self._pending: dict[str, tuple[int, int] | None] = {}
+        self._ready: queue.SimpleQueue = queue.SimpleQueue()
+        self._running = False
+        self._thread: threading.Thread | None = None
+
+    def start(self):
+        self._stamps = self._scan()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="hot-reload", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _scan(self) -> dict[str, tuple[int, int]]:
+        stamps = {}
+        for prefix, root in self.roots.items():
+            for dirpath, _, files in os.walk(root):
+                for filename in files:
+                    full = os.path.join(dirpath, filename)
+                    try:
+                        st = os.stat(full)
+                    except OSError:
+                        continue
+                    name = prefix + os.path.relpath(full, root).replace(os.sep, "/")
+                    stamps[name] = (st.st_mtime_ns, st.st_size)
+        return stamps
+
+    def _path(self, name: str) -> str:
+        for prefix, root in self.roots.items():
+            if prefix and name.startswith(prefix):
+                return os.path.join(root, name[len(prefix):])
+        return os.path.join(self.roots[""], name)
+
+    def _run(self):
+        while self._running:
+            time.sleep(self.interval)
+            stamps = self._scan()
+            ready = False
+            for name in self._stamps.keys() | stamps.keys() | self._pending.keys():
+                stamp = stamps.get(name)
+                if stamp != self._stamps.get(name):
+                    self._pending[name] = stamp
+                elif name in self._pending and self._pending[name] == stamp:
+                    del self._pending[name]
+                    self._ready.put(self._decode(name, stamp is None))
+                    ready = True
+            self._stamps = stamps
+            if ready:
+                # Разбудить цикл, если он спит в ожидании ввода
+                try:
+                    pygame.event.post(pygame.event.Event(HOT_RELOAD_EVENT))
+                except pygame.error:
+                    pass
+
+    def _decode(self, name: str, removed: bool) -> tuple:
+        # (имя, декодированные данные или None для удалённого файла, ошибка)
+        if removed:
+            return name, None, None
+        path = self._path(name)
+        ext = os.path.splitext(name)[1].lower()
+        try:
+            if name.startswith("dialogue/"):
+                with open(path, "r", encoding="utf-8") as f:
+                    return name, json.load(f), None
+            if ext in ASSET_IMAGE_EXTS:
+                return name, pygame.image.load(path), None
+        except (OSError, ValueError, pygame.error) as exc:
+            return name, None, exc
+        return name, None, None  # звуки и прочее — не перезагружаем
+
+    def pending(self) -> bool:
+        return not self._ready.empty()
+
+    def apply(self, manager: SceneManager) -> set[str]:
+        changed = set()
+        while True:
+            try:
+                name, data, error = self._ready.get_nowait()
+            except queue.Empty:
+                break
+            if error is not None:
+                self._skipped(manager, name, error)
+                continue
+            started = time.perf_counter()
+            if name.startswith("dialogue/"):
+                try:
+                    swapped = self._swap_conversation(name, data)
+                except (KeyError, TypeError, ValueError) as exc:
+                    self._skipped(manager, name, exc)
+                    continue
+                if not swapped:
+                    continue
+            elif os.path.splitext(name)[1].lower() in ASSET_IMAGE_EXTS:
+                self._swap_image(name, data)
+            else:
+                continue
+            changed.add(name)
+            self.reloads += 1
+            TELEMETRY.emit("hot_reload", name=name, ms=round((time.perf_counter() - started) * 1000, 2))
+        if changed:
+            scene, seen = manager.current, set()
+            while scene is not None and id(scene) not in seen:
+                seen.add(id(scene))
+                scene.assets_reloaded(changed)
+                scene = getattr(scene, "return_scene", None)
+        return changed
+
+    def _skipped(self, manager: SceneManager, name: str, error: Exception):
+        TELEMETRY.emit("hot_reload", name=name, error=str(error))
+        # Показываем там же, где сцена пишет свои сообщения (у меню их нет — только журнал)
+        scene = manager.current
+        if hasattr(scene, "message_timer"):
+            scene.message = f"Перезагрузка: {name} пропущен ({error})"
+            scene.message_timer = 3.0
+
+    def _swap_image(self, name: str, img: pygame.Surface | None):
+        if img is None:
+            _RELOADED_IMAGES.pop(name, None)
+        else:
+            _RELOADED_IMAGES[name] = img.convert_alpha()
+        # Только записи этого пути; заново масштабируются при следующем обращении
+        for key in [key for key in _TEXTURE_CACHE if key[0] == name]:
+            del _TEXTURE_CACHE[key]
+        for key in [key for key in _ANIMATION_CACHE if key[0] == name]:
+            del _ANIMATION_CACHE[key]
+        if name in PLAYER_ASSETS:
+            # Сцены держат эти словари у себя (AnimatedSprite) — обновляем на месте
+            for size, anims in _PLAYER_ANIMATIONS.items():
+                fresh = build_player_animations(size)
+                anims.clear()
+                anims.update(fresh)
+
+    def _swap_conversation(self, name: str, data: dict | None) -> bool:
+        conv_name = name[len("dialogue/"):].rsplit(".", 1)[0]
+        if data is None:
+            return False  # удалённый разговор оставляем в памяти
+        _CONVERSATIONS[conv_name] = compile_conversation(conv_name, data)
+        return True
+
+
 # ---------- Основной цикл ----------
-def main():
+def main(telemetry: bool = True, window_size: tuple[int, int] = (WIDTH, HEIGHT), integer_scaling: bool = False,
+         render_scale: float | None = None, backend: str = "surface", accelerated: int = -1, history: bool = True,
+         audio: bool = True, gc_tuning: bool = True, alloc_budget: int = GC_ALLOC_BUDGET, threaded: bool = False,
+         pace: bool = True, hot_reload: bool = False, gc_report: bool = False):
     pygame.init()
-    screen = pygame.display.set_mode((WIDTH, HEIGHT))
+    if telemetry:
+        TELEMETRY.start()
+    if history:
+        RUN_HISTORY.start()
+    # Пакет открывается до фоновых потоков (звук грузит из него же)
+    ASSET_PACK.open()
+    if audio:
+        AUDIO.start()
+    presenter = make_presenter(backend, window_size, integer_scaling, accelerated)
+    if render_scale is not None:
+        presenter.set_render_scale(render_scale)
     pygame.display.set_caption(TITLE)
     clock = pygame.time.Clock()
+    pacer = FramePacer(clock) if pace else None
 
     manager = SceneManager(lambda m: TitleScene(m))
+    if hot_reload:
+        manager.hot_reload = HotReloader()
+        manager.hot_reload.start()
+    capture = FrameCapture()
+    # Первый кадр подгружает шрифты и текстуры — после него всё загруженное замораживаем
+    manager.draw(presenter.surface())
+    GC_GOVERNOR.budget = alloc_budget
+    GC_GOVERNOR.start(tune=gc_tuning, diagnose=gc_report)
+    sim = SimulationThread(manager, idle=pace) if threaded else None
+    seen = 0
 
     running = True
     while running:
-        dt = clock.tick(FPS) / 1000.0
-        for event in pygame.event.get():
+        if pacer is None:
+            dt = clock.tick(FPS) / 1000.0
+            events = pygame.event.get()
+        else:
+            # Уведомления и оверлей живут по своим таймерам — на это время полный темп
+            idle = None if capture.notice_timer > 0 or GC_GOVERNOR.overlay else manager.idle_for()
+            dt, events = pacer.next_frame(idle)
+            if sim is not None:
+                sim.interval = 1.0 / pacer.rate
+        frame_start = time.perf_counter()
+        for event in events:
+            if pacer is not None:
+                pacer.handle_event(event)
             if event.type == pygame.QUIT:
                 running = False
+            elif event.type == pygame.VIDEORESIZE:
+                presenter.resize(event.size)
+            elif capture.handle_event(event) or GC_GOVERNOR.handle_event(event):
+                pass
+            elif sim is not None:
+                sim.post(event)
             else:
                 manager.handle_event(event)
 
-        manager.update(dt)
-        manager.draw(screen)
-
-        pygame.display.flip()
-
+        if sim is None:
+            manager.update(dt)
+            manager.draw(presenter.surface())
+        else:
+            seq, snapshot = sim.buffer.wait(seen, SIM_SNAPSHOT_WAIT)
+            if sim.error is not None:
+                raise sim.error
+            if manager.quit_requested or not sim.alive:
+                break
+            if seq == seen:
+                continue  # симуляция не успела — показывать нечего нового
+            seen = seq
+            frame_start = time.perf_counter()  # ожидание снимка — не время отрисовки
+            replay_snapshot(snapshot, presenter.surface())
+        capture.frame(presenter.surface(), dt)
+        capture.draw_notice(presenter.surface(), dt)
+        GC_GOVERNOR.draw_overlay(presenter.surface())
+
+        presenter.present()
+        work = time.perf_counter() - frame_start
+        presenter.record(work)
+        if pacer is not None:
+            pacer.record(work)
+        GC_GOVERNOR.frame_done()
+
+    if sim is not None:
+        sim.stop()
+    if manager.hot_reload is not None:
+        manager.hot_reload.stop()
+    gc_stats = GC_GOVERNOR.report()
+    TELEMETRY.emit("gc", **gc_stats)
+    if gc_report:
+        print(format_gc_report(gc_stats))
+    GC_GOVERNOR.stop()
+    capture.stop()
+    TELEMETRY.stop()
+    RUN_HISTORY.stop()
+    AUDIO.stop()
     pygame.quit()
     sys.exit(0)
 
 
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1:
+        import argparse
+        parser = argparse.ArgumentParser(description="Oracle")
+        parser.add_argument("--server", action="store_true", help="headless-сервер сессий")
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=7777)
+        parser.add_argument("--unix", default=None, help="путь к unix-сокету вместо TCP")
+        parser.add_argument("--tick-rate", type=int, default=SERVER_TICK_RATE)
+        parser.add_argument("--farm", type=int, default=0, metavar="N", help="прогнать N прохождений ботом")
+        parser.add_argument("--workers", type=int, default=None)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--report", default=None, help="сохранить отчёт фермы в JSON")
+        parser.add_argument("--explore", action="store_true", help="перебрать состояния квестов и концовки")
+        parser.add_argument("--max-states", type=int, default=EXPLORE_MAX_STATES)
+        parser.add_argument("--max-depth", type=int, default=EXPLORE_MAX_DEPTH, help="горизонт поиска концовок в шагах")
+        parser.add_argument("--no-telemetry", action="store_true", help="не писать журнал событий")
+        parser.add_argument("--no-history", action="store_true", help="не вести историю забегов")
+        parser.add_argument("--mute", action="store_true", help="без звука")
+        parser.add_argument("--build-pack", nargs="?", const="assets", default=None, metavar="SRC",
+                            help=f"собрать {ASSET_PACK_PATH} из каталога ресурсов")
+        parser.add_argument("--pack-compress", action="store_true", help="сжимать записи пакета zlib")
+        parser.add_argument("--threaded", action="store_true", help="симуляция и отрисовка в разных потоках")
+        parser.add_argument("--hot-reload", action="store_true", help="перечитывать изменённые assets/ и диалоги на лету")
+        parser.add_argument("--fixed-fps", action="store_true", help=f"всегда {FPS} FPS, без простоя и подстройки")
+        parser.add_argument("--stock-gc", action="store_true", help="не замораживать объекты и не откладывать сборки")
+        parser.add_argument("--alloc-budget", type=int, default=GC_ALLOC_BUDGET, help="бюджет прироста объектов под GC на кадр")
+        parser.add_argument("--gc-report", action="store_true",
+                            help="мерить память кадра через tracemalloc и напечатать отчёт GC при выходе")
+        parser.add_argument("--window", default=None, metavar="WxH", help="размер окна, например 1600x1280")
+        parser.add_argument("--integer-scale", action="store_true", help="целочисленное масштабирование кадра")
+        parser.add_argument("--render-scale", type=float, default=None, help="фиксированный шаг разрешения вместо авто")
+        parser.add_argument("--backend", choices=("surface", "renderer"), default="surface", help="бэкенд отрисовки")
+        parser.add_argument("--software-renderer", action="store_true", help="SDL Renderer без GPU")
+        parser.add_argument("--bench-backends", type=int, nargs="?", const=240, default=0, metavar="FRAMES",
+                            help="сравнить бэкенды на одинаковых сценах")
+        parser.add_argument("--telemetry-report", nargs="?", const=TELEMETRY_DIR, default=None, metavar="DIR",
+                            help="свести журналы телеметрии из каталога")
+        args = parser.parse_args()
+        if args.build_pack:
+            print(format_pack_report(build_asset_pack(args.build_pack, compress=args.pack_compress)))
+        elif args.server:
+            run_server(args.host, args.port, args.unix, args.tick_rate)
+        elif args.bench_backends:
+            print(format_backend_benchmark(benchmark_backends(args.bench_backends)))
+        elif args.telemetry_report:
+            print(format_telemetry_report(aggregate_telemetry(telemetry_files(args.telemetry_report), args.workers)))
+        elif args.explore:
+            print(format_explore_report(explore_quest_states(args.max_states, max_depth=args.max_depth)))
+        elif args.farm:
+            farm_report = run_farm(args.farm, args.workers, args.seed)
+            print(format_farm_report(farm_report))
+            if args.report:
+                with open(args.report, "w", encoding="utf-8") as f:
+                    json.dump(farm_report, f, ensure_ascii=False, indent=2)
+        else:
+            window = tuple(int(v) for v in args.window.lower().split("x")) if args.window else (WIDTH, HEIGHT)
+            main(telemetry=not args.no_telemetry, window_size=window, integer_scaling=args.integer_scale,
+                 render_scale=args.render_scale, backend=args.backend, accelerated=0 if args.software_renderer else -1,
+                 history=not args.no_history, audio=not args.mute, gc_tuning=not args.stock_gc,
+                 alloc_budget=args.alloc_budget, threaded=args.threaded, pace=not args.fixed_fps,
+                 hot_reload=args.hot_reload, gc_report=args.gc_report)
+    else:
+        main()
 
 